@@ -0,0 +1,99 @@
+"""
+Микробенчмарк Database.save_user: старый путь (SELECT + UPDATE/INSERT)
+против одного UPSERT с RETURNING
+
+Запуск из корня проекта:
+    python -m benchmarks.save_user [количество вызовов]
+
+Работает на временной БД, рабочие данные не затрагивает.
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+# Временная БД и заглушка токена - до импорта config
+_tmp_dir = tempfile.mkdtemp(prefix="bench_save_user_")
+os.environ["DB_USERS_PATH"] = os.path.join(_tmp_dir, "users.db")
+os.environ["DB_SUBMISSIONS_PATH"] = os.path.join(_tmp_dir, "submissions.db")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+
+from database.db import Database  # noqa: E402
+
+
+async def save_user_old(db: Database, user) -> bool:
+    """Прежняя реализация save_user: проверка существования + UPDATE/INSERT"""
+    now = datetime.now().isoformat()
+    conn = await db._get_connection()
+    try:
+        cursor = await conn.execute(
+            "SELECT 1 FROM users WHERE user_id = ?",
+            (user.id,)
+        )
+        exists = await cursor.fetchone()
+
+        if exists:
+            await conn.execute(
+                "UPDATE users SET username=?, first_name=?, last_name=?, last_active=? WHERE user_id=?",
+                (user.username, user.first_name, user.last_name, now, user.id)
+            )
+        else:
+            await conn.execute(
+                "INSERT INTO users (user_id, username, first_name, last_name, created_at, last_active) VALUES (?, ?, ?, ?, ?, ?)",
+                (user.id, user.username, user.first_name, user.last_name, now, now)
+            )
+        await conn.commit()
+        return not exists
+    finally:
+        await db._return_connection(conn)
+
+
+async def save_user_new(db: Database, user) -> bool:
+    """Новая реализация: один INSERT ... ON CONFLICT DO UPDATE ... RETURNING"""
+    return await db._upsert_user(user, datetime.now().isoformat())
+
+
+async def measure(func, db: Database, user_ids) -> list:
+    """Задержка каждого вызова в микросекундах"""
+    timings = []
+    for user_id in user_ids:
+        user = SimpleNamespace(id=user_id, username=f"user{user_id}",
+                               first_name="Bench", last_name=None)
+        started = time.perf_counter()
+        await func(db, user)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    return timings
+
+
+def report(name: str, timings: list):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<28} медиана {statistics.median(timings):8.1f} мкс   "
+          f"p95 {p95:8.1f} мкс")
+
+
+async def main(count: int):
+    db = Database()
+    await db.init_db()
+
+    print(f"📏 save_user, {count} вызовов на сценарий (SQLite WAL, {_tmp_dir})\n")
+
+    # Новые пользователи: у каждой реализации свой диапазон ID
+    report("старый: новые", await measure(save_user_old, db, range(1, count + 1)))
+    report("UPSERT: новые", await measure(
+        save_user_new, db, range(count + 1, 2 * count + 1)))
+
+    # Повторные визиты: те же пользователи еще раз
+    report("старый: существующие", await measure(save_user_old, db, range(1, count + 1)))
+    report("UPSERT: существующие", await measure(
+        save_user_new, db, range(count + 1, 2 * count + 1)))
+
+    await db.close_all_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
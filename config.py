@@ -1,7 +1,9 @@
 """
 Telegram Bot v3.2
 """
+import importlib.util
 import os
+import re
 from dotenv import load_dotenv, find_dotenv
 from typing import List, Optional
 from pathlib import Path
@@ -29,6 +31,10 @@ class BotConfig:
     admin_ids: List[int]
     db_users_path: str
     db_submissions_path: str
+    db_banned_path: str = "data/banned.db"
+    # Единый файл для пользователей, обратной связи и блокировок (опционально).
+    # Если задан, все БД работают с ним, а пути выше - источники для миграции
+    db_unified_path: Optional[str] = None
     version: str = BOT_VERSION
     channel_username: Optional[str] = None
     channel_id: Optional[str] = None
@@ -38,7 +44,65 @@ class BotConfig:
     max_files_per_submission: int = 5
     max_submission_length: int = 4000
     polling_timeout: int = 30
+    # Одновременная обработка обновлений: всего обработчиков, ожидающих (0 - без лимита)
+    # и ожидающих от одного пользователя; сверх лимитов обновления сбрасываются
+    update_max_in_flight: int = 50
+    update_max_pending: int = 1000
+    update_max_user_queue: int = 20
+    # Сколько ждать следующий элемент альбома, сек; 0 - обрабатывать элементы по одному
+    media_group_wait: float = 0.5
+    # Получение обновлений: polling или webhook (aiohttp-сервер)
+    bot_mode: str = "polling"
+    webhook_url: Optional[str] = None  # внешний https-адрес, например https://bot.example.com
+    webhook_path: str = "/webhook"
+    webhook_secret: Optional[str] = None  # X-Telegram-Bot-Api-Secret-Token
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    # Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - выключены)
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 9108
+    # Сводка производительности в лог раз в столько секунд (0 - выключена)
+    performance_log_interval: int = 14400
     max_retries: int = 5
+    broadcast_rate_limit: float = 25.0  # сообщений/с (лимит Telegram ~30)
+    broadcast_concurrency: int = 10
+    broadcast_chunk_size: int = 500
+    # Максимальная задержка записи активности пользователей в БД (секунды);
+    # 0 - писать сразу
+    user_activity_flush_interval: float = 5.0
+    # Пул соединений с БД пользователей (в PostgreSQL - общий пул всех хранилищ)
+    db_pool_size: int = 10
+    db_pool_timeout: float = 10.0  # ожидание свободного соединения, сек
+    # Бэкенд хранилищ: sqlite или postgres (DATABASE_URL)
+    db_backend: str = "sqlite"
+    database_url: Optional[str] = None
+    # Сколько пользователей антиспам помнит в памяти процесса (самые давние вытесняются)
+    antispam_max_users: int = 100000
+    # Общее состояние процессов в Redis: FSM, антиспам, кэш блокировок (опционально)
+    redis_url: Optional[str] = None
+    redis_prefix: str = "tgbot"
+    # Хранилище FSM (черновики, пагинация): sqlite - переживает перезапуск, memory - в памяти,
+    # redis - общее для нескольких процессов
+    fsm_storage: str = "sqlite"
+    fsm_db_path: str = "data/fsm.db"
+    fsm_state_ttl_hours: float = 72.0  # брошенные состояния удаляются; 0 - хранить всегда
+    fsm_flush_interval: float = 1.0  # задержка записи в БД, сек; 0 - писать сразу
+    fsm_cache_size: int = 10000
+
+    @property
+    def unified_storage(self) -> bool:
+        """Все данные в одном файле (DB_UNIFIED_PATH)"""
+        return bool(self.db_unified_path)
+
+    @property
+    def webhook_mode(self) -> bool:
+        """Обновления приходят на webhook, а не через polling"""
+        return self.bot_mode == "webhook"
+
+    @property
+    def shared_state(self) -> bool:
+        """Состояние процессов хранится в Redis (REDIS_URL)"""
+        return bool(self.redis_url)
 
     def __post_init__(self):
         if self.admin_ids is None:
@@ -88,9 +152,22 @@ CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME")
 CHANNEL_ID = os.getenv("CHANNEL_ID")  # ID канала (альтернатива username)
 CHANNEL_LINK = os.getenv("CHANNEL_LINK")
 FILES_DIR = os.getenv("FILES_DIR", "files").replace("\\", "/")
-DB_NAME = os.getenv('DB_USERS_PATH')
-DB_SUBMISSIONS_PATH = os.getenv(
+DB_USERS_PATH = os.getenv('DB_USERS_PATH')
+DB_SUBMISSIONS_SOURCE_PATH = os.getenv(
     "DB_SUBMISSIONS_PATH", str(BASE_DIR / 'data' / 'submissions.db'))
+DB_BANNED_SOURCE_PATH = os.getenv("DB_BANNED_PATH", "data/banned.db")
+DB_UNIFIED_PATH = os.getenv("DB_UNIFIED_PATH") or None
+
+# Фактические пути, с которыми работают БД: в едином режиме - один файл
+DB_NAME = DB_UNIFIED_PATH or DB_USERS_PATH
+DB_SUBMISSIONS_PATH = DB_UNIFIED_PATH or DB_SUBMISSIONS_SOURCE_PATH
+DB_BANNED_PATH = DB_UNIFIED_PATH or DB_BANNED_SOURCE_PATH
+
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite").strip().lower()
+DATABASE_URL = os.getenv("DATABASE_URL") or None
+REDIS_URL = os.getenv("REDIS_URL") or None
+# Состояние рассылок всегда в локальном SQLite (рассылку ведет один процесс)
+DB_BROADCASTS_PATH = DB_NAME or str(BASE_DIR / 'data' / 'broadcasts.db')
 
 # Настройки логирования
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -104,11 +181,44 @@ config = BotConfig(
     channel_id=CHANNEL_ID,
     channel_link=CHANNEL_LINK,
     files_dir=FILES_DIR,
-    db_users_path=DB_NAME or "",
-    db_submissions_path=DB_SUBMISSIONS_PATH,
+    db_users_path=DB_USERS_PATH or "",
+    db_submissions_path=DB_SUBMISSIONS_SOURCE_PATH,
+    db_banned_path=DB_BANNED_SOURCE_PATH,
+    db_unified_path=DB_UNIFIED_PATH,
     max_file_size_mb=int(os.getenv("MAX_FILE_SIZE_MB", "50")),
     max_files_per_submission=int(os.getenv("MAX_FILES_PER_SUBMISSION", "5")),
-    max_submission_length=int(os.getenv("MAX_SUBMISSION_LENGTH", "4000"))
+    max_submission_length=int(os.getenv("MAX_SUBMISSION_LENGTH", "4000")),
+    update_max_in_flight=int(os.getenv("UPDATE_MAX_IN_FLIGHT", "50")),
+    update_max_pending=int(os.getenv("UPDATE_MAX_PENDING", "1000")),
+    update_max_user_queue=int(os.getenv("UPDATE_MAX_USER_QUEUE", "20")),
+    media_group_wait=float(os.getenv("MEDIA_GROUP_WAIT", "0.5")),
+    bot_mode=os.getenv("BOT_MODE", "polling").strip().lower(),
+    webhook_url=os.getenv("WEBHOOK_URL") or None,
+    webhook_path=os.getenv("WEBHOOK_PATH", "/webhook"),
+    webhook_secret=os.getenv("WEBHOOK_SECRET") or None,
+    webhook_host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+    webhook_port=int(os.getenv("WEBHOOK_PORT", "8080")),
+    metrics_host=os.getenv("METRICS_HOST", "127.0.0.1"),
+    metrics_port=int(os.getenv("METRICS_PORT", "9108")),
+    performance_log_interval=int(os.getenv("PERFORMANCE_LOG_INTERVAL", "14400")),
+    broadcast_rate_limit=float(os.getenv("BROADCAST_RATE_LIMIT", "25")),
+    broadcast_concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "10")),
+    broadcast_chunk_size=int(os.getenv("BROADCAST_CHUNK_SIZE", "500")),
+    user_activity_flush_interval=float(
+        os.getenv("USER_ACTIVITY_FLUSH_INTERVAL", "5")),
+    db_pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    db_pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    db_backend=DB_BACKEND,
+    database_url=DATABASE_URL,
+    antispam_max_users=int(os.getenv("ANTISPAM_MAX_USERS", "100000")),
+    redis_url=REDIS_URL,
+    redis_prefix=os.getenv("REDIS_PREFIX", "tgbot"),
+    fsm_storage=os.getenv(
+        "FSM_STORAGE", "redis" if REDIS_URL else "sqlite").strip().lower(),
+    fsm_db_path=os.getenv("FSM_DB_PATH", str(BASE_DIR / 'data' / 'fsm.db')),
+    fsm_state_ttl_hours=float(os.getenv("FSM_STATE_TTL_HOURS", "72")),
+    fsm_flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", "1")),
+    fsm_cache_size=int(os.getenv("FSM_CACHE_SIZE", "10000"))
 )
 
 # Валидация конфигурации
@@ -121,11 +231,46 @@ if not config.admin_ids:
 if not config.channel_username or not config.channel_link:
     print("Внимание: канал не настроен (CHANNEL_USERNAME/CHANNEL_LINK)")
 
-if not config.db_users_path:
+if config.bot_mode not in ("polling", "webhook"):
+    raise ValueError(f'Неизвестный BOT_MODE: {config.bot_mode} (polling или webhook)')
+
+if config.webhook_mode:
+    if not config.webhook_url:
+        raise ValueError('Для BOT_MODE=webhook укажите WEBHOOK_URL в .env')
+    # Telegram допускает 1-256 символов A-Z, a-z, 0-9, _ и -
+    if not config.webhook_secret or not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', config.webhook_secret):
+        raise ValueError('Для BOT_MODE=webhook укажите WEBHOOK_SECRET (1-256 символов A-Z, a-z, 0-9, _, -)')
+    if not config.webhook_path.startswith('/'):
+        config.webhook_path = '/' + config.webhook_path
+
+if config.db_backend not in ("sqlite", "postgres"):
+    raise ValueError(f'Неизвестный DB_BACKEND: {config.db_backend} (sqlite или postgres)')
+
+if config.db_backend == "postgres" and not config.database_url:
+    raise ValueError('Для DB_BACKEND=postgres укажите DATABASE_URL в .env')
+
+if config.fsm_storage not in ("sqlite", "memory", "redis"):
+    raise ValueError(f'Неизвестный FSM_STORAGE: {config.fsm_storage} (sqlite, memory или redis)')
+
+if config.fsm_storage == "redis" and not config.shared_state:
+    raise ValueError('Для FSM_STORAGE=redis укажите REDIS_URL в .env')
+
+if config.shared_state:
+    # Клиент импортируется лениво - проверяем при старте, а не при первом сообщении
+    redis_package = "fakeredis" if config.redis_url.startswith("fakeredis://") else "redis"
+    if importlib.util.find_spec(redis_package) is None:
+        raise ValueError(f'Для REDIS_URL установите {redis_package}: pip install {redis_package}')
+
+if config.db_backend == "sqlite" and not config.db_users_path and not config.unified_storage:
     raise ValueError('Отсутствует DB_USERS_PATH в .env')
 
 # Создаем папку для файлов если не существует
 os.makedirs(config.files_dir, exist_ok=True)
-os.makedirs(os.path.dirname(config.db_submissions_path), exist_ok=True)
+os.makedirs(os.path.dirname(DB_SUBMISSIONS_PATH) or ".", exist_ok=True)
 
-print("Путь к submissions.db:", config.db_submissions_path)
+if config.db_backend == "postgres":
+    print("Хранилище: PostgreSQL")
+elif config.unified_storage:
+    print("Единая БД:", DB_UNIFIED_PATH)
+else:
+    print("Путь к submissions.db:", DB_SUBMISSIONS_PATH)
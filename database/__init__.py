@@ -1,7 +1,17 @@
 from .db import Database
+from .storage import (
+    UserStorage, SubmissionStorage, BanStorage,
+    get_user_storage, get_submission_storage, get_ban_storage
+)
 
 __all__ = [
-    'Database'
+    'Database',
+    'UserStorage',
+    'SubmissionStorage',
+    'BanStorage',
+    'get_user_storage',
+    'get_submission_storage',
+    'get_ban_storage'
 ]
 
 # Инициализация подключения к БД (опционально)
@@ -2,151 +2,445 @@
 БД для управления заблокированными пользователями
 Система прогрессивных блокировок: 24ч -> 7 дней -> навсегда
 """
-import sqlite3
-import asyncio
+import aiosqlite
+import heapq
+import json
 import logging
+import time
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from pathlib import Path
+from dataclasses import dataclass, asdict
+from config import config, DB_BANNED_PATH
+from database.storage import BanStorage
 
 logger = logging.getLogger(__name__)
 
 
-class BannedDB:
-    """База данных заблокированных пользователей"""
-
-    def __init__(self, db_path: str = "data/banned.db"):
-        self.db_path = Path(db_path)
-        self.db_path.parent.mkdir(exist_ok=True)
-        self._init_db()
-
-    def _init_db(self):
-        """Инициализация БД"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS banned_users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    banned_by INTEGER,
-                    reason TEXT,
-                    expires_at TIMESTAMP NULL,
-                    is_permanent BOOLEAN DEFAULT FALSE,
-                    ban_count INTEGER DEFAULT 1,
-                    last_ban_reason TEXT
-                )
-            """)
-            conn.commit()
-
-    async def is_banned(self, user_id: int) -> bool:
-        """Проверка, заблокирован ли пользователь"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute(
-                    "SELECT expires_at, is_permanent FROM banned_users WHERE user_id = ?",
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-
-                if not result:
-                    return False
-
-                expires_at, is_permanent = result
-
-                # Если постоянная блокировка
-                if is_permanent:
-                    return True
-
-                # Если временная блокировка истекла
-                if expires_at:
-                    expires = datetime.fromisoformat(expires_at)
-                    if datetime.now() > expires:
-                        # Удаляем истекшую блокировку
-                        conn.execute(
-                            "DELETE FROM banned_users WHERE user_id = ?", (user_id,))
-                        conn.commit()
-                        return False
-
-                return True
-        except Exception as e:
-            logger.error(f"Ошибка проверки блокировки: {e}")
-            return False
+@dataclass(frozen=True)
+class BanStatus:
+    """Компактная запись о действующей блокировке"""
+    user_id: int
+    is_permanent: bool
+    expires_at: Optional[str]
+    ban_count: int
+    reason: Optional[str]
+    username: Optional[str] = None
+    banned_at: Optional[str] = None
+    banned_by: Optional[int] = None
+    last_ban_reason: Optional[str] = None
+
+    @classmethod
+    def from_info(cls, info: Dict[str, Any]) -> 'BanStatus':
+        return cls(
+            user_id=info['user_id'],
+            is_permanent=bool(info['is_permanent']),
+            expires_at=info['expires_at'],
+            ban_count=info['ban_count'],
+            reason=info['reason'],
+            username=info['username'],
+            banned_at=info['banned_at'],
+            banned_by=info['banned_by'],
+            last_ban_reason=info['last_ban_reason']
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Формат get_ban_info (без user_id)"""
+        info = asdict(self)
+        info.pop('user_id')
+        return info
+
+
+class BanCache:
+    """
+    In-memory индекс активных блокировок.
+
+    Хранит полную информацию о блокировке по user_id и min-heap по expires_at,
+    чтобы снимать истекшие временные блокировки без обращения к БД.
+    """
+
+    def __init__(self):
+        self._bans: Dict[int, Dict[str, Any]] = {}
+        self._expiry_heap: List[Tuple[str, int]] = []
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._bans)
+
+    async def load(self, bans: List[Dict[str, Any]]):
+        """Полностью заменяет содержимое индекса"""
+        self._bans.clear()
+        self._expiry_heap.clear()
+        for info in bans:
+            await self.put(info['user_id'], info)
+        self.loaded = True
+
+    async def put(self, user_id: int, info: Dict[str, Any]):
+        """Добавляет или обновляет блокировку"""
+        self._bans[user_id] = info
+        if info.get('expires_at') and not info.get('is_permanent'):
+            heapq.heappush(self._expiry_heap, (info['expires_at'], user_id))
+
+    async def remove(self, user_id: int) -> bool:
+        """Удаляет блокировку (запись в heap становится устаревшей и пропускается)"""
+        return self._bans.pop(user_id, None) is not None
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Возвращает информацию о блокировке или None"""
+        info = self._bans.get(user_id)
+        self._count(info)
+        return info
+
+    def _count(self, info: Optional[Dict[str, Any]]):
+        """hits - блокировка найдена в индексе, misses - нет"""
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    async def pop_expired(self, now: Optional[datetime] = None) -> List[Tuple[int, str]]:
+        """Снимает истекшие блокировки, возвращает [(user_id, expires_at)]"""
+        now_iso = (now or datetime.now()).isoformat()
+        expired = []
+        while self._expiry_heap and self._expiry_heap[0][0] < now_iso:
+            expires_at, user_id = heapq.heappop(self._expiry_heap)
+            info = self._bans.get(user_id)
+            # Пропускаем устаревшие записи heap (разбан или повторный бан)
+            if info is None or info.get('expires_at') != expires_at or info.get('is_permanent'):
+                continue
+            del self._bans[user_id]
+            expired.append((user_id, expires_at))
+        return expired
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики для PerformanceMonitor"""
+        return {'size': len(self._bans), 'hits': self.hits, 'misses': self.misses}
+
+
+class RedisBanCache(BanCache):
+    """
+    Индекс активных блокировок в Redis, общий для всех процессов бота:
+    хэш user_id -> JSON и sorted set по времени истечения
+    """
+
+    # Как часто снимать истекшие блокировки, сек (get сам не отдает истекшие)
+    EXPIRE_CHECK_INTERVAL = 30.0
+
+    def __init__(self):
+        super().__init__()
+        from database.shared_state import get_redis, redis_key
+        self.redis = get_redis()
+        self._key = redis_key('bans')
+        self._expiry_key = redis_key('bans', 'expiry')
+        self._size = 0
+        self._last_expire_check = 0.0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _queue_put(self, pipe, user_id: int, info: Dict[str, Any]):
+        pipe.hset(self._key, str(user_id), json.dumps(info))
+        if info.get('expires_at') and not info.get('is_permanent'):
+            expires = datetime.fromisoformat(info['expires_at']).timestamp()
+            pipe.zadd(self._expiry_key, {str(user_id): expires})
+        else:
+            pipe.zrem(self._expiry_key, str(user_id))
+
+    async def load(self, bans: List[Dict[str, Any]]):
+        """
+        Дополняет общий индекс блокировками из локальной БД. Существующие записи
+        не трогаются: их могли записать другие процессы позже, чем эта БД.
+        Лишняя запись sorted set безвредна - pop_expired сверяет срок по хэшу
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for info in bans:
+                user_id = str(info['user_id'])
+                pipe.hsetnx(self._key, user_id, json.dumps(info))
+                if info.get('expires_at') and not info.get('is_permanent'):
+                    expires = datetime.fromisoformat(info['expires_at']).timestamp()
+                    pipe.zadd(self._expiry_key, {user_id: expires}, nx=True)
+            pipe.hlen(self._key)
+            results = await pipe.execute()
+        self._size = results[-1]
+        self.loaded = True
+
+    async def put(self, user_id: int, info: Dict[str, Any]):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue_put(pipe, user_id, info)
+            pipe.hlen(self._key)
+            results = await pipe.execute()
+        self._size = results[-1]
+
+    async def remove(self, user_id: int) -> bool:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(self._key, str(user_id))
+            pipe.zrem(self._expiry_key, str(user_id))
+            pipe.hlen(self._key)
+            results = await pipe.execute()
+        self._size = results[-1]
+        return results[0] > 0
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        raw = await self.redis.hget(self._key, str(user_id))
+        info = json.loads(raw) if raw is not None else None
+        # Истекшую блокировку снимет pop_expired
+        if info and info.get('expires_at') and not info.get('is_permanent') \
+                and info['expires_at'] < datetime.now().isoformat():
+            info = None
+        self._count(info)
+        return info
+
+    async def pop_expired(self, now: Optional[datetime] = None) -> List[Tuple[int, str]]:
+        if now is None:
+            if time.monotonic() - self._last_expire_check < self.EXPIRE_CHECK_INTERVAL:
+                return []
+            self._last_expire_check = time.monotonic()
+        now = now or datetime.now()
+        user_ids = await self.redis.zrangebyscore(self._expiry_key, '-inf', now.timestamp())
+        if not user_ids:
+            return []
 
-    async def get_ban_info(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Получение информации о блокировке"""
+        now_iso = now.isoformat()
+        expired = []
+        for user_id, raw in zip(user_ids, await self.redis.hmget(self._key, user_ids)):
+            info = json.loads(raw) if raw else None
+            if info and info.get('expires_at') and not info.get('is_permanent') \
+                    and info['expires_at'] < now_iso:
+                expired.append((int(user_id), info['expires_at']))
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if expired:
+                pipe.hdel(self._key, *(str(user_id) for user_id, _ in expired))
+            # По score, а не по списку: повторный бан за это время уже сдвинул срок
+            pipe.zremrangebyscore(self._expiry_key, '-inf', now.timestamp())
+            pipe.hlen(self._key)
+            results = await pipe.execute()
+        self._size = results[-1]
+        return expired
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': self._size, 'hits': self.hits, 'misses': self.misses}
+
+
+class BannedDB(BanStorage):
+    """Блокировки в SQLite с in-memory индексом активных блокировок"""
+    _instance = None  # Классовый атрибут для Singleton
+
+    def __new__(cls, db_path: str = DB_BANNED_PATH):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, db_path: str = DB_BANNED_PATH):
+        if not hasattr(self, 'initialized'):
+            self.db_path = Path(db_path)
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection: Optional[aiosqlite.Connection] = None
+            # При REDIS_URL индекс общий для всех процессов бота
+            self.cache = RedisBanCache() if config.shared_state else BanCache()
+            self.initialized = True
+
+    async def init(self):
+        """Открывает постоянное соединение с БД и создает таблицы"""
+        if self.connection is None:
+            self.connection = await aiosqlite.connect(
+                str(self.db_path),
+                timeout=30.0,
+                check_same_thread=False
+            )
+
+            # Те же оптимизации, что и в Database._get_connection
+            await self.connection.execute("PRAGMA journal_mode=WAL")
+            await self.connection.execute("PRAGMA synchronous=NORMAL")
+            await self.connection.execute("PRAGMA cache_size=10000")
+            await self.connection.execute("PRAGMA temp_store=MEMORY")
+            # 256MB
+            await self.connection.execute("PRAGMA mmap_size=268435456")
+            await self.connection.execute("PRAGMA optimize")
+
+            await self._create_tables()
+            await self._load_cache()
+
+    async def _create_tables(self):
+        """Создает таблицу блокировок"""
+        if self.connection is None:
+            raise RuntimeError("Соединение с БД не инициализировано")
+
+        await self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS banned_users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                banned_by INTEGER,
+                reason TEXT,
+                expires_at TIMESTAMP NULL,
+                is_permanent BOOLEAN DEFAULT FALSE,
+                ban_count INTEGER DEFAULT 1,
+                last_ban_reason TEXT
+            )
+        """)
+        await self.connection.commit()
+
+    async def _load_cache(self):
+        """Загружает все активные блокировки в in-memory индекс"""
+        if self.connection is None:
+            raise RuntimeError("Соединение с БД не инициализировано")
+
+        await self.connection.execute("""
+            DELETE FROM banned_users 
+            WHERE expires_at IS NOT NULL 
+            AND expires_at < ? 
+            AND is_permanent = FALSE
+        """, (datetime.now().isoformat(),))
+        await self.connection.commit()
+
+        async with self.connection.execute("""
+            SELECT user_id, username, banned_at, banned_by, reason, expires_at,
+                   is_permanent, ban_count, last_ban_reason
+            FROM banned_users
+        """) as cursor:
+            rows = await cursor.fetchall()
+
+        await self.cache.load([self._row_to_info(row) for row in rows])
+        logger.info(f"🚫 Загружено блокировок в кэш: {len(self.cache)}")
+
+    @staticmethod
+    def _row_to_info(row) -> Dict[str, Any]:
+        return {
+            'user_id': row[0],
+            'username': row[1],
+            'banned_at': row[2],
+            'banned_by': row[3],
+            'reason': row[4],
+            'expires_at': row[5],
+            'is_permanent': row[6],
+            'ban_count': row[7],
+            'last_ban_reason': row[8]
+        }
+
+    async def _expire_cached_bans(self):
+        """Снимает истекшие блокировки из кэша и удаляет их из БД"""
+        expired = await self.cache.pop_expired()
+        if not expired or self.connection is None:
+            return
+        await self.connection.executemany(
+            "DELETE FROM banned_users WHERE user_id = ? AND expires_at = ?",
+            expired
+        )
+        await self.connection.commit()
+
+    async def _get_connection(self) -> aiosqlite.Connection:
+        """Возвращает открытое соединение, при необходимости инициализируя его"""
+        if self.connection is None:
+            await self.init()
+        if self.connection is None:
+            raise RuntimeError("Соединение с БД не инициализировано")
+        return self.connection
+
+    async def lookup(self, user_id: int) -> Optional['BanStatus']:
+        """
+        Единая проверка блокировки одним индексированным чтением.
+        Возвращает BanStatus или None, истекшая блокировка при этом удаляется.
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    SELECT username, banned_at, banned_by, reason, expires_at, 
-                           is_permanent, ban_count, last_ban_reason
-                    FROM banned_users WHERE user_id = ?
-                """, (user_id,))
-                result = cursor.fetchone()
-
-                if not result:
+            if self.cache.loaded:
+                await self._expire_cached_bans()
+                info = await self.cache.get(user_id)
+                return BanStatus.from_info(info) if info else None
+
+            # Индекс еще не загружен: чтение из БД считается промахом
+            self.cache.misses += 1
+            conn = await self._get_connection()
+            async with conn.execute("""
+                SELECT user_id, username, banned_at, banned_by, reason, expires_at,
+                       is_permanent, ban_count, last_ban_reason
+                FROM banned_users WHERE user_id = ?
+            """, (user_id,)) as cursor:
+                row = await cursor.fetchone()
+
+            if not row:
+                return None
+
+            info = self._row_to_info(row)
+
+            # Если временная блокировка истекла
+            if info['expires_at'] and not info['is_permanent']:
+                expires = datetime.fromisoformat(info['expires_at'])
+                if datetime.now() > expires:
+                    # Удаляем истекшую блокировку
+                    await conn.execute(
+                        "DELETE FROM banned_users WHERE user_id = ?", (user_id,))
+                    await conn.commit()
+                    await self.cache.remove(user_id)
                     return None
 
-                return {
-                    'username': result[0],
-                    'banned_at': result[1],
-                    'banned_by': result[2],
-                    'reason': result[3],
-                    'expires_at': result[4],
-                    'is_permanent': result[5],
-                    'ban_count': result[6],
-                    'last_ban_reason': result[7]
-                }
+            return BanStatus.from_info(info)
         except Exception as e:
-            logger.error(f"Ошибка получения информации о блокировке: {e}")
+            logger.error(f"Ошибка проверки блокировки: {e}")
             return None
 
     async def ban_user(self, user_id: int, username: str, reason: str,
                        banned_by: int, duration_hours: int = 24) -> Dict[str, Any]:
         """Блокировка пользователя с прогрессивной системой"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # Проверяем существующую блокировку
-                cursor = conn.execute(
-                    "SELECT ban_count FROM banned_users WHERE user_id = ?",
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-
-                ban_count = 1
-                is_permanent = False
-                expires_at = None
-
-                if result:
-                    ban_count = result[0] + 1
-
-                    # Прогрессивная система блокировок
-                    if ban_count == 2:  # Вторая блокировка - 7 дней
-                        duration_hours = 24 * 7
-                    elif ban_count >= 3:  # Третья и далее - навсегда
-                        is_permanent = True
-
-                # Вычисляем время истечения
-                if not is_permanent:
-                    expires_at = (datetime.now() +
-                                  timedelta(hours=duration_hours)).isoformat()
-
-                # Обновляем или вставляем запись
-                conn.execute("""
-                    INSERT OR REPLACE INTO banned_users 
-                    (user_id, username, banned_at, banned_by, reason, expires_at, 
-                     is_permanent, ban_count, last_ban_reason)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (user_id, username, datetime.now().isoformat(), banned_by,
-                      reason, expires_at, is_permanent, ban_count, reason))
-
-                conn.commit()
-
-                return {
-                    'ban_count': ban_count,
-                    'is_permanent': is_permanent,
-                    'expires_at': expires_at,
-                    'duration_hours': duration_hours
-                }
+            conn = await self._get_connection()
+            # Проверяем существующую блокировку
+            async with conn.execute(
+                "SELECT ban_count FROM banned_users WHERE user_id = ?",
+                (user_id,)
+            ) as cursor:
+                result = await cursor.fetchone()
+
+            ban_count = 1
+            is_permanent = False
+            expires_at = None
+
+            if result:
+                ban_count = result[0] + 1
+
+                # Прогрессивная система блокировок
+                if ban_count == 2:  # Вторая блокировка - 7 дней
+                    duration_hours = 24 * 7
+                elif ban_count >= 3:  # Третья и далее - навсегда
+                    is_permanent = True
+
+            # Вычисляем время истечения
+            if not is_permanent:
+                expires_at = (datetime.now() +
+                              timedelta(hours=duration_hours)).isoformat()
+
+            # Обновляем или вставляем запись
+            banned_at = datetime.now().isoformat()
+            await conn.execute("""
+                INSERT OR REPLACE INTO banned_users 
+                (user_id, username, banned_at, banned_by, reason, expires_at, 
+                 is_permanent, ban_count, last_ban_reason)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, username, banned_at, banned_by,
+                  reason, expires_at, is_permanent, ban_count, reason))
+
+            await conn.commit()
+
+            await self.cache.put(user_id, {
+                'user_id': user_id,
+                'username': username,
+                'banned_at': banned_at,
+                'banned_by': banned_by,
+                'reason': reason,
+                'expires_at': expires_at,
+                'is_permanent': is_permanent,
+                'ban_count': ban_count,
+                'last_ban_reason': reason
+            })
+
+            return {
+                'ban_count': ban_count,
+                'is_permanent': is_permanent,
+                'expires_at': expires_at,
+                'duration_hours': duration_hours
+            }
 
         except Exception as e:
             logger.error(f"Ошибка блокировки пользователя: {e}")
@@ -155,11 +449,12 @@ class BannedDB:
     async def unban_user(self, user_id: int) -> bool:
         """Разблокировка пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute(
-                    "DELETE FROM banned_users WHERE user_id = ?", (user_id,))
-                conn.commit()
-                return cursor.rowcount > 0
+            conn = await self._get_connection()
+            cursor = await conn.execute(
+                "DELETE FROM banned_users WHERE user_id = ?", (user_id,))
+            await conn.commit()
+            await self.cache.remove(user_id)
+            return cursor.rowcount > 0
         except Exception as e:
             logger.error(f"Ошибка разблокировки пользователя: {e}")
             return False
@@ -167,27 +462,28 @@ class BannedDB:
     async def get_banned_list(self) -> List[Dict[str, Any]]:
         """Получение списка всех заблокированных пользователей"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    SELECT user_id, username, banned_at, reason, expires_at, 
-                           is_permanent, ban_count
-                    FROM banned_users 
-                    ORDER BY banned_at DESC
-                """)
-
-                results = []
-                for row in cursor.fetchall():
-                    results.append({
-                        'user_id': row[0],
-                        'username': row[1],
-                        'banned_at': row[2],
-                        'reason': row[3],
-                        'expires_at': row[4],
-                        'is_permanent': row[5],
-                        'ban_count': row[6]
-                    })
-
-                return results
+            conn = await self._get_connection()
+            async with conn.execute("""
+                SELECT user_id, username, banned_at, reason, expires_at, 
+                       is_permanent, ban_count
+                FROM banned_users 
+                ORDER BY banned_at DESC
+            """) as cursor:
+                rows = await cursor.fetchall()
+
+            results = []
+            for row in rows:
+                results.append({
+                    'user_id': row[0],
+                    'username': row[1],
+                    'banned_at': row[2],
+                    'reason': row[3],
+                    'expires_at': row[4],
+                    'is_permanent': row[5],
+                    'ban_count': row[6]
+                })
+
+            return results
         except Exception as e:
             logger.error(f"Ошибка получения списка заблокированных: {e}")
             return []
@@ -195,17 +491,18 @@ class BannedDB:
     async def cleanup_expired_bans(self) -> int:
         """Очистка истекших блокировок"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    DELETE FROM banned_users 
-                    WHERE expires_at IS NOT NULL 
-                    AND expires_at < ? 
-                    AND is_permanent = FALSE
-                """, (datetime.now().isoformat(),))
-
-                deleted_count = cursor.rowcount
-                conn.commit()
-                return deleted_count
+            conn = await self._get_connection()
+            cursor = await conn.execute("""
+                DELETE FROM banned_users 
+                WHERE expires_at IS NOT NULL 
+                AND expires_at < ? 
+                AND is_permanent = FALSE
+            """, (datetime.now().isoformat(),))
+
+            deleted_count = cursor.rowcount
+            await conn.commit()
+            await self.cache.pop_expired()
+            return deleted_count
         except Exception as e:
             logger.error(f"Ошибка очистки истекших блокировок: {e}")
             return 0
@@ -213,38 +510,50 @@ class BannedDB:
     async def get_ban_stats(self) -> Dict[str, Any]:
         """Статистика блокировок"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # Общее количество заблокированных
-                total = conn.execute(
-                    "SELECT COUNT(*) FROM banned_users").fetchone()[0]
-
-                # Постоянные блокировки
-                permanent = conn.execute(
-                    "SELECT COUNT(*) FROM banned_users WHERE is_permanent = TRUE"
-                ).fetchone()[0]
-
-                # Временные блокировки
-                temporary = conn.execute(
-                    "SELECT COUNT(*) FROM banned_users WHERE is_permanent = FALSE"
-                ).fetchone()[0]
-
-                # Заблокированные сегодня
-                today = datetime.now().date().isoformat()
-                today_bans = conn.execute(
-                    "SELECT COUNT(*) FROM banned_users WHERE DATE(banned_at) = ?",
-                    (today,)
-                ).fetchone()[0]
-
-                return {
-                    'total': total,
-                    'permanent': permanent,
-                    'temporary': temporary,
-                    'today': today_bans
-                }
+            conn = await self._get_connection()
+
+            async def count(query: str, params: tuple = ()) -> int:
+                async with conn.execute(query, params) as cursor:
+                    row = await cursor.fetchone()
+                return row[0] if row else 0
+
+            # Общее количество заблокированных
+            total = await count("SELECT COUNT(*) FROM banned_users")
+
+            # Постоянные блокировки
+            permanent = await count(
+                "SELECT COUNT(*) FROM banned_users WHERE is_permanent = TRUE")
+
+            # Временные блокировки
+            temporary = await count(
+                "SELECT COUNT(*) FROM banned_users WHERE is_permanent = FALSE")
+
+            # Заблокированные сегодня
+            today = datetime.now().date().isoformat()
+            today_bans = await count(
+                "SELECT COUNT(*) FROM banned_users WHERE DATE(banned_at) = ?",
+                (today,)
+            )
+
+            return {
+                'total': total,
+                'permanent': permanent,
+                'temporary': temporary,
+                'today': today_bans
+            }
         except Exception as e:
             logger.error(f"Ошибка получения статистики блокировок: {e}")
             return {'total': 0, 'permanent': 0, 'temporary': 0, 'today': 0}
 
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Статистика in-memory кэша блокировок"""
+        return self.cache.stats()
+
     async def close(self):
         """Закрытие соединения с БД"""
-        pass  # SQLite автоматически закрывает соединения
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+            # Тот же тип индекса, что и в __init__: при REDIS_URL - общий
+            self.cache = RedisBanCache() if config.shared_state else BanCache()
+            logger.info("🔌 Соединение с БД блокировок закрыто")
@@ -0,0 +1,226 @@
+"""
+БД фоновых рассылок: задания и доставки по пользователям
+Позволяет продолжить рассылку после перезапуска без повторной отправки
+"""
+import aiosqlite
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+from config import DB_BROADCASTS_PATH
+from metrics import instrument_storage
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastDB:
+    """Хранилище заданий рассылки (в файле БД пользователей; при PostgreSQL - в отдельном SQLite)"""
+    _instance = None  # Классовый атрибут для Singleton
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            self.db_path = Path(DB_BROADCASTS_PATH)
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection: Optional[aiosqlite.Connection] = None
+            self.initialized = True
+
+    async def init(self):
+        """Инициализирует соединение с БД"""
+        if self.connection is None:
+            self.connection = await aiosqlite.connect(
+                str(self.db_path),
+                timeout=30.0,
+                check_same_thread=False
+            )
+
+            await self.connection.execute("PRAGMA journal_mode=WAL")
+            await self.connection.execute("PRAGMA synchronous=NORMAL")
+            await self.connection.execute("PRAGMA cache_size=10000")
+            await self.connection.execute("PRAGMA temp_store=MEMORY")
+            # 256MB
+            await self.connection.execute("PRAGMA mmap_size=268435456")
+
+            await self._create_tables()
+
+    async def _create_tables(self):
+        """Создает таблицы заданий и доставок"""
+        if self.connection is None:
+            raise RuntimeError("Соединение с БД не инициализировано")
+
+        await self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_by INTEGER,
+                payload TEXT NOT NULL, -- json
+                exclude_ids TEXT DEFAULT '[]', -- json array
+                status TEXT DEFAULT 'running', -- running/done/cancelled
+                last_user_id INTEGER DEFAULT 0, -- все ID <= last_user_id уже заняты
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                finished_at TEXT
+            )
+        ''')
+        await self.connection.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)')
+
+        await self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending', -- pending/sent/failed/unknown
+                error TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (job_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+
+        await self.connection.commit()
+
+    def _conn(self) -> aiosqlite.Connection:
+        if self.connection is None:
+            raise RuntimeError("Соединение с БД не инициализировано")
+        return self.connection
+
+    async def create_job(self, payload: Dict[str, Any], created_by: int,
+                         exclude_ids: Optional[Iterable[int]] = None,
+                         status_chat_id: Optional[int] = None,
+                         status_message_id: Optional[int] = None) -> int:
+        """Создает задание рассылки и возвращает его id"""
+        conn = self._conn()
+        cursor = await conn.execute(
+            '''INSERT INTO broadcast_jobs
+            (created_by, payload, exclude_ids, status_chat_id, status_message_id)
+            VALUES (?, ?, ?, ?, ?)''',
+            (created_by, json.dumps(payload), json.dumps(list(exclude_ids or [])),
+             status_chat_id, status_message_id)
+        )
+        await conn.commit()
+        if cursor.lastrowid is None:
+            raise RuntimeError("Не удалось создать задание рассылки")
+        return cursor.lastrowid
+
+    async def get_unfinished_jobs(self) -> List[Dict[str, Any]]:
+        """Задания, прерванные остановкой бота"""
+        conn = self._conn()
+        async with conn.execute(
+            '''SELECT id, created_by, payload, exclude_ids, last_user_id, sent_count,
+                      failed_count, status_chat_id, status_message_id
+            FROM broadcast_jobs WHERE status = 'running' ORDER BY id'''
+        ) as cursor:
+            rows = await cursor.fetchall()
+
+        return [{
+            'id': row[0],
+            'created_by': row[1],
+            'payload': json.loads(row[2]),
+            'exclude_ids': json.loads(row[3] or '[]'),
+            'last_user_id': row[4],
+            'sent_count': row[5],
+            'failed_count': row[6],
+            'status_chat_id': row[7],
+            'status_message_id': row[8]
+        } for row in rows]
+
+    async def claim_recipients(self, job_id: int, user_ids: List[int]) -> List[int]:
+        """
+        Занимает получателей перед отправкой одной транзакцией и сдвигает курсор.
+        Возвращает только тех, кому задание еще не отправлялось.
+        """
+        if not user_ids:
+            return []
+        conn = self._conn()
+        placeholders = ','.join(['?' for _ in user_ids])
+        async with conn.execute(
+            f'SELECT user_id FROM broadcast_deliveries WHERE job_id = ? AND user_id IN ({placeholders})',
+            [job_id] + user_ids
+        ) as cursor:
+            already = {row[0] for row in await cursor.fetchall()}
+
+        claimed = [user_id for user_id in user_ids if user_id not in already]
+        await conn.executemany(
+            "INSERT INTO broadcast_deliveries (job_id, user_id, status) VALUES (?, ?, 'pending')",
+            [(job_id, user_id) for user_id in claimed]
+        )
+        await conn.execute(
+            'UPDATE broadcast_jobs SET last_user_id = MAX(last_user_id, ?) WHERE id = ?',
+            (user_ids[-1], job_id)
+        )
+        await conn.commit()
+        return claimed
+
+    async def record_results(self, job_id: int, results: List[Tuple[int, str, Optional[str]]]):
+        """Пакетно сохраняет результаты доставки [(user_id, status, error)]"""
+        if not results:
+            return
+        conn = self._conn()
+        now = datetime.now().isoformat()
+        await conn.executemany(
+            '''UPDATE broadcast_deliveries SET status = ?, error = ?, updated_at = ?
+            WHERE job_id = ? AND user_id = ?''',
+            [(status, error, now, job_id, user_id)
+             for user_id, status, error in results]
+        )
+        sent = sum(1 for _, status, _ in results if status == 'sent')
+        await conn.execute(
+            '''UPDATE broadcast_jobs SET sent_count = sent_count + ?, failed_count = failed_count + ?
+            WHERE id = ?''',
+            (sent, len(results) - sent, job_id)
+        )
+        await conn.commit()
+
+    async def release_claims(self, job_id: int, user_ids: List[int]):
+        """Освобождает занятых, но не обработанных получателей (при остановке)"""
+        if not user_ids:
+            return
+        conn = self._conn()
+        await conn.executemany(
+            "DELETE FROM broadcast_deliveries WHERE job_id = ? AND user_id = ? AND status = 'pending'",
+            [(job_id, user_id) for user_id in user_ids]
+        )
+        # Возвращаем курсор, чтобы освобожденные ID были обработаны при возобновлении
+        await conn.execute(
+            'UPDATE broadcast_jobs SET last_user_id = MIN(last_user_id, ?) WHERE id = ?',
+            (min(user_ids) - 1, job_id)
+        )
+        await conn.commit()
+
+    async def mark_stale_pending(self, job_id: int) -> int:
+        """
+        Помечает доставки, прерванные аварийной остановкой, как 'unknown'.
+        Повторно им не отправляем, чтобы не было дублей.
+        """
+        conn = self._conn()
+        cursor = await conn.execute(
+            '''UPDATE broadcast_deliveries SET status = 'unknown', updated_at = ?
+            WHERE job_id = ? AND status = 'pending' ''',
+            (datetime.now().isoformat(), job_id)
+        )
+        await conn.commit()
+        return cursor.rowcount
+
+    async def finish_job(self, job_id: int, status: str = 'done'):
+        """Завершает задание"""
+        conn = self._conn()
+        await conn.execute(
+            'UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?',
+            (status, datetime.now().isoformat(), job_id)
+        )
+        await conn.commit()
+
+    async def close(self):
+        """Закрывает соединение с БД"""
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+            logger.info("🔌 Соединение с БД рассылок закрыто")
+
+
+instrument_storage(BroadcastDB, 'broadcasts')
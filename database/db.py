@@ -1,12 +1,165 @@
 import os
 import aiosqlite
 from datetime import datetime
-from config import DB_NAME
+from config import DB_NAME, config
 import asyncio
-from typing import Optional
+import logging
+import time
+from typing import Any, Dict, Optional, List, Tuple, Iterable
+from database.storage import UserStorage
 
+logger = logging.getLogger(__name__)
+
+# Лимит переменных в одном SQLite запросе (SQLITE_MAX_VARIABLE_NUMBER)
+SQLITE_MAX_VARIABLES = 900
+
+# Запись буфера активности: новые пользователи вставляются, существующие обновляются
+UPSERT_USERS_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, created_at, last_active,
+                       delivery_status, delivery_failed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        last_active = excluded.last_active,
+        delivery_status = excluded.delivery_status,
+        delivery_failed_at = excluded.delivery_failed_at
+"""
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений aiosqlite с таймаутом ожидания и метриками"""
+
+    def __init__(self, db_path: str, max_size: int = 10, acquire_timeout: float = 10.0,
+                 read_only: bool = False):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.read_only = read_only
+        self._semaphore = asyncio.Semaphore(max_size)
+        self._idle: List[aiosqlite.Connection] = []
+        self._closed = False
+        # Метрики
+        self.in_use = 0
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        """Новое соединение; PRAGMA выполняются один раз на соединение"""
+        conn = await aiosqlite.connect(
+            self.db_path,
+            timeout=30.0,  # Увеличиваем timeout
+            check_same_thread=False
+        )
+
+        # Включаем WAL режим для лучшей производительности
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute("PRAGMA cache_size=10000")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        await conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+        if self.read_only:
+            # Соединения для чтения не должны случайно что-то записать
+            await conn.execute("PRAGMA query_only=ON")
+
+        self.created += 1
+        return conn
+
+    async def acquire(self) -> aiosqlite.Connection:
+        """Берет соединение из пула, ожидая не дольше acquire_timeout"""
+        if self._closed:
+            raise RuntimeError("Пул соединений с БД закрыт")
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.error(
+                f"⏱️ Нет свободного соединения с БД за {self.acquire_timeout} сек. "
+                f"(занято {self.in_use}/{self.max_size})")
+            raise RuntimeError("Превышено время ожидания соединения с БД")
+
+        waited = time.monotonic() - started
+        self.checkouts += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+
+        try:
+            conn = self._idle.pop() if self._idle else await self._connect()
+        except Exception:
+            self._semaphore.release()
+            raise
+        self.in_use += 1
+        return conn
+
+    async def release(self, conn: aiosqlite.Connection):
+        """Возвращает соединение; сломанные и после закрытия пула - закрываются"""
+        self.in_use -= 1
+        try:
+            healthy = not self._closed
+            if healthy:
+                try:
+                    # Незакоммиченные изменения не должны достаться следующему
+                    # (in_transaction падает, если соединение уже закрыто)
+                    if conn.in_transaction:
+                        await conn.rollback()
+                except Exception as e:
+                    logger.warning(f"⚠️ Соединение с БД неисправно, закрываем: {e}")
+                    healthy = False
+
+            if healthy:
+                self._idle.append(conn)
+            else:
+                self.discarded += 1
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+        finally:
+            self._semaphore.release()
+
+    async def close(self):
+        """Закрывает свободные соединения; занятые закроются при возврате"""
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for i, conn in enumerate(idle):
+            try:
+                if i == 0 and not self.read_only:
+                    # Обновляем статистику планировщика один раз при остановке
+                    await conn.execute("PRAGMA optimize")
+            except Exception as e:
+                logger.warning(f"⚠️ PRAGMA optimize не выполнен: {e}")
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error(f"❌ Ошибка закрытия соединения с БД: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        """Метрики пула"""
+        return {
+            'size': self.max_size,
+            'in_use': self.in_use,
+            'idle': len(self._idle),
+            'created': self.created,
+            'discarded': self.discarded,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_avg_ms': (self.wait_time_total / self.checkouts * 1000) if self.checkouts else 0.0,
+            'wait_max_ms': self.wait_time_max * 1000
+        }
+
+
+class Database(UserStorage):
+    """Пользователи в SQLite (DB_USERS_PATH)"""
+    # Один пул соединений на процесс, общий для всех экземпляров Database
+    _pool: Optional[ConnectionPool] = None
 
-class Database:
     def __init__(self):
         if not DB_NAME:
             raise ValueError('❌ Отсутствует DB_USERS_PATH в .env')
@@ -15,41 +168,29 @@ class Database:
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
 
-        # Пул соединений для высокой нагрузки
-        self._connection_pool = []
-        self._max_connections = 10
-        self._lock = asyncio.Lock()
-
-    async def _get_connection(self):
-        """Получает соединение из пула или создает новое"""
-        async with self._lock:
-            if self._connection_pool:
-                return self._connection_pool.pop()
-
-            # Создаем новое соединение с оптимизациями
-            conn = await aiosqlite.connect(
-                self.db_name,
-                timeout=30.0,  # Увеличиваем timeout
-                check_same_thread=False
+    @classmethod
+    def _get_pool(cls) -> ConnectionPool:
+        """Общий пул соединений (создается при первом обращении)"""
+        if cls._pool is None:
+            cls._pool = ConnectionPool(
+                DB_NAME or "",
+                max_size=config.db_pool_size,
+                acquire_timeout=config.db_pool_timeout
             )
+        return cls._pool
 
-            # Включаем WAL режим для лучшей производительности
-            await conn.execute("PRAGMA journal_mode=WAL")
-            await conn.execute("PRAGMA synchronous=NORMAL")
-            await conn.execute("PRAGMA cache_size=10000")
-            await conn.execute("PRAGMA temp_store=MEMORY")
-            await conn.execute("PRAGMA mmap_size=268435456")  # 256MB
-            await conn.execute("PRAGMA optimize")
+    @classmethod
+    def pool_stats(cls) -> Dict[str, float]:
+        """Метрики пула соединений (пустые, если пул еще не создан)"""
+        return cls._pool.stats() if cls._pool is not None else {}
 
-            return conn
+    async def _get_connection(self) -> aiosqlite.Connection:
+        """Получает соединение из общего пула"""
+        return await self._get_pool().acquire()
 
     async def _return_connection(self, conn):
         """Возвращает соединение в пул"""
-        async with self._lock:
-            if len(self._connection_pool) < self._max_connections:
-                self._connection_pool.append(conn)
-            else:
-                await conn.close()
+        await self._get_pool().release(conn)
 
     async def init_db(self):
         """Инициализация базы данных"""
@@ -62,12 +203,26 @@ class Database:
                     first_name TEXT,
                     last_name TEXT,
                     created_at TEXT,
-                    last_active TEXT
+                    last_active TEXT,
+                    delivery_status TEXT DEFAULT 'active', -- active/blocked/deactivated
+                    delivery_failed_at TEXT
                 )
             ''')
 
+            # Миграция старых БД: колонки статуса доставки
+            cursor = await conn.execute("PRAGMA table_info(users)")
+            columns = {row[1] for row in await cursor.fetchall()}
+            if 'delivery_status' not in columns:
+                await conn.execute(
+                    "ALTER TABLE users ADD COLUMN delivery_status TEXT DEFAULT 'active'")
+            if 'delivery_failed_at' not in columns:
+                await conn.execute(
+                    "ALTER TABLE users ADD COLUMN delivery_failed_at TEXT")
+
             # Создаем индексы для быстрого поиска
             await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
+            # Поиск по username без учета регистра (как в Telegram)
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)')
             await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active)')
 
             await conn.commit()
@@ -83,40 +238,147 @@ class Database:
         submission_db = SubmissionDB()
         await submission_db.init()
 
-    async def save_user(self, user):
-        """Сохранение/обновление пользователя"""
-        now = datetime.now().isoformat()
+    async def _upsert_user(self, user, now: str) -> bool:
+        """INSERT ... ON CONFLICT DO UPDATE ... RETURNING за один вызов; True - если вставлен"""
         conn = await self._get_connection()
         try:
             cursor = await conn.execute(
-                "SELECT 1 FROM users WHERE user_id = ?",
-                (user.id,)
+                UPSERT_USERS_SQL + " RETURNING created_at",
+                (user.id, user.username, user.first_name, user.last_name,
+                 now, now, 'active', None)
             )
-            exists = await cursor.fetchone()
+            row = await cursor.fetchone()
+            await conn.commit()
+            # created_at равен переданному now только у только что вставленной строки
+            return row is not None and row[0] == now
+        finally:
+            await self._return_connection(conn)
 
-            if exists:
-                await conn.execute(
-                    "UPDATE users SET username=?, first_name=?, last_name=?, last_active=? WHERE user_id=?",
-                    (user.username, user.first_name, user.last_name, now, user.id)
-                )
-            else:
-                await conn.execute(
-                    "INSERT INTO users (user_id, username, first_name, last_name, created_at, last_active) VALUES (?, ?, ?, ?, ?, ?)",
-                    (user.id, user.username, user.first_name,
-                     user.last_name, now, now)
-                )
+    async def _write_users(self, rows: List[tuple]):
+        """Записывает пачку пользователей одним executemany UPSERT"""
+        conn = await self._get_connection()
+        try:
+            await conn.executemany(UPSERT_USERS_SQL, rows)
             await conn.commit()
         finally:
             await self._return_connection(conn)
 
+    async def _write_delivery_failures(self, rows: List[Tuple[str, str, int]]):
+        """Записывает пачку недоставок одной транзакцией"""
+        conn = await self._get_connection()
+        try:
+            await conn.executemany(
+                "UPDATE users SET delivery_status=?, delivery_failed_at=? WHERE user_id=?",
+                rows
+            )
+            await conn.commit()
+        finally:
+            await self._return_connection(conn)
+
+    async def get_user(self, user_id: int):
+        """Получение пользователя по первичному ключу"""
+        if user_id in self._pending_users:
+            await self.flush_pending_users()
+        conn = await self._get_connection()
+        try:
+            cursor = await conn.execute(
+                "SELECT * FROM users WHERE user_id = ?",
+                (user_id,)
+            )
+            return await cursor.fetchone()
+        finally:
+            await self._return_connection(conn)
+
+    async def find_users(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """
+        Поиск пользователей по ID или username (с @ или без).
+        В единой БД тем же запросом возвращаются блокировка и число обращений,
+        иначе is_banned/ban_*/submissions равны None
+        """
+        query = query.strip()
+        if query.isdigit():
+            condition, value = "u.user_id = ?", int(query)
+        else:
+            condition, value = "u.username = ? COLLATE NOCASE", query.lstrip('@')
+        if not value:
+            return []
+        await self.flush_pending_users()
+
+        if config.unified_storage:
+            sql = f"""
+                SELECT u.user_id, u.username, u.first_name, u.last_active, u.delivery_status,
+                       b.user_id IS NOT NULL AND (b.is_permanent OR b.expires_at IS NULL OR b.expires_at > ?),
+                       b.reason, b.ban_count, b.banned_at,
+                       (SELECT COUNT(*) FROM submissions s WHERE s.user_id = u.user_id)
+                FROM users u
+                LEFT JOIN banned_users b ON b.user_id = u.user_id
+                WHERE {condition}
+                ORDER BY u.last_active DESC
+                LIMIT ?
+            """
+            params: tuple = (datetime.now().isoformat(), value, limit)
+        else:
+            sql = f"""
+                SELECT u.user_id, u.username, u.first_name, u.last_active, u.delivery_status,
+                       NULL, NULL, NULL, NULL, NULL
+                FROM users u
+                WHERE {condition}
+                ORDER BY u.last_active DESC
+                LIMIT ?
+            """
+            params = (value, limit)
+
+        conn = await self._get_connection()
+        try:
+            cursor = await conn.execute(sql, params)
+            rows = await cursor.fetchall()
+        finally:
+            await self._return_connection(conn)
+
+        keys = ('user_id', 'username', 'first_name', 'last_active', 'delivery_status',
+                'is_banned', 'ban_reason', 'ban_count', 'banned_at', 'submissions')
+        users = [dict(zip(keys, row)) for row in rows]
+        for user in users:
+            if user['is_banned'] is not None:
+                user['is_banned'] = bool(user['is_banned'])
+        return users
+
+    async def get_users_by_ids(self, user_ids: Iterable[int]) -> List[tuple]:
+        """Получение пользователей по списку ID (пачками по первичному ключу)"""
+        ids = list(dict.fromkeys(user_ids))
+        if not ids:
+            return []
+        if any(user_id in self._pending_users for user_id in ids):
+            await self.flush_pending_users()
+        conn = await self._get_connection()
+        try:
+            rows = []
+            for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ','.join(['?' for _ in chunk])
+                cursor = await conn.execute(
+                    f"SELECT * FROM users WHERE user_id IN ({placeholders})",
+                    chunk
+                )
+                rows.extend(await cursor.fetchall())
+            return rows
+        finally:
+            await self._return_connection(conn)
+
     async def get_users_stats(self):
-        """Получение статистики пользователей"""
+        """Получение статистики пользователей: (всего, последние активные, доступных)"""
+        await self.flush_pending_writes()
         conn = await self._get_connection()
         try:
             cursor = await conn.execute("SELECT COUNT(*) FROM users")
             result = await cursor.fetchone()
             total_users = result[0] if result is not None else 0
 
+            cursor = await conn.execute(
+                "SELECT COUNT(*) FROM users WHERE delivery_status = 'active'")
+            result = await cursor.fetchone()
+            reachable_users = result[0] if result is not None else 0
+
             cursor = await conn.execute("""
                 SELECT first_name, username, last_active 
                 FROM users 
@@ -125,22 +387,42 @@ class Database:
             """)
             recent_users = await cursor.fetchall()
 
-            return total_users, recent_users
+            return total_users, recent_users, reachable_users
         finally:
             await self._return_connection(conn)
 
-    async def get_all_users(self):
-        """Получение всех пользователей"""
+    async def get_all_users(self, include_unreachable: bool = False):
+        """Получение всех пользователей (по умолчанию без заблокировавших бота)"""
+        await self.flush_pending_writes()
         conn = await self._get_connection()
         try:
-            cursor = await conn.execute("SELECT * FROM users")
+            if include_unreachable:
+                cursor = await conn.execute("SELECT * FROM users")
+            else:
+                cursor = await conn.execute(
+                    "SELECT * FROM users WHERE delivery_status = 'active'")
             return await cursor.fetchall()
         finally:
             await self._return_connection(conn)
 
+    async def get_user_ids_after(self, after_id: int, limit: int = 500,
+                                 include_unreachable: bool = False) -> List[int]:
+        """Порция ID пользователей после after_id (keyset-пагинация для рассылок)"""
+        conn = await self._get_connection()
+        try:
+            if include_unreachable:
+                query = "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+            else:
+                query = ("SELECT user_id FROM users WHERE user_id > ? AND delivery_status = 'active' "
+                         "ORDER BY user_id LIMIT ?")
+            cursor = await conn.execute(query, (after_id, limit))
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
+        finally:
+            await self._return_connection(conn)
+
     async def close_all_connections(self):
-        """Закрывает все соединения в пуле"""
-        async with self._lock:
-            for conn in self._connection_pool:
-                await conn.close()
-            self._connection_pool.clear()
+        """Закрывает общий пул соединений"""
+        pool, Database._pool = Database._pool, None
+        if pool is not None:
+            await pool.close()
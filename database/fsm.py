@@ -0,0 +1,288 @@
+"""
+Хранилище FSM в SQLite: черновики обратной связи и ответов переживают перезапуск
+Чтение через кэш в памяти, запись пачками в фоне, брошенные состояния удаляются по TTL
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional, Set
+
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from config import config
+from metrics import FSM_DATA_BYTES
+
+logger = logging.getLogger(__name__)
+
+FSM_MEMORY = "memory"
+FSM_SQLITE = "sqlite"
+FSM_REDIS = "redis"
+
+# Как часто удалять брошенные состояния из БД, сек
+CLEANUP_INTERVAL = 600.0
+
+EMPTY_DATA = "{}"
+
+
+class _Record:
+    """Состояние и данные одного ключа; data хранится в виде JSON, как в БД"""
+    __slots__ = ('state', 'data', 'updated_at')
+
+    def __init__(self, state: Optional[str] = None, data: str = EMPTY_DATA, updated_at: float = 0.0):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and self.data == EMPTY_DATA
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage для aiogram поверх SQLite"""
+    _instance = None  # Классовый атрибут для Singleton
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            self.db_path = Path(config.fsm_db_path)
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection: Optional[aiosqlite.Connection] = None
+            self.ttl = config.fsm_state_ttl_hours * 3600
+            self.flush_interval = config.fsm_flush_interval
+            self.cache_size = config.fsm_cache_size
+            # Кэш прочитанных ключей, включая отсутствующие в БД (пустые записи)
+            self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+            self._dirty: Set[str] = set()
+            self._flush_task: Optional[asyncio.Task] = None
+            self._flush_lock = asyncio.Lock()
+            self.hits = 0
+            self.misses = 0
+            self.initialized = True
+
+    async def init(self):
+        """Открывает БД, удаляет просроченные состояния и запускает фоновую запись"""
+        if self.connection is None:
+            self.connection = await aiosqlite.connect(
+                str(self.db_path),
+                timeout=30.0,
+                check_same_thread=False
+            )
+            await self.connection.execute("PRAGMA journal_mode=WAL")
+            await self.connection.execute("PRAGMA synchronous=NORMAL")
+            await self.connection.execute("PRAGMA temp_store=MEMORY")
+            await self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS fsm_states (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}', -- json
+                    updated_at REAL NOT NULL -- unix time
+                ) WITHOUT ROWID
+            ''')
+            await self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)')
+            await self.connection.commit()
+            removed = await self.cleanup()
+            if removed:
+                logger.info(f"🧹 Удалено брошенных FSM состояний: {removed}")
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Сбрасывает несохраненные изменения и закрывает БД"""
+        task, self._flush_task = self._flush_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.connection is not None:
+            await self.flush()
+            await self.connection.close()
+            self.connection = None
+        self._cache.clear()
+
+    @staticmethod
+    def _make_key(key: StorageKey) -> str:
+        # business_connection_id есть не во всех версиях aiogram
+        business_connection_id = getattr(key, 'business_connection_id', None)
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            business_connection_id, key.destiny
+        ))
+
+    def _expired(self, record: _Record, now: float) -> bool:
+        return self.ttl > 0 and not record.empty and record.updated_at < now - self.ttl
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        """Запись из кэша, при промахе - из БД"""
+        db_key = self._make_key(key)
+        record = self._cache.get(db_key)
+        if record is not None:
+            self.hits += 1
+            self._cache.move_to_end(db_key)
+        else:
+            self.misses += 1
+            if self.connection is None:
+                raise RuntimeError("Соединение с БД не инициализировано")
+            async with self.connection.execute(
+                "SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (db_key,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            # Пока ждали БД, ключ мог быть записан
+            record = self._cache.get(db_key)
+            if record is None:
+                record = _Record(*row) if row else _Record(updated_at=time.time())
+                self._cache[db_key] = record
+                self._evict()
+
+        if self._expired(record, time.time()):
+            record.state, record.data = None, EMPTY_DATA
+            self._dirty.add(db_key)
+        return record
+
+    def _evict(self):
+        """Вытесняет самые старые записи, кроме еще не сохраненных"""
+        if len(self._cache) <= self.cache_size:
+            return
+        for db_key in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if db_key not in self._dirty:
+                del self._cache[db_key]
+
+    async def _touch(self, key: StorageKey, record: _Record):
+        record.updated_at = time.time()
+        self._dirty.add(self._make_key(key))
+        if self.flush_interval <= 0:
+            await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, Mapping):
+            raise TypeError(f"Данные FSM должны быть словарем, получено {type(data).__name__}")
+        # Сериализуем сразу: ошибка видна в обработчике, а не при фоновой записи
+        serialized = json.dumps(dict(data), ensure_ascii=False)
+        FSM_DATA_BYTES.observe(len(serialized.encode()))
+        record = await self._get_record(key)
+        record.data = serialized
+        await self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return json.loads((await self._get_record(key)).data)
+
+    async def flush(self):
+        """Записывает измененные ключи одной транзакцией"""
+        if self.connection is None or not self._dirty:
+            return
+        async with self._flush_lock:
+            keys, self._dirty = self._dirty, set()
+            upserts = []
+            deletes = []
+            for db_key in keys:
+                record = self._cache.get(db_key)
+                if record is None or record.empty:
+                    deletes.append((db_key,))
+                else:
+                    upserts.append((db_key, record.state, record.data, record.updated_at))
+            try:
+                if upserts:
+                    await self.connection.executemany('''
+                        INSERT INTO fsm_states (key, state, data, updated_at)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET
+                            state = excluded.state,
+                            data = excluded.data,
+                            updated_at = excluded.updated_at
+                    ''', upserts)
+                if deletes:
+                    await self.connection.executemany(
+                        "DELETE FROM fsm_states WHERE key = ?", deletes)
+                await self.connection.commit()
+            except Exception:
+                # Вернем ключи в очередь, чтобы повторить при следующей записи
+                self._dirty |= keys
+                raise
+
+    async def cleanup(self) -> int:
+        """Удаляет состояния, не менявшиеся дольше TTL"""
+        if self.connection is None or self.ttl <= 0:
+            return 0
+        cutoff = time.time() - self.ttl
+        cursor = await self.connection.execute(
+            "DELETE FROM fsm_states WHERE updated_at < ?", (cutoff,))
+        await self.connection.commit()
+        for db_key in [k for k, r in self._cache.items() if r.updated_at < cutoff and k not in self._dirty]:
+            del self._cache[db_key]
+        return cursor.rowcount
+
+    async def _flush_loop(self):
+        interval = self.flush_interval if self.flush_interval > 0 else CLEANUP_INTERVAL
+        last_cleanup = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_cleanup >= CLEANUP_INTERVAL:
+                    last_cleanup = time.monotonic()
+                    removed = await self.cleanup()
+                    if removed:
+                        logger.info(f"🧹 Удалено брошенных FSM состояний: {removed}")
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи FSM состояний: {e}")
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Статистика кэша FSM"""
+        return {
+            'size': len(self._cache),
+            'dirty': len(self._dirty),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+_redis_storage: Optional[BaseStorage] = None
+
+
+def _get_redis_storage() -> BaseStorage:
+    """RedisStorage aiogram поверх общего клиента; TTL обновляется при каждой записи"""
+    global _redis_storage
+    if _redis_storage is None:
+        from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+        from database.shared_state import get_redis, redis_key
+
+        ttl = int(config.fsm_state_ttl_hours * 3600) or None
+        _redis_storage = RedisStorage(
+            redis=get_redis(),
+            key_builder=DefaultKeyBuilder(prefix=redis_key('fsm')),
+            state_ttl=ttl,
+            data_ttl=ttl
+        )
+    return _redis_storage
+
+
+def get_fsm_storage() -> Optional[BaseStorage]:
+    """FSM storage для Dispatcher; None - хранилище aiogram в памяти"""
+    if config.fsm_storage == FSM_SQLITE:
+        return SQLiteStorage()
+    if config.fsm_storage == FSM_REDIS:
+        return _get_redis_storage()
+    return None
@@ -0,0 +1,122 @@
+"""
+Перенос раздельных БД (пользователи, обратная связь, блокировки) в единый файл
+
+Запуск из корня проекта при остановленном боте:
+    python -m database.migrate
+
+Источники - DB_USERS_PATH, DB_SUBMISSIONS_PATH, DB_BANNED_PATH,
+назначение - DB_UNIFIED_PATH (должен быть задан). Исходные файлы не изменяются.
+"""
+import asyncio
+import logging
+import os
+import sys
+from typing import Dict, List
+
+import aiosqlite
+
+from config import config, DB_UNIFIED_PATH
+
+logger = logging.getLogger(__name__)
+
+# Таблицы, которые не копируются: счетчики пересчитываются триггерами при вставке
+SKIP_TABLES = {'submission_counters'}
+
+
+async def _table_columns(conn: aiosqlite.Connection, schema: str, table: str) -> List[str]:
+    async with conn.execute(f'PRAGMA {schema}.table_info("{table}")') as cursor:
+        return [row[1] for row in await cursor.fetchall()]
+
+
+async def _copy_database(conn: aiosqlite.Connection, source_path: str) -> Dict[str, int]:
+    """Копирует все таблицы источника в одноименные таблицы единой БД"""
+    copied: Dict[str, int] = {}
+    await conn.execute("ATTACH DATABASE ? AS src", (source_path,))
+    try:
+        async with conn.execute(
+            "SELECT name FROM src.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        ) as cursor:
+            tables = [row[0] for row in await cursor.fetchall()]
+
+        for table in tables:
+            if table in SKIP_TABLES:
+                continue
+            target_columns = await _table_columns(conn, 'main', table)
+            if not target_columns:
+                logger.warning(f"⚠️ Таблица {table} отсутствует в схеме единой БД, пропущена")
+                continue
+            # Только общие колонки: у старых файлов колонки могли добавляться ALTER TABLE
+            source_columns = set(await _table_columns(conn, 'src', table))
+            columns = ', '.join(f'"{c}"' for c in target_columns if c in source_columns)
+            cursor = await conn.execute(
+                f'INSERT OR IGNORE INTO main."{table}" ({columns}) SELECT {columns} FROM src."{table}"'
+            )
+            copied[table] = cursor.rowcount
+        await conn.commit()
+    finally:
+        await conn.execute("DETACH DATABASE src")
+    return copied
+
+
+async def _create_schema():
+    """Создает все таблицы, индексы и триггеры в единой БД штатной инициализацией"""
+    from database.db import Database
+    from database.submissions import SubmissionDB
+    from database.banned import BannedDB
+    from database.broadcasts import BroadcastDB
+
+    db = Database()
+    await db.init_db()
+    submission_db = SubmissionDB()
+    await submission_db.init()
+    banned_db = BannedDB()
+    await banned_db.init()
+    broadcast_db = BroadcastDB()
+    await broadcast_db.init()
+
+    await broadcast_db.close()
+    await banned_db.close()
+    await submission_db.close()
+    await db.close_all_connections()
+
+
+async def migrate() -> Dict[str, int]:
+    """Переносит данные в DB_UNIFIED_PATH, возвращает число строк по таблицам"""
+    if not DB_UNIFIED_PATH:
+        raise ValueError("Не задан DB_UNIFIED_PATH")
+
+    target = os.path.abspath(DB_UNIFIED_PATH)
+    sources = [config.db_users_path, config.db_submissions_path, config.db_banned_path]
+    sources = [path for path in sources if path and os.path.exists(path)]
+    if any(os.path.abspath(path) == target for path in sources):
+        raise ValueError("DB_UNIFIED_PATH совпадает с одним из исходных файлов")
+
+    await _create_schema()
+
+    copied: Dict[str, int] = {}
+    async with aiosqlite.connect(target, timeout=30.0) as conn:
+        for table in ('users', 'submissions', 'banned_users'):
+            async with conn.execute(f'SELECT 1 FROM "{table}" LIMIT 1') as cursor:
+                if await cursor.fetchone():
+                    raise ValueError(f"Единая БД уже содержит данные ({table})")
+
+        for path in sources:
+            logger.info(f"📦 Перенос {path}")
+            copied.update(await _copy_database(conn, os.path.abspath(path)))
+        await conn.execute("PRAGMA optimize")
+    return copied
+
+
+def main():
+    try:
+        copied = asyncio.run(migrate())
+    except Exception as e:
+        print(f"❌ Ошибка миграции: {e}")
+        sys.exit(1)
+    for table, count in copied.items():
+        print(f"  {table}: {count}")
+    print(f"✅ Данные перенесены в {DB_UNIFIED_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,922 @@
+"""
+PostgreSQL-реализация хранилищ (DB_BACKEND=postgres) на asyncpg
+
+Все хранилища работают через один пул asyncpg (DB_POOL_SIZE, DB_POOL_TIMEOUT),
+поэтому несколько процессов бота могут делить одну БД. Даты хранятся текстом в тех
+же форматах, что и в SQLite, - обработчики работают с обоими бэкендами без изменений.
+"""
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+from config import config
+from database.banned import BanCache, BanStatus, RedisBanCache
+from database.storage import (
+    BanStorage, DELIVERY_ACTIVE, SubmissionStorage, UserStorage
+)
+
+logger = logging.getLogger(__name__)
+
+# То же, что CURRENT_TIMESTAMP в SQLite: UTC, 'YYYY-MM-DD HH:MM:SS'
+PG_NOW = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+
+# Ключ advisory lock: процессы создают схему по очереди
+SCHEMA_LOCK_ID = 7413209
+
+USERS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        created_at TEXT,
+        last_active TEXT,
+        delivery_status TEXT DEFAULT 'active', -- active/blocked/deactivated
+        delivery_failed_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (lower(username));
+    CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active);
+"""
+
+SUBMISSIONS_SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS submissions (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        username TEXT,
+        text_content TEXT,
+        file_ids TEXT,
+        status TEXT DEFAULT 'new',
+        conversation_id BIGINT,
+        processed_at TEXT,
+        viewed_at TEXT,
+        created_at TEXT DEFAULT {PG_NOW}
+    );
+    CREATE INDEX IF NOT EXISTS idx_submissions_created ON submissions (created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_submissions_status_created ON submissions (status, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_submissions_user ON submissions (user_id, created_at);
+
+    CREATE TABLE IF NOT EXISTS submission_counters (
+        status TEXT PRIMARY KEY,
+        count BIGINT NOT NULL DEFAULT 0
+    );
+    CREATE OR REPLACE FUNCTION submission_counters_sync() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' AND OLD.status IS NOT DISTINCT FROM NEW.status THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE submission_counters SET count = count - 1 WHERE status = OLD.status;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status IS NOT NULL THEN
+            INSERT INTO submission_counters (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT (status) DO UPDATE SET count = submission_counters.count + 1;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    -- Не CREATE OR REPLACE TRIGGER: он есть только с PostgreSQL 14
+    DROP TRIGGER IF EXISTS trg_submissions_count ON submissions;
+    CREATE TRIGGER trg_submissions_count
+        AFTER INSERT OR DELETE OR UPDATE OF status ON submissions
+        FOR EACH ROW EXECUTE FUNCTION submission_counters_sync();
+
+    CREATE TABLE IF NOT EXISTS conversations (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        created_at TEXT DEFAULT {PG_NOW},
+        last_message_at TEXT DEFAULT {PG_NOW},
+        status TEXT DEFAULT 'open' -- open/closed/archived
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id);
+    CREATE INDEX IF NOT EXISTS idx_conversations_status ON conversations (status);
+
+    CREATE TABLE IF NOT EXISTS messages (
+        id BIGSERIAL PRIMARY KEY,
+        conversation_id BIGINT NOT NULL REFERENCES conversations (id),
+        sender_id BIGINT NOT NULL,
+        receiver_id BIGINT NOT NULL,
+        sender_role TEXT NOT NULL, -- 'user' или 'admin'
+        text_content TEXT,
+        file_ids TEXT, -- json array
+        status TEXT DEFAULT 'new', -- new/read
+        created_at TEXT DEFAULT {PG_NOW}
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages (conversation_id);
+    CREATE INDEX IF NOT EXISTS idx_messages_status ON messages (status);
+    CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender_id);
+    CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON messages (receiver_id);
+"""
+
+BANNED_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS banned_users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        banned_at TEXT,
+        banned_by BIGINT,
+        reason TEXT,
+        expires_at TEXT NULL,
+        is_permanent BOOLEAN DEFAULT FALSE,
+        ban_count INTEGER DEFAULT 1,
+        last_ban_reason TEXT
+    );
+"""
+
+UPSERT_USERS_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, created_at, last_active,
+                       delivery_status, delivery_failed_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        last_active = EXCLUDED.last_active,
+        delivery_status = EXCLUDED.delivery_status,
+        delivery_failed_at = EXCLUDED.delivery_failed_at
+"""
+
+# Действующая блокировка из LEFT JOIN banned_users b (параметр - текущее время)
+BAN_ACTIVE_SQL = "b.user_id IS NOT NULL AND (b.is_permanent OR b.expires_at IS NULL OR b.expires_at > {now})"
+
+
+def _rowcount(status: str) -> int:
+    """Число строк из статуса команды asyncpg ('DELETE 3' -> 3)"""
+    try:
+        return int(status.split()[-1])
+    except (ValueError, IndexError):
+        return 0
+
+
+class PostgresPool:
+    """Общий на процесс пул asyncpg с метриками в формате ConnectionPool.stats"""
+    _pool: Optional[asyncpg.Pool] = None
+    _lock: Optional[asyncio.Lock] = None
+    in_use = 0
+    checkouts = 0
+    timeouts = 0
+    wait_time_total = 0.0
+    wait_time_max = 0.0
+
+    @classmethod
+    async def get(cls) -> asyncpg.Pool:
+        """Пул (создается при первом обращении)"""
+        if cls._pool is None:
+            if cls._lock is None:
+                cls._lock = asyncio.Lock()
+            async with cls._lock:
+                if cls._pool is None:
+                    cls._pool = await asyncpg.create_pool(
+                        config.database_url,
+                        min_size=1,
+                        max_size=config.db_pool_size,
+                        command_timeout=30
+                    )
+        return cls._pool
+
+    @classmethod
+    @asynccontextmanager
+    async def acquire(cls) -> AsyncIterator[asyncpg.Connection]:
+        """Соединение из пула; ждет не дольше DB_POOL_TIMEOUT"""
+        pool = await cls.get()
+        started = time.monotonic()
+        try:
+            conn = await pool.acquire(timeout=config.db_pool_timeout)
+        except asyncio.TimeoutError:
+            cls.timeouts += 1
+            logger.error(
+                f"⏱️ Нет свободного соединения с БД за {config.db_pool_timeout} сек. "
+                f"(занято {cls.in_use}/{config.db_pool_size})")
+            raise RuntimeError("Превышено время ожидания соединения с БД")
+
+        waited = time.monotonic() - started
+        cls.checkouts += 1
+        cls.wait_time_total += waited
+        cls.wait_time_max = max(cls.wait_time_max, waited)
+        cls.in_use += 1
+        try:
+            yield conn
+        finally:
+            cls.in_use -= 1
+            await pool.release(conn)
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls) -> AsyncIterator[asyncpg.Connection]:
+        """Соединение с открытой транзакцией (commit при выходе без ошибки)"""
+        async with cls.acquire() as conn, conn.transaction():
+            yield conn
+
+    @classmethod
+    def stats(cls) -> Dict[str, float]:
+        """Метрики пула"""
+        if cls._pool is None:
+            return {}
+        return {
+            'size': cls._pool.get_max_size(),
+            'in_use': cls.in_use,
+            'idle': cls._pool.get_idle_size(),
+            'created': cls._pool.get_size(),
+            'discarded': 0,
+            'checkouts': cls.checkouts,
+            'timeouts': cls.timeouts,
+            'wait_avg_ms': (cls.wait_time_total / cls.checkouts * 1000) if cls.checkouts else 0.0,
+            'wait_max_ms': cls.wait_time_max * 1000
+        }
+
+    @classmethod
+    async def close(cls):
+        pool, cls._pool = cls._pool, None
+        if pool is not None:
+            await pool.close()
+            logger.info("🔌 Пул соединений PostgreSQL закрыт")
+
+
+async def _create_schema(schema: str) -> bool:
+    """Создает таблицы под advisory lock; True - если счетчики обращений уже были"""
+    async with PostgresPool.transaction() as conn:
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+        counters_exist = await conn.fetchval(
+            "SELECT to_regclass('submission_counters') IS NOT NULL")
+        await conn.execute(schema)
+        return counters_exist
+
+
+class PostgresUserDB(UserStorage):
+    """Пользователи в PostgreSQL"""
+
+    async def init_db(self):
+        """Инициализация таблицы пользователей"""
+        await _create_schema(USERS_SCHEMA)
+
+    async def _upsert_user(self, user, now: str) -> bool:
+        """UPSERT ... RETURNING created_at; True - если вставлен"""
+        async with PostgresPool.acquire() as conn:
+            created_at = await conn.fetchval(
+                UPSERT_USERS_SQL + " RETURNING created_at",
+                user.id, user.username, user.first_name, user.last_name,
+                now, now, DELIVERY_ACTIVE, None
+            )
+        # created_at равен переданному now только у только что вставленной строки
+        return created_at == now
+
+    async def _write_users(self, rows: List[tuple]):
+        async with PostgresPool.transaction() as conn:
+            await conn.executemany(UPSERT_USERS_SQL, rows)
+
+    async def _write_delivery_failures(self, rows: List[Tuple[str, str, int]]):
+        async with PostgresPool.transaction() as conn:
+            await conn.executemany(
+                "UPDATE users SET delivery_status = $1, delivery_failed_at = $2 WHERE user_id = $3",
+                rows
+            )
+
+    async def get_user(self, user_id: int):
+        """Получение пользователя по первичному ключу"""
+        if user_id in self._pending_users:
+            await self.flush_pending_users()
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+
+    async def find_users(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """Поиск по ID или username одним запросом с блокировкой и числом обращений"""
+        query = query.strip()
+        if query.isdigit():
+            condition, value = "u.user_id = $2", int(query)
+        else:
+            condition, value = "lower(u.username) = lower($2)", query.lstrip('@')
+        if not value:
+            return []
+        await self.flush_pending_users()
+
+        async with PostgresPool.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT u.user_id, u.username, u.first_name, u.last_active, u.delivery_status,
+                       {BAN_ACTIVE_SQL.format(now='$1')},
+                       b.reason, b.ban_count, b.banned_at,
+                       (SELECT COUNT(*) FROM submissions s WHERE s.user_id = u.user_id)
+                FROM users u
+                LEFT JOIN banned_users b ON b.user_id = u.user_id
+                WHERE {condition}
+                ORDER BY u.last_active DESC NULLS LAST
+                LIMIT $3
+            """, datetime.now().isoformat(), value, limit)
+
+        keys = ('user_id', 'username', 'first_name', 'last_active', 'delivery_status',
+                'is_banned', 'ban_reason', 'ban_count', 'banned_at', 'submissions')
+        return [dict(zip(keys, row)) for row in rows]
+
+    async def get_users_by_ids(self, user_ids) -> List[tuple]:
+        """Получение пользователей по списку ID одним запросом"""
+        ids = list(dict.fromkeys(user_ids))
+        if not ids:
+            return []
+        if any(user_id in self._pending_users for user_id in ids):
+            await self.flush_pending_users()
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetch(
+                "SELECT * FROM users WHERE user_id = ANY($1::bigint[])", ids)
+
+    async def get_users_stats(self):
+        """Получение статистики пользователей: (всего, последние активные, доступных)"""
+        await self.flush_pending_writes()
+        async with PostgresPool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT COUNT(*), COUNT(*) FILTER (WHERE delivery_status = 'active') FROM users")
+            recent_users = await conn.fetch("""
+                SELECT first_name, username, last_active
+                FROM users
+                ORDER BY last_active DESC NULLS LAST
+                LIMIT 5
+            """)
+        return row[0], recent_users, row[1]
+
+    async def get_all_users(self, include_unreachable: bool = False):
+        """Получение всех пользователей (по умолчанию без заблокировавших бота)"""
+        await self.flush_pending_writes()
+        async with PostgresPool.acquire() as conn:
+            if include_unreachable:
+                return await conn.fetch("SELECT * FROM users")
+            return await conn.fetch("SELECT * FROM users WHERE delivery_status = 'active'")
+
+    async def get_user_ids_after(self, after_id: int, limit: int = 500,
+                                 include_unreachable: bool = False) -> List[int]:
+        """Порция ID пользователей после after_id (keyset-пагинация для рассылок)"""
+        if include_unreachable:
+            query = "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2"
+        else:
+            query = ("SELECT user_id FROM users WHERE user_id > $1 AND delivery_status = 'active' "
+                     "ORDER BY user_id LIMIT $2")
+        async with PostgresPool.acquire() as conn:
+            rows = await conn.fetch(query, after_id, limit)
+        return [row[0] for row in rows]
+
+    async def close_all_connections(self):
+        """Закрывает общий пул (закрывать последним - им пользуются все хранилища)"""
+        await PostgresPool.close()
+
+    @classmethod
+    def pool_stats(cls) -> Dict[str, float]:
+        return PostgresPool.stats()
+
+
+class PostgresSubmissionDB(SubmissionStorage):
+    """Обратная связь в PostgreSQL"""
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            self._ready = False
+            self.initialized = True
+
+    @property
+    def is_connected(self) -> bool:
+        return self._ready
+
+    async def init(self):
+        """Создает таблицы (один раз на процесс)"""
+        if self._ready:
+            return
+        counters_exist = await _create_schema(SUBMISSIONS_SCHEMA)
+        if not counters_exist:
+            # Таблицы созданы до появления счетчиков - заполняем по текущим данным
+            async with PostgresPool.transaction() as conn:
+                await self._recompute_counters(conn)
+        self._ready = True
+
+    async def close(self):
+        """Пул общий с другими хранилищами и закрывается вместе с ними"""
+        self._ready = False
+
+    async def add_submission(self, user_id: int, username: str, text: str,
+                             file_ids: Optional[List[str]] = None) -> int:
+        """Добавляет заявку в БД и создает переписку"""
+        file_ids_json = json.dumps(file_ids or [])
+        try:
+            async with PostgresPool.transaction() as conn:
+                conversation_id = await conn.fetchval(
+                    'INSERT INTO conversations (user_id) VALUES ($1) RETURNING id', user_id)
+                submission_id = await conn.fetchval(
+                    '''INSERT INTO submissions
+                    (user_id, username, text_content, file_ids, status, conversation_id)
+                    VALUES ($1, $2, $3, $4, 'new', $5) RETURNING id''',
+                    user_id, username, text, file_ids_json, conversation_id
+                )
+                await conn.execute(
+                    '''INSERT INTO messages (conversation_id, sender_id, receiver_id, sender_role, text_content, file_ids, status)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)''',
+                    conversation_id, user_id, 0, 'user', text, file_ids_json, 'new'
+                )
+            return submission_id
+        except Exception as e:
+            logger.error(f"❌ Ошибка при добавлении записи: {e}")
+            raise
+
+    async def get_all_submissions(self, limit: int = 100, offset: int = 0):
+        """Получает записи из БД с пагинацией"""
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetch(
+                'SELECT * FROM submissions ORDER BY created_at DESC, id DESC LIMIT $1 OFFSET $2',
+                limit, offset)
+
+    async def get_submissions_by_status(self, status: str, limit: int = 100, offset: int = 0):
+        """Получает записи по статусу с пагинацией"""
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetch(
+                'SELECT * FROM submissions WHERE status = $1 ORDER BY created_at DESC, id DESC LIMIT $2 OFFSET $3',
+                status, limit, offset)
+
+    async def get_submissions_page(self, status: Optional[str] = None,
+                                   cursor: Optional[Sequence[Any]] = None,
+                                   direction: str = 'next', inclusive: bool = False,
+                                   limit: int = 10):
+        """
+        Страница записей по курсору (created_at, id) с актуальным username
+        и признаком блокировки - одним запросом
+        """
+        params: List[Any] = [datetime.now().isoformat()]
+
+        def arg(value: Any) -> str:
+            params.append(value)
+            return f'${len(params)}'
+
+        conditions = []
+        if status is not None:
+            conditions.append(f's.status = {arg(status)}')
+        if cursor is not None:
+            if direction == 'prev':
+                op = '>=' if inclusive else '>'
+            else:
+                op = '<=' if inclusive else '<'
+            conditions.append(f'(s.created_at, s.id) {op} ({arg(cursor[0])}, {arg(cursor[1])})')
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'ASC' if direction == 'prev' else 'DESC'
+
+        try:
+            async with PostgresPool.acquire() as conn:
+                rows = await conn.fetch(f'''
+                    SELECT s.*, u.username, {BAN_ACTIVE_SQL.format(now='$1')}
+                    FROM submissions s
+                    LEFT JOIN users u ON u.user_id = s.user_id
+                    LEFT JOIN banned_users b ON b.user_id = s.user_id
+                    {where} ORDER BY s.created_at {order}, s.id {order} LIMIT {arg(limit)}''',
+                    *params)
+            rows = list(rows)
+            if direction == 'prev':
+                rows.reverse()
+            return rows
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении страницы записей: {e}")
+            raise
+
+    async def count_submissions(self, status: Optional[str] = None) -> int:
+        """Количество записей (из таблицы счетчиков)"""
+        async with PostgresPool.acquire() as conn:
+            if status is None:
+                count = await conn.fetchval('SELECT COALESCE(SUM(count), 0) FROM submission_counters')
+            else:
+                count = await conn.fetchval(
+                    'SELECT count FROM submission_counters WHERE status = $1', status)
+        return int(count or 0)
+
+    @staticmethod
+    async def _recompute_counters(conn: asyncpg.Connection):
+        await conn.execute('DELETE FROM submission_counters')
+        await conn.execute(
+            '''INSERT INTO submission_counters (status, count)
+            SELECT status, COUNT(*) FROM submissions WHERE status IS NOT NULL GROUP BY status'''
+        )
+
+    async def recompute_counters(self) -> Dict[str, int]:
+        """Пересобирает счетчики с нуля (если данные правили в обход бота)"""
+        async with PostgresPool.transaction() as conn:
+            # Параллельные изменения submissions ждут пересчета
+            await conn.execute('LOCK TABLE submissions IN SHARE MODE')
+            await self._recompute_counters(conn)
+        stats = await self.get_statistics()
+        logger.info(f"🔄 Счетчики обращений пересчитаны: {stats}")
+        return stats
+
+    async def get_submission_by_id(self, submission_id: int):
+        """Получает запись по ID"""
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetchrow('SELECT * FROM submissions WHERE id = $1', submission_id)
+
+    async def mark_as_viewed(self, submission_id: int):
+        """Отмечает запись как просмотренную"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                await conn.execute(
+                    f'''UPDATE submissions SET status = 'viewed', viewed_at = {PG_NOW}
+                    WHERE id = $1 AND status = 'new' ''',
+                    submission_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при отметке как просмотренной: {e}")
+            raise
+
+    async def mark_as_solved(self, submission_id: int):
+        """Отмечает запись как решенную"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                await conn.execute(
+                    f"UPDATE submissions SET status = 'solved', processed_at = {PG_NOW} WHERE id = $1",
+                    submission_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при отметке как решенной: {e}")
+            raise
+
+    async def save_admin_response(self, submission_id: int, admin_response: str, admin_id: int,
+                                  file_ids: Optional[List[str]] = None):
+        """Сохраняет ответ администратора в переписку (текст и файлы)"""
+        try:
+            async with PostgresPool.transaction() as conn:
+                row = await conn.fetchrow(
+                    'SELECT conversation_id, user_id FROM submissions WHERE id = $1', submission_id)
+                if not row:
+                    raise RuntimeError(f"Обращение {submission_id} не найдено")
+                conversation_id, user_id = row
+                await conn.execute(
+                    '''INSERT INTO messages (conversation_id, sender_id, receiver_id, sender_role, text_content, file_ids, status)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)''',
+                    conversation_id, admin_id, user_id, 'admin', admin_response,
+                    json.dumps(file_ids or []), 'new'
+                )
+                await conn.execute(
+                    f'UPDATE conversations SET last_message_at = {PG_NOW} WHERE id = $1',
+                    conversation_id)
+            logger.info(
+                f"✅ Ответ администратора сохранен в переписку {conversation_id}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сохранении ответа администратора: {e}")
+            raise
+
+    async def delete_submission(self, submission_id: int):
+        """Удаляет запись"""
+        logger.info(f"🗑️ Удаление записи {submission_id}...")
+        try:
+            async with PostgresPool.acquire() as conn:
+                await conn.execute('DELETE FROM submissions WHERE id = $1', submission_id)
+            logger.info(f"✅ Запись {submission_id} удалена")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при удалении записи: {e}")
+            raise
+
+    async def get_statistics(self) -> Dict[str, int]:
+        """Получает статистику по записям"""
+        logger.info("📊 Получение статистики...")
+        try:
+            async with PostgresPool.acquire() as conn:
+                rows = await conn.fetch('SELECT status, count FROM submission_counters')
+            counts = {row[0]: int(row[1]) for row in rows}
+            stats = {
+                'total': sum(counts.values()),
+                'new': counts.get('new', 0),
+                'solved': counts.get('solved', 0),
+                'viewed': counts.get('viewed', 0)
+            }
+            logger.info(f"📊 Статистика: {stats}")
+            return stats
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении статистики: {e}")
+            raise
+
+    async def batch_update_status(self, submission_ids: List[int], status: str):
+        """Пакетное обновление статуса записей"""
+        if not submission_ids:
+            return
+        timestamp_field = 'viewed_at' if status == 'viewed' else 'processed_at'
+        try:
+            async with PostgresPool.acquire() as conn:
+                await conn.execute(
+                    f'''UPDATE submissions SET status = $1, {timestamp_field} = {PG_NOW}
+                    WHERE id = ANY($2::bigint[])''',
+                    status, list(submission_ids))
+        except Exception as e:
+            logger.error(f"❌ Ошибка при пакетном обновлении: {e}")
+            raise
+
+    async def get_user_submissions(self, user_id: int, limit: int = 10):
+        """Последние обращения пользователя: (id, text_content, file_ids, status, created_at)"""
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetch(
+                '''SELECT id, text_content, file_ids, status, created_at FROM submissions
+                WHERE user_id = $1 ORDER BY created_at DESC, id DESC LIMIT $2''',
+                user_id, limit)
+
+    async def get_last_submission_time(self, user_id: int) -> Optional[str]:
+        """Дата и время последнего обращения пользователя (по created_at)"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                return await conn.fetchval(
+                    'SELECT MAX(created_at) FROM submissions WHERE user_id = $1', user_id)
+        except Exception as e:
+            logger.error(
+                f"❌ Ошибка при получении времени последней отправки: {e}")
+            return None
+
+    async def create_conversation(self, user_id: int) -> int:
+        """Создать новую переписку и вернуть её id"""
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetchval(
+                'INSERT INTO conversations (user_id) VALUES ($1) RETURNING id', user_id)
+
+    async def add_message(self, conversation_id: int, sender_id: int, receiver_id: int,
+                          sender_role: str, text: str = "", file_ids: Optional[List[str]] = None,
+                          status: str = 'new'):
+        """Добавить сообщение в переписку"""
+        async with PostgresPool.transaction() as conn:
+            message_id = await conn.fetchval(
+                '''INSERT INTO messages (conversation_id, sender_id, receiver_id, sender_role, text_content, file_ids, status)
+                VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id''',
+                conversation_id, sender_id, receiver_id, sender_role, text,
+                json.dumps(file_ids or []), status
+            )
+            await conn.execute(
+                f'UPDATE conversations SET last_message_at = {PG_NOW} WHERE id = $1',
+                conversation_id)
+        return message_id
+
+    async def get_conversation_by_id(self, conversation_id: int):
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetchrow('SELECT * FROM conversations WHERE id = $1', conversation_id)
+
+    async def get_user_conversations(self, user_id: int, limit: int = 20, offset: int = 0):
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetch(
+                'SELECT * FROM conversations WHERE user_id = $1 ORDER BY last_message_at DESC LIMIT $2 OFFSET $3',
+                user_id, limit, offset)
+
+    async def get_messages_in_conversation(self, conversation_id: int, limit: int = 50, offset: int = 0):
+        async with PostgresPool.acquire() as conn:
+            return await conn.fetch(
+                'SELECT * FROM messages WHERE conversation_id = $1 ORDER BY created_at, id LIMIT $2 OFFSET $3',
+                conversation_id, limit, offset)
+
+    async def mark_message_as_read(self, message_id: int):
+        async with PostgresPool.acquire() as conn:
+            await conn.execute("UPDATE messages SET status = 'read' WHERE id = $1", message_id)
+
+    async def get_conversation_history(self, submission_id: int):
+        """Получает историю переписки для обращения"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                return await conn.fetch(
+                    '''SELECT m.sender_role, m.text_content, m.file_ids, m.created_at
+                    FROM submissions s
+                    JOIN messages m ON m.conversation_id = s.conversation_id
+                    WHERE s.id = $1
+                    ORDER BY m.created_at, m.id''',
+                    submission_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении истории переписки: {e}")
+            return []
+
+    async def backup_and_clear_database(self) -> str:
+        """Копирует обращения и переписки в отдельную схему и очищает их"""
+        schema = f"submissions_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        try:
+            async with PostgresPool.transaction() as conn:
+                await conn.execute(f'CREATE SCHEMA {schema}')
+                for table in ('submissions', 'conversations', 'messages'):
+                    await conn.execute(f'CREATE TABLE {schema}.{table} AS TABLE {table}')
+                logger.info(f"✅ Резервная копия создана: схема {schema}")
+
+                await conn.execute('DELETE FROM messages')
+                await conn.execute('DELETE FROM conversations')
+                await conn.execute('DELETE FROM submissions')
+            logger.info("✅ Все сообщения и переписки очищены")
+            return f"PostgreSQL, схема {schema}"
+        except Exception as e:
+            logger.error(f"❌ Ошибка при резервном копировании и очистке: {e}")
+            raise
+
+
+class PostgresBannedDB(BanStorage):
+    """
+    Блокировки в PostgreSQL с индексом активных блокировок, как у BannedDB.
+    Несколько процессов бота должны работать с REDIS_URL: иначе индекс у каждого
+    процесса свой и бан из другого процесса виден только после перезапуска
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # При REDIS_URL индекс общий для всех процессов бота
+            self.cache = RedisBanCache() if config.shared_state else BanCache()
+            self.initialized = True
+
+    async def init(self):
+        """Создает таблицу блокировок и загружает активные блокировки в индекс"""
+        await _create_schema(BANNED_SCHEMA)
+        await self._load_cache()
+
+    async def close(self):
+        """Пул общий с другими хранилищами и закрывается вместе с ними; индекс сбрасывается"""
+        self.cache = RedisBanCache() if config.shared_state else BanCache()
+
+    async def _load_cache(self):
+        """Удаляет истекшие блокировки и загружает остальные в индекс"""
+        async with PostgresPool.acquire() as conn:
+            await conn.execute("""
+                DELETE FROM banned_users
+                WHERE expires_at IS NOT NULL
+                AND expires_at < $1
+                AND is_permanent = FALSE
+            """, datetime.now().isoformat())
+            rows = await conn.fetch("""
+                SELECT user_id, username, banned_at, banned_by, reason, expires_at,
+                       is_permanent, ban_count, last_ban_reason
+                FROM banned_users
+            """)
+        await self.cache.load([dict(row) for row in rows])
+        logger.info(f"🚫 Загружено блокировок в кэш: {len(self.cache)}")
+
+    async def _expire_cached_bans(self):
+        """Снимает истекшие блокировки из индекса и удаляет их из БД"""
+        expired = await self.cache.pop_expired()
+        if not expired:
+            return
+        async with PostgresPool.acquire() as conn:
+            await conn.executemany(
+                "DELETE FROM banned_users WHERE user_id = $1 AND expires_at = $2", expired)
+
+    async def lookup(self, user_id: int) -> Optional[BanStatus]:
+        """Действующая блокировка из индекса (до его загрузки - из БД); истекшая удаляется"""
+        try:
+            if self.cache.loaded:
+                await self._expire_cached_bans()
+                info = await self.cache.get(user_id)
+                return BanStatus.from_info(info) if info else None
+
+            # Индекс еще не загружен: чтение из БД считается промахом
+            self.cache.misses += 1
+            async with PostgresPool.acquire() as conn:
+                row = await conn.fetchrow("""
+                    SELECT user_id, username, banned_at, banned_by, reason, expires_at,
+                           is_permanent, ban_count, last_ban_reason
+                    FROM banned_users WHERE user_id = $1
+                """, user_id)
+                if not row:
+                    return None
+
+                info = dict(row)
+                # Если временная блокировка истекла
+                if info['expires_at'] and not info['is_permanent']:
+                    if datetime.now() > datetime.fromisoformat(info['expires_at']):
+                        await conn.execute(
+                            "DELETE FROM banned_users WHERE user_id = $1 AND expires_at = $2",
+                            user_id, info['expires_at'])
+                        return None
+
+            return BanStatus.from_info(info)
+        except Exception as e:
+            logger.error(f"Ошибка проверки блокировки: {e}")
+            return None
+
+    async def ban_user(self, user_id: int, username: str, reason: str,
+                       banned_by: int, duration_hours: int = 24) -> Dict[str, Any]:
+        """Блокировка пользователя с прогрессивной системой"""
+        try:
+            async with PostgresPool.transaction() as conn:
+                # Строка блокируется до конца транзакции - повторный бан из другого процесса ждет
+                previous = await conn.fetchval(
+                    "SELECT ban_count FROM banned_users WHERE user_id = $1 FOR UPDATE", user_id)
+
+                ban_count = 1
+                is_permanent = False
+                expires_at = None
+
+                if previous:
+                    ban_count = previous + 1
+
+                    # Прогрессивная система блокировок
+                    if ban_count == 2:  # Вторая блокировка - 7 дней
+                        duration_hours = 24 * 7
+                    elif ban_count >= 3:  # Третья и далее - навсегда
+                        is_permanent = True
+
+                if not is_permanent:
+                    expires_at = (datetime.now() +
+                                  timedelta(hours=duration_hours)).isoformat()
+
+                banned_at = datetime.now().isoformat()
+                await conn.execute("""
+                    INSERT INTO banned_users
+                    (user_id, username, banned_at, banned_by, reason, expires_at,
+                     is_permanent, ban_count, last_ban_reason)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        banned_at = EXCLUDED.banned_at,
+                        banned_by = EXCLUDED.banned_by,
+                        reason = EXCLUDED.reason,
+                        expires_at = EXCLUDED.expires_at,
+                        is_permanent = EXCLUDED.is_permanent,
+                        ban_count = EXCLUDED.ban_count,
+                        last_ban_reason = EXCLUDED.last_ban_reason
+                """, user_id, username, banned_at, banned_by,
+                    reason, expires_at, is_permanent, ban_count, reason)
+
+            await self.cache.put(user_id, {
+                'user_id': user_id,
+                'username': username,
+                'banned_at': banned_at,
+                'banned_by': banned_by,
+                'reason': reason,
+                'expires_at': expires_at,
+                'is_permanent': is_permanent,
+                'ban_count': ban_count,
+                'last_ban_reason': reason
+            })
+
+            return {
+                'ban_count': ban_count,
+                'is_permanent': is_permanent,
+                'expires_at': expires_at,
+                'duration_hours': duration_hours
+            }
+        except Exception as e:
+            logger.error(f"Ошибка блокировки пользователя: {e}")
+            raise
+
+    async def unban_user(self, user_id: int) -> bool:
+        """Разблокировка пользователя"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                status = await conn.execute(
+                    "DELETE FROM banned_users WHERE user_id = $1", user_id)
+            await self.cache.remove(user_id)
+            return _rowcount(status) > 0
+        except Exception as e:
+            logger.error(f"Ошибка разблокировки пользователя: {e}")
+            return False
+
+    async def get_banned_list(self) -> List[Dict[str, Any]]:
+        """Получение списка всех заблокированных пользователей"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT user_id, username, banned_at, reason, expires_at,
+                           is_permanent, ban_count
+                    FROM banned_users
+                    ORDER BY banned_at DESC
+                """)
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"Ошибка получения списка заблокированных: {e}")
+            return []
+
+    async def cleanup_expired_bans(self) -> int:
+        """Очистка истекших блокировок"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                status = await conn.execute("""
+                    DELETE FROM banned_users
+                    WHERE expires_at IS NOT NULL
+                    AND expires_at < $1
+                    AND is_permanent = FALSE
+                """, datetime.now().isoformat())
+            await self.cache.pop_expired()
+            return _rowcount(status)
+        except Exception as e:
+            logger.error(f"Ошибка очистки истекших блокировок: {e}")
+            return 0
+
+    async def get_ban_stats(self) -> Dict[str, Any]:
+        """Статистика блокировок одним запросом"""
+        try:
+            async with PostgresPool.acquire() as conn:
+                row = await conn.fetchrow("""
+                    SELECT COUNT(*),
+                           COUNT(*) FILTER (WHERE is_permanent),
+                           COUNT(*) FILTER (WHERE NOT is_permanent),
+                           COUNT(*) FILTER (WHERE left(banned_at, 10) = $1)
+                    FROM banned_users
+                """, datetime.now().date().isoformat())
+            return {
+                'total': row[0],
+                'permanent': row[1],
+                'temporary': row[2],
+                'today': row[3]
+            }
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики блокировок: {e}")
+            return {'total': 0, 'permanent': 0, 'temporary': 0, 'today': 0}
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Статистика индекса блокировок"""
+        return self.cache.stats()
@@ -0,0 +1,53 @@
+"""
+Общее состояние нескольких процессов бота в Redis (или совместимом хранилище)
+FSM, окна антиспама и кэш блокировок; REDIS_URL=fakeredis:// - замена в памяти процесса для тестов
+"""
+import logging
+from typing import Any, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[Any] = None
+
+
+def _connect(url: str):
+    """Клиент redis.asyncio (redis - необязательная зависимость)"""
+    if url.startswith("fakeredis://"):
+        try:
+            from fakeredis import aioredis as fake_aioredis
+        except ImportError as e:
+            raise RuntimeError("Для REDIS_URL=fakeredis:// установите fakeredis: pip install fakeredis") from e
+        return fake_aioredis.FakeRedis(decode_responses=True)
+    try:
+        from redis.asyncio import Redis
+    except ImportError as e:
+        raise RuntimeError("Для REDIS_URL установите redis: pip install redis") from e
+    return Redis.from_url(url, decode_responses=True)
+
+
+def get_redis():
+    """Общий клиент Redis процесса"""
+    global _client
+    if _client is None:
+        if not config.redis_url:
+            raise RuntimeError("Не задан REDIS_URL")
+        _client = _connect(config.redis_url)
+        logger.info("🔗 Общее состояние в Redis")
+    return _client
+
+
+def redis_key(*parts: Any) -> str:
+    """Ключ с префиксом бота (несколько ботов могут делить один Redis)"""
+    return ':'.join(str(part) for part in (config.redis_prefix, *parts))
+
+
+async def close_redis():
+    """Закрывает клиент Redis"""
+    global _client
+    client, _client = _client, None
+    if client is not None:
+        # redis>=5 - aclose, старые версии - close
+        close = getattr(client, 'aclose', None) or client.close
+        await close()
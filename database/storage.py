@@ -0,0 +1,471 @@
+"""
+Интерфейсы хранилищ (пользователи, обратная связь, блокировки) и выбор бэкенда
+
+DB_BACKEND=sqlite (по умолчанию) - Database, SubmissionDB, BannedDB на aiosqlite;
+DB_BACKEND=postgres - реализации из database.postgres на asyncpg (DATABASE_URL).
+Обработчики получают хранилища через get_user_storage / get_submission_storage /
+get_ban_storage и не зависят от конкретной БД.
+"""
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from config import config
+from metrics import instrument_storage
+
+if TYPE_CHECKING:
+    from database.banned import BanStatus
+
+logger = logging.getLogger(__name__)
+
+# Статусы доставки: active - доступен, blocked - заблокировал бота,
+# deactivated - аккаунт удален
+DELIVERY_ACTIVE = 'active'
+DELIVERY_BLOCKED = 'blocked'
+DELIVERY_DEACTIVATED = 'deactivated'
+
+# Сколько ошибок доставки копить перед записью в БД
+DELIVERY_FAILURES_FLUSH_SIZE = 100
+
+# Сколько пользователей копить в буфере активности до внеочередной записи
+PENDING_USERS_FLUSH_SIZE = 1000
+
+BACKEND_SQLITE = 'sqlite'
+BACKEND_POSTGRES = 'postgres'
+
+
+class UserStorage(ABC):
+    """
+    Хранилище пользователей. LRU кэш, буфер активности (write-behind) и пакетная
+    запись недоставок общие для всех бэкендов; SQL - в наследниках
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Время вызовов бэкенда в метриках (bot_db_query_duration_seconds)
+        instrument_storage(cls, 'users')
+
+    # LRU кэш последних пользователей: user_id -> (username, first_name).
+    # Общий для всех экземпляров, наполняется в save_user
+    _recent_users: "OrderedDict[int, Tuple[Optional[str], Optional[str]]]" = OrderedDict()
+    _recent_users_max = 5000
+    # Недоставки, ожидающие пакетной записи: user_id -> (status, failed_at)
+    _delivery_failures: "OrderedDict[int, Tuple[str, str]]" = OrderedDict()
+    # Буфер активности (write-behind): user_id -> [username, first_name, last_name,
+    # created_at, last_active, delivery_status, delivery_failed_at]
+    _pending_users: Dict[int, list] = {}
+    _flush_task: Optional[asyncio.Task] = None
+
+    # --- SQL бэкенда ---
+
+    @abstractmethod
+    async def init_db(self):
+        """Создает таблицы и индексы"""
+
+    @abstractmethod
+    async def _upsert_user(self, user, now: str) -> bool:
+        """Один UPSERT пользователя; True - если запись вставлена"""
+
+    @abstractmethod
+    async def _write_users(self, rows: List[tuple]):
+        """UPSERT пачки (user_id, username, first_name, last_name, created_at,
+        last_active, delivery_status, delivery_failed_at) одной транзакцией"""
+
+    @abstractmethod
+    async def _write_delivery_failures(self, rows: List[Tuple[str, str, int]]):
+        """Записывает пачку (delivery_status, delivery_failed_at, user_id)"""
+
+    @abstractmethod
+    async def get_user(self, user_id: int):
+        """Пользователь по ID: (user_id, username, first_name, ...) или None"""
+
+    @abstractmethod
+    async def find_users(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """Поиск по ID или username вместе с блокировкой и числом обращений"""
+
+    @abstractmethod
+    async def get_users_by_ids(self, user_ids) -> List[tuple]:
+        """Пользователи по списку ID"""
+
+    @abstractmethod
+    async def get_users_stats(self):
+        """(всего, последние активные, доступных для рассылки)"""
+
+    @abstractmethod
+    async def get_all_users(self, include_unreachable: bool = False):
+        """Все пользователи (по умолчанию без заблокировавших бота)"""
+
+    @abstractmethod
+    async def get_user_ids_after(self, after_id: int, limit: int = 500,
+                                 include_unreachable: bool = False) -> List[int]:
+        """Порция ID пользователей после after_id (keyset-пагинация для рассылок)"""
+
+    @abstractmethod
+    async def close_all_connections(self):
+        """Закрывает соединения с БД"""
+
+    @classmethod
+    @abstractmethod
+    def pool_stats(cls) -> Dict[str, float]:
+        """Метрики пула соединений"""
+
+    # --- Общая логика ---
+
+    async def save_user(self, user) -> bool:
+        """
+        Сохранение/обновление пользователя. Возвращает True для нового пользователя.
+        Уже известные пользователи пишутся в буфер и сбрасываются в БД пачкой (write-behind)
+        """
+        now = datetime.now().isoformat()
+        known = user.id in self._pending_users or user.id in self._recent_users
+
+        if known and self._flush_task is not None:
+            pending = self._pending_users.get(user.id)
+            # Пользователь написал боту - значит снова доступен для доставки
+            self._pending_users[user.id] = [
+                user.username, user.first_name, user.last_name,
+                pending[3] if pending else now, now, DELIVERY_ACTIVE, None
+            ]
+            self._remember_user(user.id, user.username, user.first_name)
+            self._delivery_failures.pop(user.id, None)
+            if len(self._pending_users) >= PENDING_USERS_FLUSH_SIZE:
+                await self.flush_pending_users()
+            return False
+
+        # Незнакомый пользователь (или запись без буфера) - сразу один UPSERT
+        is_new = await self._upsert_user(user, now)
+        self._pending_users.pop(user.id, None)
+        self._remember_user(user.id, user.username, user.first_name)
+        self._delivery_failures.pop(user.id, None)
+        return is_new
+
+    async def flush_pending_users(self) -> int:
+        """Записывает буфер активности одним пакетным UPSERT"""
+        if not self._pending_users:
+            return 0
+        pending = list(self._pending_users.items())
+        self._pending_users.clear()
+        try:
+            await self._write_users([(user_id, *values) for user_id, values in pending])
+            return len(pending)
+        except Exception:
+            # Не теряем активность: возвращаем в буфер то, что не перезаписано новыми кликами
+            for user_id, values in pending:
+                self._pending_users.setdefault(user_id, values)
+            raise
+
+    async def flush_pending_writes(self):
+        """Сбрасывает все отложенные записи (активность, затем недоставки)"""
+        await self.flush_pending_users()
+        await self.flush_delivery_failures()
+
+    async def _flush_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_pending_writes()
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи активности пользователей: {e}")
+
+    def start_write_behind(self):
+        """Запускает периодическую запись буфера активности"""
+        interval = config.user_activity_flush_interval
+        if interval <= 0 or UserStorage._flush_task is not None:
+            return
+        UserStorage._flush_task = asyncio.create_task(self._flush_loop(interval))
+
+    async def stop_write_behind(self):
+        """Останавливает периодическую запись и сбрасывает буфер"""
+        task, UserStorage._flush_task = UserStorage._flush_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush_pending_writes()
+
+    @classmethod
+    def _remember_user(cls, user_id: int, username: Optional[str], first_name: Optional[str]):
+        """Кладет пользователя в LRU кэш"""
+        cls._recent_users[user_id] = (username, first_name)
+        cls._recent_users.move_to_end(user_id)
+        while len(cls._recent_users) > cls._recent_users_max:
+            cls._recent_users.popitem(last=False)
+
+    async def get_user_names(self, user_id: int) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """Возвращает (username, first_name): сначала из LRU кэша, затем из БД"""
+        cached = self._recent_users.get(user_id)
+        if cached is not None:
+            self._recent_users.move_to_end(user_id)
+            return cached
+
+        row = await self.get_user(user_id)
+        if row is None:
+            return None
+        self._remember_user(row[0], row[1], row[2])
+        return row[1], row[2]
+
+    async def note_delivery_failure(self, user_id: int, status: str):
+        """Запоминает недоставку (blocked/deactivated), запись в БД - пачками"""
+        failed_at = datetime.now().isoformat()
+        self._delivery_failures[user_id] = (status, failed_at)
+        pending = self._pending_users.get(user_id)
+        if pending is not None:
+            # Иначе отложенная запись активности вернула бы статус 'active'
+            pending[5], pending[6] = status, failed_at
+        if len(self._delivery_failures) >= DELIVERY_FAILURES_FLUSH_SIZE:
+            await self.flush_delivery_failures()
+
+    async def flush_delivery_failures(self) -> int:
+        """Записывает накопленные недоставки одной транзакцией"""
+        if not self._delivery_failures:
+            return 0
+        failures = list(self._delivery_failures.items())
+        self._delivery_failures.clear()
+        await self._write_delivery_failures(
+            [(status, failed_at, user_id) for user_id, (status, failed_at) in failures])
+        return len(failures)
+
+
+class SubmissionStorage(ABC):
+    """
+    Хранилище обратной связи: обращения, переписки и сообщения.
+    Строки обращений: (id, user_id, username, text_content, file_ids, status,
+    conversation_id, processed_at, viewed_at, created_at)
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Время вызовов бэкенда в метриках (bot_db_query_duration_seconds)
+        instrument_storage(cls, 'submissions')
+
+    @property
+    @abstractmethod
+    def is_connected(self) -> bool:
+        """Соединение с БД установлено"""
+
+    @abstractmethod
+    async def init(self):
+        """Открывает соединения и создает таблицы"""
+
+    @abstractmethod
+    async def close(self):
+        """Закрывает соединения"""
+
+    async def __aenter__(self):
+        await self.init()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @abstractmethod
+    async def add_submission(self, user_id: int, username: str, text: str,
+                             file_ids: Optional[List[str]] = None) -> int:
+        """Добавляет обращение с перепиской и первым сообщением, возвращает id"""
+
+    @abstractmethod
+    async def get_all_submissions(self, limit: int = 100, offset: int = 0):
+        """Обращения (новые сверху)"""
+
+    @abstractmethod
+    async def get_submissions_by_status(self, status: str, limit: int = 100, offset: int = 0):
+        """Обращения с указанным статусом"""
+
+    @abstractmethod
+    async def get_submissions_page(self, status: Optional[str] = None,
+                                   cursor: Optional[Sequence[Any]] = None,
+                                   direction: str = 'next', inclusive: bool = False,
+                                   limit: int = 10):
+        """Страница по курсору (created_at, id); к строке добавлены username из users
+        и признак блокировки (None, если бэкенд не может их получить)"""
+
+    @abstractmethod
+    async def count_submissions(self, status: Optional[str] = None) -> int:
+        """Количество обращений"""
+
+    @abstractmethod
+    async def recompute_counters(self) -> Dict[str, int]:
+        """Пересобирает счетчики по статусам"""
+
+    @abstractmethod
+    async def get_submission_by_id(self, submission_id: int):
+        """Обращение по ID или None"""
+
+    @abstractmethod
+    async def mark_as_viewed(self, submission_id: int):
+        """new -> viewed"""
+
+    @abstractmethod
+    async def mark_as_solved(self, submission_id: int):
+        """-> solved"""
+
+    @abstractmethod
+    async def save_admin_response(self, submission_id: int, admin_response: str, admin_id: int,
+                                  file_ids: Optional[List[str]] = None):
+        """Добавляет ответ администратора в переписку обращения"""
+
+    @abstractmethod
+    async def delete_submission(self, submission_id: int):
+        """Удаляет обращение"""
+
+    @abstractmethod
+    async def get_statistics(self) -> Dict[str, int]:
+        """{'total', 'new', 'solved', 'viewed'}"""
+
+    @abstractmethod
+    async def batch_update_status(self, submission_ids: List[int], status: str):
+        """Пакетная смена статуса"""
+
+    @abstractmethod
+    async def get_user_submissions(self, user_id: int, limit: int = 10):
+        """Последние обращения пользователя: (id, text_content, file_ids, status, created_at)"""
+
+    @abstractmethod
+    async def get_last_submission_time(self, user_id: int) -> Optional[str]:
+        """created_at последнего обращения пользователя"""
+
+    @abstractmethod
+    async def create_conversation(self, user_id: int) -> int:
+        """Создает переписку, возвращает id"""
+
+    @abstractmethod
+    async def add_message(self, conversation_id: int, sender_id: int, receiver_id: int,
+                          sender_role: str, text: str = "", file_ids: Optional[List[str]] = None,
+                          status: str = 'new'):
+        """Добавляет сообщение в переписку, возвращает id"""
+
+    @abstractmethod
+    async def get_conversation_by_id(self, conversation_id: int):
+        """Переписка по ID"""
+
+    @abstractmethod
+    async def get_user_conversations(self, user_id: int, limit: int = 20, offset: int = 0):
+        """Переписки пользователя"""
+
+    @abstractmethod
+    async def get_messages_in_conversation(self, conversation_id: int, limit: int = 50, offset: int = 0):
+        """Сообщения переписки"""
+
+    @abstractmethod
+    async def mark_message_as_read(self, message_id: int):
+        """Отмечает сообщение прочитанным"""
+
+    @abstractmethod
+    async def get_conversation_history(self, submission_id: int):
+        """(sender_role, text_content, file_ids, created_at) по переписке обращения"""
+
+    @abstractmethod
+    async def backup_and_clear_database(self) -> str:
+        """Сохраняет резервную копию и удаляет обращения; возвращает, где копия"""
+
+
+class BanStorage(ABC):
+    """Хранилище блокировок (прогрессивные: 24ч -> 7 дней -> навсегда)"""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Время вызовов бэкенда в метриках (bot_db_query_duration_seconds)
+        instrument_storage(cls, 'bans')
+
+    @abstractmethod
+    async def init(self):
+        """Открывает соединение и создает таблицы"""
+
+    @abstractmethod
+    async def close(self):
+        """Закрывает соединение"""
+
+    @abstractmethod
+    async def lookup(self, user_id: int) -> Optional['BanStatus']:
+        """Действующая блокировка или None"""
+
+    async def is_banned(self, user_id: int) -> bool:
+        """Проверка, заблокирован ли пользователь"""
+        return await self.lookup(user_id) is not None
+
+    async def get_ban_info(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Получение информации о блокировке"""
+        status = await self.lookup(user_id)
+        return status.to_dict() if status else None
+
+    @abstractmethod
+    async def ban_user(self, user_id: int, username: str, reason: str,
+                       banned_by: int, duration_hours: int = 24) -> Dict[str, Any]:
+        """Блокирует пользователя, возвращает ban_count/is_permanent/expires_at/duration_hours"""
+
+    @abstractmethod
+    async def unban_user(self, user_id: int) -> bool:
+        """Снимает блокировку"""
+
+    @abstractmethod
+    async def get_banned_list(self) -> List[Dict[str, Any]]:
+        """Все блокировки"""
+
+    @abstractmethod
+    async def cleanup_expired_bans(self) -> int:
+        """Удаляет истекшие блокировки, возвращает их число"""
+
+    @abstractmethod
+    async def get_ban_stats(self) -> Dict[str, Any]:
+        """{'total', 'permanent', 'temporary', 'today'}"""
+
+    @abstractmethod
+    def get_cache_stats(self) -> Dict[str, int]:
+        """{'size', 'hits', 'misses'} кэша блокировок"""
+
+
+# Общие методы интерфейсов (save_user, lookup через is_banned и т.д.)
+instrument_storage(UserStorage, 'users')
+instrument_storage(SubmissionStorage, 'submissions')
+instrument_storage(BanStorage, 'bans')
+
+
+def _postgres():
+    """Модуль PostgreSQL-бэкенда (asyncpg - необязательная зависимость)"""
+    if config.db_backend != BACKEND_POSTGRES:
+        return None
+    try:
+        from database import postgres
+    except ImportError as e:
+        raise RuntimeError(
+            "Для DB_BACKEND=postgres установите asyncpg: pip install asyncpg") from e
+    return postgres
+
+
+def get_user_storage() -> UserStorage:
+    """Хранилище пользователей выбранного бэкенда"""
+    postgres = _postgres()
+    if postgres is not None:
+        return postgres.PostgresUserDB()
+    from database.db import Database
+    return Database()
+
+
+def get_submission_storage() -> SubmissionStorage:
+    """Хранилище обратной связи выбранного бэкенда (Singleton)"""
+    postgres = _postgres()
+    if postgres is not None:
+        return postgres.PostgresSubmissionDB()
+    from database.submissions import SubmissionDB
+    return SubmissionDB()
+
+
+def get_ban_storage() -> BanStorage:
+    """Хранилище блокировок выбранного бэкенда (Singleton)"""
+    postgres = _postgres()
+    if postgres is not None:
+        return postgres.PostgresBannedDB()
+    from database.banned import BannedDB
+    return BannedDB()
+
+
+async def init_all():
+    """Создает таблицы всех хранилищ выбранного бэкенда"""
+    await get_user_storage().init_db()
+    await get_submission_storage().init()
+    await get_ban_storage().init()
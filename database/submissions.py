@@ -1,15 +1,35 @@
 import aiosqlite
 import json
 import logging
+from datetime import datetime
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional, List
-from config import DB_SUBMISSIONS_PATH
+from typing import AsyncIterator, Awaitable, Callable, Optional, List, Any, Dict, Sequence, Tuple
+from config import DB_SUBMISSIONS_PATH, config
+from database.db import ConnectionPool
+from database.storage import SubmissionStorage
 import asyncio
 
 logger = logging.getLogger(__name__)
 
+# Соединений только для чтения (WAL позволяет читать параллельно с записью)
+SUBMISSIONS_READERS = 4
 
-class SubmissionDB:
+# Групповой коммит: записи, накопившиеся в очереди, выполняются одной транзакцией.
+# Окно - доп. ожидание перед сбором пачки; 0 - без задержки для одиночных записей
+GROUP_COMMIT_WINDOW = 0.0  # секунды
+GROUP_COMMIT_MAX_OPS = 100
+
+# Операция записи: выполняется на соединении-писателе без commit
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+class SubmissionDB(SubmissionStorage):
+    """
+    БД обратной связи: одно соединение-писатель и небольшой пул читателей,
+    чтобы долгие чтения истории не задерживали сохранение новых обращений.
+    Записи от всех обработчиков собирает фоновая задача и коммитит пачками
+    """
     _instance = None  # Классовый атрибут для Singleton
 
     def __new__(cls):
@@ -20,7 +40,19 @@ class SubmissionDB:
     def __init__(self):
         if not hasattr(self, 'initialized'):
             self.db_path: Path = Path(DB_SUBMISSIONS_PATH)
-            self.connection: Optional[aiosqlite.Connection] = None
+            self.connection: Optional[aiosqlite.Connection] = None  # писатель
+            self._readers: Optional[ConnectionPool] = None
+            self._write_lock = asyncio.Lock()
+            self._init_lock = asyncio.Lock()
+            self._write_queue: "asyncio.Queue[Optional[Tuple[WriteOp, asyncio.Future]]]" = asyncio.Queue()
+            self._writer_task: Optional[asyncio.Task] = None
+            # Сброшено, пока резервное копирование переоткрывает соединения:
+            # чтения ждут его, записи копятся в очереди
+            self._available = asyncio.Event()
+            self._available.set()
+            # Метрики группового коммита
+            self.write_batches = 0
+            self.write_ops = 0
             self.ensure_db_directory()
             self.initialized = True
 
@@ -30,25 +62,164 @@ class SubmissionDB:
 
     async def init(self):
         """
-        Инициализирует соединение с БД
+        Инициализирует соединение-писатель, пул читателей и задачу записи
         """
+        if self.connection is not None and self._readers is not None and self._writer_task is not None:
+            return
+        async with self._init_lock:
+            await self._open()
+            if self._writer_task is None:
+                self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def _open(self):
+        """Открывает соединение-писатель и пул читателей (если еще не открыты)"""
         if self.connection is None:  # Если соединение ещё не создано
-            self.connection = await aiosqlite.connect(
+            connection = await aiosqlite.connect(
                 str(self.db_path),
                 timeout=30.0,
                 check_same_thread=False
             )
 
             # Оптимизации для высокой нагрузки
-            await self.connection.execute("PRAGMA journal_mode=WAL")
-            await self.connection.execute("PRAGMA synchronous=NORMAL")
-            await self.connection.execute("PRAGMA cache_size=10000")
-            await self.connection.execute("PRAGMA temp_store=MEMORY")
+            await connection.execute("PRAGMA journal_mode=WAL")
+            await connection.execute("PRAGMA synchronous=NORMAL")
+            await connection.execute("PRAGMA cache_size=10000")
+            await connection.execute("PRAGMA temp_store=MEMORY")
             # 256MB
-            await self.connection.execute("PRAGMA mmap_size=268435456")
+            await connection.execute("PRAGMA mmap_size=268435456")
 
+            self.connection = connection
             await self._create_tables()
 
+        if self._readers is None:
+            self._readers = ConnectionPool(
+                str(self.db_path), max_size=SUBMISSIONS_READERS, read_only=True)
+
+    async def _close_connections(self):
+        """Закрывает пул читателей и соединение-писатель"""
+        readers, self._readers = self._readers, None
+        if readers is not None:
+            await readers.close()
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await connection.close()
+
+    @property
+    def is_connected(self) -> bool:
+        return (self.connection is not None or not self._available.is_set()) \
+            and self._writer_task is not None
+
+    def _check_open(self):
+        """Ошибка, если БД не открыта (на время резервного копирования - открыта)"""
+        if self.connection is None and self._available.is_set():
+            raise RuntimeError("Соединение с БД не инициализировано")
+
+    async def _write(self, op: WriteOp) -> Any:
+        """Ставит операцию в очередь записи и ждет ее коммита; возвращает результат op"""
+        self._check_open()
+        if self._writer_task is None:
+            raise RuntimeError("Соединение с БД не инициализировано")
+        future = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((op, future))
+        return await future
+
+    async def _writer_loop(self):
+        """Собирает операции записи за короткое окно и коммитит их одной транзакцией"""
+        while True:
+            item = await self._write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            await asyncio.sleep(GROUP_COMMIT_WINDOW)
+            stop = False
+            while len(batch) < GROUP_COMMIT_MAX_OPS:
+                try:
+                    item = self._write_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                await self._run_batch(batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка группового коммита: {e}")
+            if stop:
+                return
+
+    async def _run_batch(self, batch: List[Tuple[WriteOp, asyncio.Future]]):
+        """
+        Выполняет пачку операций в одной транзакции. Каждая операция - в своем
+        SAVEPOINT, поэтому ошибка одной не откатывает остальные
+        """
+        async with self._write_lock:
+            conn = self.connection
+            if conn is None:
+                error = RuntimeError("Соединение с БД не инициализировано")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+
+            results: List[Tuple[asyncio.Future, Any, Optional[BaseException]]] = []
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+                for op, future in batch:
+                    if future.cancelled():
+                        continue
+                    await conn.execute("SAVEPOINT write_op")
+                    try:
+                        result = await op(conn)
+                    except Exception as e:
+                        await conn.execute("ROLLBACK TO write_op")
+                        await conn.execute("RELEASE write_op")
+                        results.append((future, None, e))
+                    else:
+                        await conn.execute("RELEASE write_op")
+                        results.append((future, result, None))
+                await conn.commit()
+            except Exception as e:
+                try:
+                    await conn.rollback()
+                except Exception:
+                    pass
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            self.write_batches += 1
+            self.write_ops += len(results)
+            for future, result, error in results:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def get_write_stats(self) -> Dict[str, float]:
+        """Метрики группового коммита"""
+        return {
+            'batches': self.write_batches,
+            'ops': self.write_ops,
+            'ops_per_batch': self.write_ops / self.write_batches if self.write_batches else 0.0,
+            'queued': self._write_queue.qsize()
+        }
+
+    @asynccontextmanager
+    async def _reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Соединение из пула читателей (во время резервного копирования ждет его окончания)"""
+        await self._available.wait()
+        if self._readers is None:
+            raise RuntimeError("Соединение с БД не инициализировано")
+        conn = await self._readers.acquire()
+        try:
+            yield conn
+        finally:
+            await self._readers.release(conn)
+
     async def _create_tables(self):
         """Создает таблицы для обратной связи и истории переписки"""
         if self.connection is None:
@@ -70,6 +241,53 @@ class SubmissionDB:
             )
         ''')
 
+        # Индексы для постраничного просмотра (keyset по created_at, id) и счетчиков
+        await self.connection.execute('CREATE INDEX IF NOT EXISTS idx_submissions_created ON submissions(created_at, id)')
+        await self.connection.execute('CREATE INDEX IF NOT EXISTS idx_submissions_status_created ON submissions(status, created_at, id)')
+        # История пользователя и число его обращений в поиске пользователей
+        await self.connection.execute('CREATE INDEX IF NOT EXISTS idx_submissions_user ON submissions(user_id, created_at)')
+
+        # Счетчики записей по статусам. Обновляются триггерами в той же
+        # транзакции, что и изменение submissions
+        async with self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'submission_counters'"
+        ) as cursor:
+            counters_exist = await cursor.fetchone() is not None
+        await self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS submission_counters (
+                status TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_submissions_count_insert
+            AFTER INSERT ON submissions
+            BEGIN
+                INSERT INTO submission_counters (status, count) VALUES (NEW.status, 1)
+                ON CONFLICT(status) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_submissions_count_delete
+            AFTER DELETE ON submissions
+            BEGIN
+                UPDATE submission_counters SET count = count - 1 WHERE status = OLD.status;
+            END
+        ''')
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_submissions_count_update
+            AFTER UPDATE OF status ON submissions
+            WHEN OLD.status IS NOT NEW.status
+            BEGIN
+                UPDATE submission_counters SET count = count - 1 WHERE status = OLD.status;
+                INSERT INTO submission_counters (status, count) VALUES (NEW.status, 1)
+                ON CONFLICT(status) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        if not counters_exist:
+            # БД создана до появления счетчиков - заполняем по текущим данным
+            await self._recompute_counters()
+
         # Новая таблица для переписок (логическая цепочка сообщений)
         await self.connection.execute('''
             CREATE TABLE IF NOT EXISTS conversations (
@@ -107,13 +325,14 @@ class SubmissionDB:
 
     async def add_submission(self, user_id: int, username: str, text: str, file_ids: Optional[List[str]] = None):
         """Добавляет заявку в БД и создает переписку"""
-        if self.connection is None:
+        if self.connection is None and self._available.is_set():
             logger.error("❌ Соединение с БД не инициализировано!")
             raise RuntimeError("Соединение с БД не инициализировано")
         if file_ids is None:
             file_ids = []
-        try:
-            async with self.connection.cursor() as cursor:
+
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
                 # Создаем новую переписку
                 await cursor.execute(
                     'INSERT INTO conversations (user_id) VALUES (?)',
@@ -137,20 +356,20 @@ class SubmissionDB:
                     (conversation_id, user_id, 0, 'user',
                      text, json.dumps(file_ids), 'new')
                 )
-
-                await self.connection.commit()
                 return submission_id
+
+        try:
+            return await self._write(op)
         except Exception as e:
             logger.error(f"❌ Ошибка при добавлении записи: {e}")
             raise
 
     async def get_all_submissions(self, limit: int = 100, offset: int = 0):
         """Получает записи из БД с пагинацией"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         try:
-            async with self.connection.cursor() as cursor:
+            async with self._reader() as conn, conn.cursor() as cursor:
                 await cursor.execute(
                     'SELECT * FROM submissions ORDER BY created_at DESC LIMIT ? OFFSET ?',
                     (limit, offset)
@@ -163,11 +382,10 @@ class SubmissionDB:
 
     async def get_submissions_by_status(self, status: str, limit: int = 100, offset: int = 0):
         """Получает записи по статусу с пагинацией"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         try:
-            async with self.connection.cursor() as cursor:
+            async with self._reader() as conn, conn.cursor() as cursor:
                 await cursor.execute(
                     'SELECT * FROM submissions WHERE status = ? ORDER BY created_at DESC LIMIT ? OFFSET ?',
                     (status, limit, offset)
@@ -178,13 +396,98 @@ class SubmissionDB:
             logger.error(f"❌ Ошибка при получении записей по статусу: {e}")
             raise
 
+    async def get_submissions_page(self, status: Optional[str] = None,
+                                   cursor: Optional[Sequence[Any]] = None,
+                                   direction: str = 'next', inclusive: bool = False,
+                                   limit: int = 10):
+        """
+        Страница записей (новые сверху) по курсору (created_at, id).
+        direction='next' - записи старше курсора, 'prev' - новее курсора.
+        inclusive=True включает саму запись курсора (перерисовка текущей страницы).
+        К колонкам submissions добавляются актуальный username из users и признак
+        блокировки; без единой БД оба значения NULL
+        """
+        self._check_open()
+
+        conditions = []
+        params: List[Any] = []
+        if status is not None:
+            conditions.append('s.status = ?')
+            params.append(status)
+        if cursor is not None:
+            if direction == 'prev':
+                op = '>=' if inclusive else '>'
+            else:
+                op = '<=' if inclusive else '<'
+            conditions.append(f'(s.created_at, s.id) {op} (?, ?)')
+            params.extend([cursor[0], cursor[1]])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'ASC' if direction == 'prev' else 'DESC'
+
+        try:
+            async with self._reader() as conn, conn.cursor() as db_cursor:
+                if config.unified_storage:
+                    # Один запрос вместо обращения к трем файлам
+                    query = f'''
+                        SELECT s.*, u.username,
+                               b.user_id IS NOT NULL AND (b.is_permanent OR b.expires_at IS NULL OR b.expires_at > ?)
+                        FROM submissions s
+                        LEFT JOIN users u ON u.user_id = s.user_id
+                        LEFT JOIN banned_users b ON b.user_id = s.user_id
+                        {where} ORDER BY s.created_at {order}, s.id {order} LIMIT ?'''
+                    params = [datetime.now().isoformat()] + params
+                else:
+                    query = f'SELECT s.*, NULL, NULL FROM submissions s {where} ORDER BY s.created_at {order}, s.id {order} LIMIT ?'
+                await db_cursor.execute(query, params + [limit])
+                rows = list(await db_cursor.fetchall())
+                if direction == 'prev':
+                    rows.reverse()
+                return rows
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении страницы записей: {e}")
+            raise
+
+    async def count_submissions(self, status: Optional[str] = None) -> int:
+        """Количество записей (из таблицы счетчиков)"""
+        self._check_open()
+
+        async with self._reader() as conn, conn.cursor() as cursor:
+            if status is None:
+                await cursor.execute('SELECT COALESCE(SUM(count), 0) FROM submission_counters')
+            else:
+                await cursor.execute(
+                    'SELECT count FROM submission_counters WHERE status = ?', (status,))
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+    async def _recompute_counters(self):
+        """Пересчитывает счетчики по статусам из submissions (без commit)"""
+        self._check_open()
+
+        await self.connection.execute('DELETE FROM submission_counters')
+        await self.connection.execute(
+            '''INSERT INTO submission_counters (status, count)
+            SELECT status, COUNT(*) FROM submissions WHERE status IS NOT NULL GROUP BY status'''
+        )
+
+    async def recompute_counters(self) -> Dict[str, int]:
+        """Пересобирает счетчики с нуля (если данные правили в обход бота)"""
+        self._check_open()
+
+        async def op(conn: aiosqlite.Connection):
+            await self._recompute_counters()
+
+        await self._write(op)
+        stats = await self.get_statistics()
+        logger.info(f"🔄 Счетчики обращений пересчитаны: {stats}")
+        return stats
+
     async def get_submission_by_id(self, submission_id: int):
         """Получает запись по ID"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         try:
-            async with self.connection.cursor() as cursor:
+            async with self._reader() as conn, conn.cursor() as cursor:
                 await cursor.execute(
                     'SELECT * FROM submissions WHERE id = ?',
                     (submission_id,)
@@ -197,48 +500,50 @@ class SubmissionDB:
 
     async def mark_as_viewed(self, submission_id: int):
         """Отмечает запись как просмотренную"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
-        try:
-            async with self.connection.cursor() as cursor:
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
                 await cursor.execute(
                     '''UPDATE submissions 
                     SET status = 'viewed', viewed_at = CURRENT_TIMESTAMP 
                     WHERE id = ? AND status = 'new' ''',
                     (submission_id,)
                 )
-                await self.connection.commit()
+
+        try:
+            return await self._write(op)
         except Exception as e:
             logger.error(f"❌ Ошибка при отметке как просмотренной: {e}")
             raise
 
     async def mark_as_solved(self, submission_id: int):
         """Отмечает запись как решенную"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
-        try:
-            async with self.connection.cursor() as cursor:
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
                 await cursor.execute(
                     '''UPDATE submissions 
                     SET status = 'solved', processed_at = CURRENT_TIMESTAMP 
                     WHERE id = ?''',
                     (submission_id,)
                 )
-                await self.connection.commit()
+
+        try:
+            return await self._write(op)
         except Exception as e:
             logger.error(f"❌ Ошибка при отметке как решенной: {e}")
             raise
 
     async def save_admin_response(self, submission_id: int, admin_response: str, admin_id: int, file_ids: Optional[List[str]] = None):
         """Сохраняет ответ администратора в переписку (текст и файлы)"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
         if file_ids is None:
             file_ids = []
-        try:
-            async with self.connection.cursor() as cursor:
+
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
                 # Получаем conversation_id из submissions
                 await cursor.execute(
                     'SELECT conversation_id, user_id FROM submissions WHERE id = ?',
@@ -263,65 +568,51 @@ class SubmissionDB:
                     'UPDATE conversations SET last_message_at = CURRENT_TIMESTAMP WHERE id = ?',
                     (conversation_id,)
                 )
+                return conversation_id
 
-                await self.connection.commit()
-                logger.info(
-                    f"✅ Ответ администратора сохранен в переписку {conversation_id}")
+        try:
+            conversation_id = await self._write(op)
+            logger.info(
+                f"✅ Ответ администратора сохранен в переписку {conversation_id}")
         except Exception as e:
             logger.error(f"❌ Ошибка при сохранении ответа администратора: {e}")
             raise
 
     async def delete_submission(self, submission_id: int):
         """Удаляет запись"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         logger.info(f"🗑️ Удаление записи {submission_id}...")
-        try:
-            async with self.connection.cursor() as cursor:
+
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
                 await cursor.execute(
                     'DELETE FROM submissions WHERE id = ?',
                     (submission_id,)
                 )
-                await self.connection.commit()
-                logger.info(f"✅ Запись {submission_id} удалена")
+
+        try:
+            await self._write(op)
+            logger.info(f"✅ Запись {submission_id} удалена")
         except Exception as e:
             logger.error(f"❌ Ошибка при удалении записи: {e}")
             raise
 
     async def get_statistics(self):
         """Получает статистику по записям"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         logger.info("📊 Получение статистики...")
         try:
-            async with self.connection.cursor() as cursor:
-                # Общее количество
-                await cursor.execute('SELECT COUNT(*) FROM submissions')
-                total_row = await cursor.fetchone()
-                total = total_row[0] if total_row else 0
-
-                # Новые
-                await cursor.execute("SELECT COUNT(*) FROM submissions WHERE status = 'new'")
-                new_row = await cursor.fetchone()
-                new_count = new_row[0] if new_row else 0
-
-                # Решенные
-                await cursor.execute("SELECT COUNT(*) FROM submissions WHERE status = 'solved'")
-                solved_row = await cursor.fetchone()
-                solved_count = solved_row[0] if solved_row else 0
-
-                # Просмотренные
-                await cursor.execute("SELECT COUNT(*) FROM submissions WHERE status = 'viewed'")
-                viewed_row = await cursor.fetchone()
-                viewed_count = viewed_row[0] if viewed_row else 0
+            async with self._reader() as conn, conn.cursor() as cursor:
+                await cursor.execute('SELECT status, count FROM submission_counters')
+                counts = {status: count for status, count in await cursor.fetchall()}
 
                 stats = {
-                    'total': total,
-                    'new': new_count,
-                    'solved': solved_count,
-                    'viewed': viewed_count
+                    'total': sum(counts.values()),
+                    'new': counts.get('new', 0),
+                    'solved': counts.get('solved', 0),
+                    'viewed': counts.get('viewed', 0)
                 }
 
                 logger.info(f"📊 Статистика: {stats}")
@@ -332,14 +623,13 @@ class SubmissionDB:
 
     async def batch_update_status(self, submission_ids: List[int], status: str):
         """Пакетное обновление статуса записей"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         if not submission_ids:
             return
 
-        try:
-            async with self.connection.cursor() as cursor:
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
                 placeholders = ','.join(['?' for _ in submission_ids])
                 timestamp_field = 'viewed_at' if status == 'viewed' else 'processed_at'
 
@@ -349,19 +639,31 @@ class SubmissionDB:
                     WHERE id IN ({placeholders})''',
                     [status] + submission_ids
                 )
-                await self.connection.commit()
+
+        try:
+            return await self._write(op)
         except Exception as e:
             logger.error(f"❌ Ошибка при пакетном обновлении: {e}")
             raise
 
+    async def get_user_submissions(self, user_id: int, limit: int = 10):
+        """Последние обращения пользователя: (id, text_content, file_ids, status, created_at)"""
+        self._check_open()
+
+        async with self._reader() as conn, conn.cursor() as cursor:
+            await cursor.execute(
+                'SELECT id, text_content, file_ids, status, created_at FROM submissions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?',
+                (user_id, limit)
+            )
+            return list(await cursor.fetchall())
+
     async def get_last_submission_time(self, user_id: int) -> Optional[str]:
         """
         Возвращает дату и время последней отправки обращения пользователем (по created_at).
         """
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
         try:
-            async with self.connection.cursor() as cursor:
+            async with self._reader() as conn, conn.cursor() as cursor:
                 await cursor.execute(
                     'SELECT created_at FROM submissions WHERE user_id = ? ORDER BY created_at DESC LIMIT 1',
                     (user_id,)
@@ -374,92 +676,91 @@ class SubmissionDB:
             return None
 
     async def close(self):
-        """Закрывает соединение с БД"""
-        if hasattr(self, 'connection') and self.connection:
-            await self.connection.close()
+        """Дописывает очередь записи и закрывает соединения с БД"""
+        task, self._writer_task = self._writer_task, None
+        if task is not None:
+            await self._write_queue.put(None)
+            await task
+        was_open = self.connection is not None
+        await self._close_connections()
+        if was_open:
             logger.info("🔌 Соединение с БД закрыто")
 
-    async def __aenter__(self):
-        await self.init()
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.close()
-
     # Методы для работы с новой структурой
     async def create_conversation(self, user_id: int) -> int:
         """Создать новую переписку и вернуть её id"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(
-                'INSERT INTO conversations (user_id) VALUES (?)',
-                (user_id,)
-            )
-            await self.connection.commit()
-            lastrowid = cursor.lastrowid
-            if lastrowid is None:
-                raise RuntimeError("Не удалось получить id новой переписки")
-            return lastrowid
+        self._check_open()
+
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    'INSERT INTO conversations (user_id) VALUES (?)',
+                    (user_id,)
+                )
+                return cursor.lastrowid
+
+        lastrowid = await self._write(op)
+        if lastrowid is None:
+            raise RuntimeError("Не удалось получить id новой переписки")
+        return lastrowid
 
     async def add_message(self, conversation_id: int, sender_id: int, receiver_id: int, sender_role: str, text: str = "", file_ids: Optional[List[str]] = None, status: str = 'new'):
         """Добавить сообщение в переписку"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
         if file_ids is None:
             file_ids = []
         file_ids_json = json.dumps(file_ids)
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(
-                '''INSERT INTO messages (conversation_id, sender_id, receiver_id, sender_role, text_content, file_ids, status) \
-                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (conversation_id, sender_id, receiver_id,
-                 sender_role, text, file_ids_json, status)
-            )
-            await self.connection.commit()
-            # Обновляем last_message_at в conversations
-            await cursor.execute(
-                'UPDATE conversations SET last_message_at = CURRENT_TIMESTAMP WHERE id = ?',
-                (conversation_id,)
-            )
-            await self.connection.commit()
-            return cursor.lastrowid
+
+        async def op(conn: aiosqlite.Connection):
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    '''INSERT INTO messages (conversation_id, sender_id, receiver_id, sender_role, text_content, file_ids, status) \
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (conversation_id, sender_id, receiver_id,
+                     sender_role, text, file_ids_json, status)
+                )
+                message_id = cursor.lastrowid
+                # Обновляем last_message_at в conversations (в той же транзакции)
+                await cursor.execute(
+                    'UPDATE conversations SET last_message_at = CURRENT_TIMESTAMP WHERE id = ?',
+                    (conversation_id,)
+                )
+                return message_id
+
+        return await self._write(op)
 
     async def get_conversation_by_id(self, conversation_id: int):
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
-        async with self.connection.cursor() as cursor:
+        self._check_open()
+        async with self._reader() as conn, conn.cursor() as cursor:
             await cursor.execute('SELECT * FROM conversations WHERE id = ?', (conversation_id,))
             return await cursor.fetchone()
 
     async def get_user_conversations(self, user_id: int, limit: int = 20, offset: int = 0):
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
-        async with self.connection.cursor() as cursor:
+        self._check_open()
+        async with self._reader() as conn, conn.cursor() as cursor:
             await cursor.execute('SELECT * FROM conversations WHERE user_id = ? ORDER BY last_message_at DESC LIMIT ? OFFSET ?', (user_id, limit, offset))
             return await cursor.fetchall()
 
     async def get_messages_in_conversation(self, conversation_id: int, limit: int = 50, offset: int = 0):
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
-        async with self.connection.cursor() as cursor:
+        self._check_open()
+        async with self._reader() as conn, conn.cursor() as cursor:
             await cursor.execute('SELECT * FROM messages WHERE conversation_id = ? ORDER BY created_at ASC LIMIT ? OFFSET ?', (conversation_id, limit, offset))
             return await cursor.fetchall()
 
     async def mark_message_as_read(self, message_id: int):
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
-        async with self.connection.cursor() as cursor:
-            await cursor.execute('UPDATE messages SET status = "read" WHERE id = ?', (message_id,))
-            await self.connection.commit()
+        self._check_open()
+
+        async def op(conn: aiosqlite.Connection):
+            await conn.execute('UPDATE messages SET status = "read" WHERE id = ?', (message_id,))
+
+        await self._write(op)
 
     async def get_conversation_history(self, submission_id: int):
         """Получает историю переписки для обращения"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         try:
-            async with self.connection.cursor() as cursor:
+            async with self._reader() as conn, conn.cursor() as cursor:
                 # Получаем conversation_id из submissions
                 await cursor.execute(
                     'SELECT conversation_id FROM submissions WHERE id = ?',
@@ -487,42 +788,52 @@ class SubmissionDB:
 
     async def backup_and_clear_database(self):
         """Создает резервную копию БД и очищает все сообщения"""
-        if self.connection is None:
-            raise RuntimeError("Соединение с БД не инициализировано")
+        self._check_open()
 
         try:
             import shutil
-            from datetime import datetime
-
-            # Закрываем текущее соединение
-            await self.connection.close()
-            self.connection = None
-
-            # Создаем имя файла резервной копии с текущей датой
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = self.db_path.parent / \
-                f"submissions_backup_{timestamp}.db"
-
-            # Копируем файл БД
-            shutil.copy2(str(self.db_path), str(backup_path))
-            logger.info(f"✅ Резервная копия создана: {backup_path}")
-
-            # Пересоздаем соединение
-            await self.init()
-            if self.connection is None:
-                self.connection = await aiosqlite.connect(
-                    str(self.db_path),
-                    timeout=30.0,
-                    check_same_thread=False
-                )
-                await self._create_tables()
-
-            # Очищаем все сообщения и переписки
-            async with self.connection.cursor() as cursor:
-                await cursor.execute('DELETE FROM messages')
-                await cursor.execute('DELETE FROM conversations')
-                await cursor.execute('DELETE FROM submissions')
-                await self.connection.commit()
+
+            # Групповые коммиты ждут, пока идет копирование и очистка: новые записи
+            # копятся в очереди, чтения ждут _available
+            async with self._write_lock:
+                self._available.clear()
+                try:
+                    # Закрываем текущие соединения (последнее закрытие сбрасывает WAL в файл)
+                    await self._close_connections()
+
+                    # Создаем имя файла резервной копии с текущей датой
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    backup_path = self.db_path.parent / \
+                        f"submissions_backup_{timestamp}.db"
+
+                    if config.unified_storage:
+                        # Файл открыт и другими БД - согласованный снимок через VACUUM INTO
+                        await self._open()
+                        if self.connection is None:
+                            raise RuntimeError("Соединение с БД не инициализировано")
+                        await self.connection.execute("VACUUM INTO ?", (str(backup_path),))
+                    else:
+                        # Копируем файл БД
+                        shutil.copy2(str(self.db_path), str(backup_path))
+                    logger.info(f"✅ Резервная копия создана: {backup_path}")
+
+                    # Пересоздаем соединения
+                    await self._open()
+                    if self.connection is None:
+                        raise RuntimeError("Соединение с БД не инициализировано")
+
+                    # Очищаем все сообщения и переписки
+                    async with self.connection.cursor() as cursor:
+                        await cursor.execute('DELETE FROM messages')
+                        await cursor.execute('DELETE FROM conversations')
+                        await cursor.execute('DELETE FROM submissions')
+                        await self.connection.commit()
+                finally:
+                    # Соединения нужны и после ошибки; ожидающие чтения продолжают
+                    try:
+                        await self._open()
+                    finally:
+                        self._available.set()
 
             logger.info("✅ Все сообщения и переписки очищены")
             return str(backup_path)
@@ -2,35 +2,39 @@ from aiogram import Router, F, Bot, types
 from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto, InputMediaDocument, MediaUnion
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database import Database
+from database import get_user_storage, get_submission_storage
 from keyboards import get_admin_keyboard, get_bans_keyboard, get_ban_user_keyboard, get_unban_user_keyboard
 from config import FILES_DIR, BOT_VERSION, ADMIN_IDS
-from utils.checks import is_user_banned, ban_user, unban_user, get_ban_info, get_banned_db
+from utils.checks import get_ban_status, ban_user, unban_user, get_banned_db, get_delivery_status
+from utils.broadcast import start_broadcast
+from metrics import ALL_HANDLERS, slow_handlers
 from datetime import datetime
 import os
 import csv
 import logging
-import asyncio
 from aiogram.types import ReplyKeyboardRemove
-from database.submissions import SubmissionDB
 import json
-from typing import Union, Optional, Any, Sequence, cast
+from typing import Union, Optional, Any, List, Sequence, cast
 import platform
 
 router = Router()
 logger = logging.getLogger(__name__)
 try:
-    db = Database()
+    db = get_user_storage()
 except Exception as e:
     db = None
-    logger.error(f"Ошибка инициализации Database: {e}")
-submission_db = SubmissionDB()
+    logger.error(f"Ошибка инициализации хранилища пользователей: {e}")
+submission_db = get_submission_storage()
 
 
 class BroadcastState(StatesGroup):
     waiting_message = State()
 
 
+# Записей на одной странице списка обратной связи
+SUBMISSIONS_PAGE_SIZE = 10
+
+
 class SubmissionsViewState(StatesGroup):
     viewing_list = State()
     viewing_detail = State()
@@ -65,15 +69,36 @@ async def stats_handler(message: Message):
 
     stats_text = f"📊 Статистика (v{BOT_VERSION}):\n"
     stats_text += f"🖥️ Сервер: {hostname}\n"
-    stats_text += f"👥 Пользователей: {stats[0]}\n\n"
+    stats_text += f"👥 Пользователей: {stats[0]}\n"
+    stats_text += f"📬 Доступны для рассылки: {stats[2]}\n\n"
     stats_text += "⚡ Последние активные:\n"
 
     for user in stats[1]:
         stats_text += f"- {user[0]} (@{user[1]}) - {user[2][:10]}\n"
 
+    stats_text += format_handler_timings()
+
     await message.answer(stats_text)
 
 
+def format_handler_timings(limit: int = 5) -> str:
+    """Перцентили времени обработчиков и самые медленные из них, мс"""
+    if not ALL_HANDLERS.count:
+        return ""
+
+    def ms(histogram, percent):
+        return f"{histogram.percentile(percent) * 1000:.1f}"
+
+    text = "\n⏱ Время обработчиков (p50/p95/p99, мс):\n"
+    text += (f"Все: {ms(ALL_HANDLERS, 50)}/{ms(ALL_HANDLERS, 95)}/{ms(ALL_HANDLERS, 99)} "
+             f"(вызовов: {ALL_HANDLERS.count})\n")
+    text += "🐢 Самые медленные (по p95):\n"
+    for name, histogram in slow_handlers(limit):
+        text += (f"- {name}: {ms(histogram, 50)}/{ms(histogram, 95)}/{ms(histogram, 99)}, "
+                 f"max {histogram.max * 1000:.1f} ({histogram.count})\n")
+    return text
+
+
 @router.message(F.text == '🔄 Версия бота')
 async def version_handler(message: Message):
     """Показ версии бота"""
@@ -344,24 +369,20 @@ async def handle_submissions_callback(callback: CallbackQuery, state: FSMContext
 
         await submission_db.init()
 
-        if action == "all":
-            submissions = await submission_db.get_all_submissions()
-            status_filter = "all"
-        elif action in ["new", "solved", "viewed"]:
-            submissions = await submission_db.get_submissions_by_status(action)
-            status_filter = action
-        else:
+        if action not in ["all", "new", "solved", "viewed"]:
             await callback.answer("❌ Неизвестное действие")
             return
 
-        if not submissions:
+        status_filter = action
+        if not await submission_db.count_submissions(None if action == "all" else action):
             await callback.answer(f"📭 Нет сообщений в категории '{action}'", reply_markup=get_admin_keyboard())
             return
 
-        # Показываем список сообщений (первые 10)
-        await show_submissions_list(callback, submissions[:10], 0, status_filter)
+        # В FSM храним только фильтр и курсор страницы, записи читаются из БД
         await state.set_state(SubmissionsViewState.viewing_list)
-        await state.update_data(submissions=submissions, current_page=0, status_filter=status_filter)
+        await state.update_data(status_filter=status_filter, current_page=0,
+                                page_first=None, page_last=None)
+        await show_submissions_page(callback, state, "first")
 
     except Exception as e:
         logger.error(f"Ошибка при обработке submissions callback: {e}")
@@ -426,13 +447,56 @@ async def handle_cancel_clear_db(callback: CallbackQuery):
     await callback.answer("❌ Очистка БД отменена")
 
 
-async def show_submissions_list(message: Union[Message, CallbackQuery, Any], submissions: list, page: int, status_filter: str):
-    """Показывает список предложенных сообщений"""
-    total_pages = (len(submissions) - 1) // 10 + 1
-    start_idx = page * 10
-    end_idx = min(start_idx + 10, len(submissions))
+async def show_submissions_page(message: Union[Message, CallbackQuery, Any], state: FSMContext, move: str = "current"):
+    """
+    Загружает страницу обращений по курсору из FSM и показывает ее.
+    move: first / next / prev / current (перерисовать текущую страницу)
+    """
+    user_data = await state.get_data()
+    status_filter = user_data.get('status_filter', 'all')
+    status = None if status_filter == "all" else status_filter
+    page = user_data.get('current_page', 0)
+    page_first = user_data.get('page_first')
+    page_last = user_data.get('page_last')
+
+    await submission_db.init()
+    rows = []
+    if move == "next" and page_last:
+        rows = await submission_db.get_submissions_page(
+            status, page_last, "next", limit=SUBMISSIONS_PAGE_SIZE)
+        page += 1
+    elif move == "prev" and page_first and page > 0:
+        rows = await submission_db.get_submissions_page(
+            status, page_first, "prev", limit=SUBMISSIONS_PAGE_SIZE)
+        page -= 1
+        # Сверху появились новые записи - проще начать с первой страницы
+        if len(rows) < SUBMISSIONS_PAGE_SIZE:
+            rows = []
+    elif move == "current" and page_first:
+        rows = await submission_db.get_submissions_page(
+            status, page_first, "next", inclusive=True, limit=SUBMISSIONS_PAGE_SIZE)
+
+    if not rows:
+        page = 0
+        rows = await submission_db.get_submissions_page(
+            status, limit=SUBMISSIONS_PAGE_SIZE)
+
+    total = await submission_db.count_submissions(status)
+    # Курсор: (created_at, id) первой и последней записи на странице
+    await state.update_data(
+        current_page=page,
+        page_first=[rows[0][9], rows[0][0]] if rows else None,
+        page_last=[rows[-1][9], rows[-1][0]] if rows else None
+    )
+    await show_submissions_list(message, rows, page, status_filter, total)
+
+
+async def show_submissions_list(message: Union[Message, CallbackQuery, Any], submissions: list, page: int, status_filter: str, total: int):
+    """Показывает страницу предложенных сообщений"""
+    total_pages = max(1, (total - 1) // SUBMISSIONS_PAGE_SIZE + 1)
+    has_next = page * SUBMISSIONS_PAGE_SIZE + len(submissions) < total
 
-    response = f"📋 Обратная связь ({len(submissions)} шт.)\n"
+    response = f"📋 Обратная связь ({total} шт.)\n"
     if status_filter != "all":
         status_names = {"new": "🆕 Новые",
                         "solved": "✅ Решенные", "viewed": "👁️ Просмотренные"}
@@ -444,28 +508,32 @@ async def show_submissions_list(message: Union[Message, CallbackQuery, Any], sub
     keyboard_buttons = []
 
     # Кнопки для каждой идеи
-    for i, submission in enumerate(submissions[start_idx:end_idx], start_idx + 1):
-        id_, user_id, username, text, file_ids, status, admin_response, processed_at, viewed_at, created_at = submission
+    for i, submission in enumerate(submissions, page * SUBMISSIONS_PAGE_SIZE + 1):
+        id_, user_id, username, text, file_ids, status, admin_response, processed_at, viewed_at, created_at, current_username, is_banned = submission
         text_preview = text[:30] + "..." if len(text) > 30 else text
         status_emoji = {"new": "🆕", "viewed": "👁️", "solved": "✅"}
         status_display = status_emoji.get(status, "❓")
+        # В единой БД признак пришел из JOIN, иначе - из кэша блокировок
+        if is_banned is None:
+            is_banned = await get_ban_status(user_id) is not None
+        ban_badge = "🚫 " if is_banned else ""
         keyboard_buttons.append([
             InlineKeyboardButton(
-                text=f"{status_display} {i}. @{username}: {text_preview}",
+                text=f"{status_display} {i}. {ban_badge}@{current_username or username}: {text_preview}",
                 callback_data=f"view_{id_}"
             )
         ])
 
-    if total_pages > 1:
+    if page > 0 or has_next:
         nav_row = []
         if page > 0:
             nav_row.append(InlineKeyboardButton(
-                text="◀️ Назад", callback_data=f"page_{page-1}"))
+                text="◀️ Назад", callback_data="page_prev"))
         nav_row.append(InlineKeyboardButton(
             text=f"{page+1}/{total_pages}", callback_data="page_info"))
-        if page < total_pages - 1:
+        if has_next:
             nav_row.append(InlineKeyboardButton(
-                text="Вперед ▶️", callback_data=f"page_{page+1}"))
+                text="Вперед ▶️", callback_data="page_next"))
         keyboard_buttons.append(nav_row)
 
     keyboard_buttons.append([InlineKeyboardButton(
@@ -499,18 +567,16 @@ async def handle_page_navigation(callback: CallbackQuery, state: FSMContext):
             await callback.answer("❌ Ошибка данных")
             return
 
-        user_data = await state.get_data()
-        submissions = user_data.get('submissions', [])
-        status_filter = user_data.get('status_filter', 'all')
-
         if callback.data == "page_info":
             await callback.answer("Информация о странице")
             return
 
-        page = int(callback.data.split("_")[1])
-        await state.update_data(current_page=page)
+        move = callback.data.split("_")[1]
+        if move not in ("next", "prev"):
+            await callback.answer("❌ Ошибка данных")
+            return
 
-        await show_submissions_list(callback, submissions, page, status_filter)
+        await show_submissions_page(callback, state, move)
 
     except Exception as e:
         logger.error(f"Ошибка при навигации по страницам: {e}")
@@ -790,25 +856,14 @@ async def handle_confirm_delete(callback: CallbackQuery, state: FSMContext):
 
         # Возвращаемся к списку
         await state.set_state(SubmissionsViewState.viewing_list)
-        user_data = await state.get_data()
-        submissions = user_data.get('submissions', [])
-        current_page = user_data.get('current_page', 0)
-        status_filter = user_data.get('status_filter', 'all')
-
-        # Удаляем удаленное сообщение из списка
-        submissions = [s for s in submissions if s[0] != submission_id]
-        await state.update_data(submissions=submissions)
 
         # Отправляем обновлённый список сообщений вместо админ-панели
         if callback.from_user:
             try:
                 if callback.message:
-                    await show_submissions_list(
-                        callback.message,
-                        submissions,
-                        current_page,
-                        status_filter
-                    )
+                    # Курсор указывает на удаленную запись - страница
+                    # перечитывается из БД начиная со следующей за ней
+                    await show_submissions_page(callback.message, state, "current")
                     await state.set_state(SubmissionsViewState.viewing_list)
                 else:
                     await callback.answer("✅ Запись удалена. Вернитесь к списку сообщений.")
@@ -901,8 +956,9 @@ async def handle_cancel_reply(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(SubmissionsViewState.waiting_response)
-async def handle_response_text(message: Message, state: FSMContext, bot: Bot):
-    """Обработка текста/файлов ответа"""
+async def handle_response_text(message: Message, state: FSMContext, bot: Bot,
+                               album: Optional[List[Message]] = None):
+    """Обработка текста/файлов ответа (альбом - одним вызовом)"""
     if not message.from_user or message.from_user.id not in ADMIN_IDS:
         return
 
@@ -923,16 +979,17 @@ async def handle_response_text(message: Message, state: FSMContext, bot: Bot):
             await state.clear()
             return
 
-        # Собираем file_ids (фото, документы)
+        # Собираем file_ids (фото, документы); альбом приходит одним обновлением
         file_ids = []
-        if message.photo:
-            file_ids.append(message.photo[-1].file_id)
-        if message.document:
-            file_ids.append(message.document.file_id)
-        # TODO: если поддержка media_group — добавить обработку group_id
+        for item in album or [message]:
+            if item.photo:
+                file_ids.append(item.photo[-1].file_id)
+            if item.document:
+                file_ids.append(item.document.file_id)
 
-        # Получаем текст из сообщения (может быть в text или caption)
-        admin_text = message.text or message.caption or ''
+        # Получаем текст из сообщения (может быть в text или caption, у альбома - у любого элемента)
+        admin_text = next((item.text or item.caption for item in album or [message]
+                           if item.text or item.caption), '')
 
         # Отправляем ответ пользователю
         user_id = submission[1]  # user_id из записи
@@ -961,22 +1018,17 @@ async def handle_response_text(message: Message, state: FSMContext, bot: Bot):
             await message.answer("✅ Ответ отправлен пользователю и сохранен в базу данных")
 
             # Возвращаемся к списку обращений
-            user_data = await state.get_data()
-            submissions = user_data.get('submissions', [])
-            current_page = user_data.get('current_page', 0)
-            status_filter = user_data.get('status_filter', 'all')
-            await show_submissions_list(message, submissions, current_page, status_filter)
+            await show_submissions_page(message, state, "current")
             await state.set_state(SubmissionsViewState.viewing_list)
 
         except Exception as e:
             logger.error(f"Ошибка отправки ответа пользователю: {e}")
+            delivery_status = get_delivery_status(e)
+            if delivery_status and db is not None:
+                await db.note_delivery_failure(user_id, delivery_status)
             await message.answer("❌ Не удалось отправить ответ пользователю")
             # Также возвращаемся к списку обращений при ошибке
-            user_data = await state.get_data()
-            submissions = user_data.get('submissions', [])
-            current_page = user_data.get('current_page', 0)
-            status_filter = user_data.get('status_filter', 'all')
-            await show_submissions_list(message, submissions, current_page, status_filter)
+            await show_submissions_page(message, state, "current")
             await state.set_state(SubmissionsViewState.viewing_list)
 
         await state.update_data(current_submission_id=submission_id)
@@ -996,13 +1048,8 @@ async def handle_back_to_list(callback: CallbackQuery, state: FSMContext):
         return
 
     try:
-        user_data = await state.get_data()
-        submissions = user_data.get('submissions', [])
-        current_page = user_data.get('current_page', 0)
-        status_filter = user_data.get('status_filter', 'all')
-
         if callback.message:
-            await show_submissions_list(callback.message, submissions, current_page, status_filter)
+            await show_submissions_page(callback.message, state, "current")
             await state.set_state(SubmissionsViewState.viewing_list)
 
     except Exception as e:
@@ -1039,34 +1086,21 @@ async def process_broadcast(message: Message, state: FSMContext, bot: Bot):
     if db is None:
         await message.answer("❌ Ошибка: не удалось инициализировать подключение к базе данных. Обратитесь к администратору.", reply_markup=get_admin_keyboard())
         return
-    users = await db.get_all_users()
-    success = 0
-    failed = 0
+
+    text = message.text or ""
     sender_id = message.from_user.id  # ID отправителя рассылки
 
     await message.answer("⏳ Начинаю рассылку...", reply_markup=get_admin_keyboard())
-
-    for user in users:
-        user_id = user[0]  # Получаем ID пользователя из БД
-        if user_id == sender_id:  # Пропускаем отправителя
-            continue
-
-        try:
-            await bot.send_message(user_id, message.text or "")
-            success += 1
-            await asyncio.sleep(0.1)  # Задержка против флуда
-        except Exception as e:
-            logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
-            failed += 1
-
-    # Добавляем информацию о пропуске отправителя
-    await message.answer(
-        f"✅ Рассылка завершена:\n"
-        f"• Получателей: {len(list(users))-1}\n"  # -1 за счет отправителя
-        f"• Доставлено: {success}\n"
-        f"• Не доставлено: {failed}\n"
-        f"• Пропущено (отправитель): 1",
-        reply_markup=get_admin_keyboard()
+    status_message = await message.answer("📤 Подготовка получателей...")
+
+    # Рассылка идет в фоне, прогресс обновляется в status_message
+    await start_broadcast(
+        bot,
+        db,
+        payload={'text': text},
+        created_by=sender_id,
+        status_message=status_message,
+        exclude_ids=[sender_id]  # Пропускаем отправителя
     )
 
 
@@ -1078,11 +1112,7 @@ async def back_to_admin_menu(message: Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state == SubmissionsViewState.viewing_detail.state:
         # Возврат к списку сообщений
-        user_data = await state.get_data()
-        submissions = user_data.get('submissions', [])
-        current_page = user_data.get('current_page', 0)
-        status_filter = user_data.get('status_filter', 'all')
-        await show_submissions_list(message, submissions, current_page, status_filter)
+        await show_submissions_page(message, state, "current")
         await state.set_state(SubmissionsViewState.viewing_list)
     else:
         await message.answer("Админ-панель:", reply_markup=get_admin_keyboard())
@@ -1185,7 +1215,7 @@ async def find_user_handler(message: Message, state: FSMContext):
         "- @username\n"
         "- username (без @)"
     )
-    await state.set_state("waiting_user_search")
+    await state.set_state(BanStates.waiting_user_search)
 
 
 @router.message(F.text == '🧹 Очистить истекшие')
@@ -1230,48 +1260,60 @@ async def process_user_search(message: Message, state: FSMContext):
     search_query = message.text.strip() if message.text else ""
 
     try:
-        # Парсим ID или username
-        user_id = None
-        username = None
+        # Пользователь, блокировка и число обращений (в единой БД - одним запросом)
+        found = await db.find_users(search_query, limit=1) if db else []
+        user = found[0] if found else None
 
-        if search_query.isdigit():
+        if user:
+            user_id = user['user_id']
+        elif search_query.isdigit():
+            # Пользователя нет в БД, но заблокировать по ID все равно можно
             user_id = int(search_query)
-        elif search_query.startswith('@'):
-            username = search_query[1:]
-        else:
-            username = search_query
-
-        # Проверяем, заблокирован ли пользователь
-        if user_id:
-            is_banned = await is_user_banned(user_id)
-            ban_info = await get_ban_info(user_id) if is_banned else None
         else:
-            # Для username нужно найти ID (упрощенная версия)
-            await message.answer("⚠️ Поиск по username пока не поддерживается. Используйте ID пользователя.", reply_markup=get_admin_keyboard())
+            await message.answer(f"❌ Пользователь {search_query} не найден", reply_markup=get_admin_keyboard())
             await state.clear()
             return
 
-        if is_banned and ban_info:
+        found_username = (user['username'] if user else None) or "unknown"
+        ban = None
+        if user and user['is_banned'] is not None:
+            if user['is_banned']:
+                ban = (user['ban_reason'], user['ban_count'], user['banned_at'])
+        else:
+            ban_status = await get_ban_status(user_id)
+            if ban_status:
+                found_username = ban_status.username or found_username
+                ban = (ban_status.reason, ban_status.ban_count, ban_status.banned_at)
+
+        details = ""
+        if user and user['submissions'] is not None:
+            details += f"Обращений: {user['submissions']}\n"
+        if user and user['last_active']:
+            details += f"Активность: {user['last_active'][:16]}\n"
+
+        if ban:
             # Пользователь заблокирован - предлагаем разблокировать
-            keyboard = get_unban_user_keyboard(
-                user_id, ban_info.get('username'))
+            reason, ban_count, banned_at = ban
+            keyboard = get_unban_user_keyboard(user_id, found_username)
             await message.answer(
                 f"🔍 Найден заблокированный пользователь:\n\n"
                 f"ID: {user_id}\n"
-                f"Username: @{ban_info.get('username', 'unknown')}\n"
-                f"Причина: {ban_info.get('reason', 'Не указана')}\n"
-                f"Блокировок: {ban_info.get('ban_count', 1)}\n"
-                f"Дата: {ban_info.get('banned_at', 'Неизвестно')[:16]}\n\n"
+                f"Username: @{found_username}\n"
+                f"{details}"
+                f"Причина: {reason or 'Не указана'}\n"
+                f"Блокировок: {ban_count}\n"
+                f"Дата: {(banned_at or 'Неизвестно')[:16]}\n\n"
                 f"Хотите разблокировать?",
                 reply_markup=keyboard
             )
         else:
             # Пользователь не заблокирован - предлагаем заблокировать
-            keyboard = get_ban_user_keyboard(user_id, "unknown")
+            keyboard = get_ban_user_keyboard(user_id, found_username)
             await message.answer(
                 f"🔍 Найден пользователь:\n\n"
                 f"ID: {user_id}\n"
-                f"Username: @unknown\n\n"
+                f"Username: @{found_username}\n"
+                f"{details}\n"
                 f"Пользователь не заблокирован. Хотите заблокировать?",
                 reply_markup=keyboard
             )
@@ -1355,7 +1397,9 @@ async def process_ban_reason(message: Message, state: FSMContext):
 
     try:
         # Блокируем пользователя
-        ban_result = await ban_user(ban_user_id, "unknown", reason, message.from_user.id)
+        names = await db.get_user_names(ban_user_id) if db else None
+        ban_username = (names[0] if names else None) or "unknown"
+        ban_result = await ban_user(ban_user_id, ban_username, reason, message.from_user.id)
 
         ban_count = ban_result.get('ban_count', 1)
         duration = "24 часа" if ban_count == 1 else "7 дней" if ban_count == 2 else "навсегда"
@@ -5,7 +5,7 @@ import logging
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
-from database import Database
+from database import get_user_storage
 from keyboards import (
     get_main_keyboard,
     get_guides_keyboard,
@@ -20,10 +20,10 @@ logger = logging.getLogger(__name__)
 
 # Инициализация базы данных
 try:
-    db = Database()
+    db = get_user_storage()
 except Exception as e:
     db = None
-    logger.error(f"Ошибка инициализации Database: {e}")
+    logger.error(f"Ошибка инициализации хранилища пользователей: {e}")
 
 
 @router.message(Command("start"))
@@ -35,11 +35,14 @@ async def start_command(message: Message, bot: Bot):
     user_info = get_user_info(message.from_user)
 
     # Сохраняем пользователя в БД
+    is_new_user = False
     if db:
         try:
-            await db.save_user(message.from_user)  # type: ignore
+            is_new_user = await db.save_user(message.from_user)  # type: ignore
         except Exception as e:
             logger.error(f"Ошибка сохранения пользователя: {e}")
+    if is_new_user:
+        logger.info(f"🆕 Новый пользователь: {user_info['id']} (@{user_info['username']})")
 
     # Приветствие (без обязательной подписки)
     if config.channel_username:
@@ -52,8 +55,9 @@ async def start_command(message: Message, bot: Bot):
             # Продолжаем работу бота даже без подписки
 
     # Приветственное сообщение
+    greeting = "🎉 Добро пожаловать" if is_new_user else "👋 С возвращением"
     welcome_text = f"""
-🎉 Добро пожаловать в бот v{BOT_VERSION}!
+{greeting} в бот v{BOT_VERSION}!
 
 📚 Здесь вы найдете полезные гайды и материалы.
 📨 Обратная связь - вопросы, предложения и заказы на разработку.
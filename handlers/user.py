@@ -1,22 +1,22 @@
 import asyncio
-import time
-from typing import Optional
+from typing import List, Optional
 from aiogram import Router, F, Bot, types
 from aiogram.types import Message, FSInputFile, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
-from database import Database
+from database import get_user_storage, get_submission_storage
 from keyboards import (
     get_subscribe_keyboard,
     get_main_keyboard
 )
 from utils import check_subscription
-from utils.checks import is_user_banned, ban_user, get_user_info, get_ban_info
+from utils.checks import get_ban_status, ban_user, get_user_info
+from utils.broadcast import start_broadcast
+from utils.antispam import get_activity_tracker
 from config import FILES_DIR, ADMIN_IDS
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardRemove
 import os
 import logging
-from database.submissions import SubmissionDB
 
 
 class FeedbackStates(StatesGroup):
@@ -29,17 +29,17 @@ class BroadcastState(StatesGroup):
 
 
 # Создаем глобальный экземпляр базы данных
-submission_db = SubmissionDB()
+submission_db = get_submission_storage()
 router = Router()
 logger = logging.getLogger(__name__)
 try:
-    db = Database()
+    db = get_user_storage()
 except Exception as e:
     db = None
-    logger.error(f"Ошибка инициализации Database: {e}")
+    logger.error(f"Ошибка инициализации хранилища пользователей: {e}")
 
-# Система отслеживания активности для автоматической блокировки
-user_activity = {}  # {user_id: {'messages': [], 'last_message': timestamp}}
+# Активность пользователей для автоматической блокировки (в памяти или в Redis)
+activity_tracker = get_activity_tracker()
 
 
 async def check_user_activity(user_id: int, message_text: Optional[str] = None) -> tuple[bool, str]:
@@ -49,44 +49,10 @@ async def check_user_activity(user_id: int, message_text: Optional[str] = None)
     Returns:
         tuple[bool, str]: (можно продолжить, причина блокировки если заблокирован)
     """
-    current_time = time.time()
-
-    if user_id not in user_activity:
-        user_activity[user_id] = {
-            'messages': [],
-            'last_message': current_time,
-            'duplicate_count': 0,
-            'last_text': None
-        }
-
-    user_data = user_activity[user_id]
-
-    # Очищаем старые сообщения (старше 1 минуты)
-    user_data['messages'] = [msg for msg in user_data['messages']
-                             if current_time - msg < 60]
-
-    # Добавляем текущее сообщение
-    user_data['messages'].append(current_time)
-    user_data['last_message'] = current_time
-
-    # Проверяем количество сообщений за минуту
-    if len(user_data['messages']) > 5:
-        reason = "Спам: более 5 сообщений за минуту"
+    reason = await activity_tracker.register(user_id, message_text)
+    if reason:
         await auto_ban_user(user_id, reason)
         return False, reason
-
-    # Проверяем дублирование сообщений
-    if message_text:
-        if user_data['last_text'] == message_text:
-            user_data['duplicate_count'] += 1
-            if user_data['duplicate_count'] >= 3:
-                reason = "Спам: отправка одинаковых сообщений"
-                await auto_ban_user(user_id, reason)
-                return False, reason
-        else:
-            user_data['duplicate_count'] = 0
-            user_data['last_text'] = message_text
-
     return True, ""
 
 
@@ -95,18 +61,16 @@ async def auto_ban_user(user_id: int, reason: str):
     try:
         # Получаем информацию о пользователе из БД или создаем базовую
         username = "unknown"
+        first_name = ""
         try:
             if db:
-                # Получаем всех пользователей и ищем нужного
-                users = await db.get_all_users()
-                for user in users:
-                    if user[0] == user_id:  # user[0] is user_id
-                        username = user[1] or "unknown"  # user[1] is username
-                        break
-                else:
-                    username = "unknown"
-        except:
-            username = "unknown"
+                # LRU кэш или поиск по первичному ключу
+                names = await db.get_user_names(user_id)
+                if names:
+                    username = names[0] or "unknown"
+                    first_name = names[1] or ""
+        except Exception as e:
+            logger.error(f"Ошибка получения пользователя {user_id}: {e}")
 
         # Блокируем пользователя
         # 0 = система
@@ -124,6 +88,7 @@ async def auto_ban_user(user_id: int, reason: str):
                         f"🚫 Автоматическая блокировка пользователя:\n"
                         f"ID: {user_id}\n"
                         f"Username: @{username}\n"
+                        f"Имя: {first_name}\n"
                         f"Причина: {reason}\n"
                         f"Блокировка: {duration}"
                     )
@@ -161,14 +126,13 @@ async def start_feedback(message: Message, state: FSMContext):
         return
 
     # Проверяем блокировку
-    is_banned = await is_user_banned(message.from_user.id)
-    ban_info = await get_ban_info(message.from_user.id) if is_banned else None
+    ban_status = await get_ban_status(message.from_user.id)
     ban_text = ""
-    if is_banned and ban_info:
-        if ban_info['is_permanent']:
+    if ban_status:
+        if ban_status.is_permanent:
             ban_text = "\n\n🚫 Вы заблокированы навсегда за нарушение правил. Вы можете отправлять только 1 обращение в неделю, пока блокировка не снята."
         else:
-            ban_text = f"\n\n🚫 Вы заблокированы до {ban_info['expires_at'][:16]} за нарушение правил. Вы можете отправлять только 1 обращение в неделю, пока блокировка не снята."
+            ban_text = f"\n\n🚫 Вы заблокированы до {ban_status.expires_at[:16]} за нарушение правил. Вы можете отправлять только 1 обращение в неделю, пока блокировка не снята."
 
     # Создаем клавиатуру с кнопками "Отправить", "История" и "Отменить"
     keyboard = ReplyKeyboardMarkup(
@@ -209,7 +173,7 @@ async def start_feedback(message: Message, state: FSMContext):
 @router.message(FeedbackStates.waiting_for_feedback, F.text == "📜 История")
 async def show_user_history(message: types.Message, state: FSMContext, bot: Bot):
     await submission_db.init()
-    if not submission_db.connection:
+    if not submission_db.is_connected:
         if message:
             await message.answer("Ошибка: соединение с базой не установлено.", reply_markup=get_main_keyboard(message.from_user.id if message.from_user else 0))
         return
@@ -217,9 +181,7 @@ async def show_user_history(message: types.Message, state: FSMContext, bot: Bot)
     if not user_id:
         await message.answer("Ошибка: не удалось определить пользователя.", reply_markup=get_main_keyboard(message.from_user.id if message.from_user else 0))
         return
-    async with submission_db.connection.cursor() as cursor:
-        await cursor.execute('SELECT id, text_content, file_ids, status, created_at FROM submissions WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-        rows = await cursor.fetchall()
+    rows = await submission_db.get_user_submissions(user_id, limit=10)
     rows = list(rows) if rows else []
     if not rows:
         await message.answer("У вас пока нет обращений.", reply_markup=get_main_keyboard(message.from_user.id if message.from_user else 0))
@@ -239,8 +201,9 @@ async def show_user_history(message: types.Message, state: FSMContext, bot: Bot)
 
 # Универсальный обработчик для текста/фото/документов
 @router.message(FeedbackStates.waiting_for_feedback, F.photo | F.document | F.text)
-async def handle_feedback_content(message: types.Message, state: FSMContext, bot: Bot):
-    """Обработка обратной связи с накоплением текста и файлов"""
+async def handle_feedback_content(message: types.Message, state: FSMContext, bot: Bot,
+                                  album: Optional[List[types.Message]] = None):
+    """Обработка обратной связи с накоплением текста и файлов (альбом - одним вызовом)"""
     try:
         if not message.from_user:
             logger.error("❌ Не удалось определить пользователя")
@@ -249,8 +212,7 @@ async def handle_feedback_content(message: types.Message, state: FSMContext, bot
             return
 
         user_id = message.from_user.id
-        is_banned = await is_user_banned(user_id)
-        ban_info = await get_ban_info(user_id) if is_banned else None
+        ban_status = await get_ban_status(user_id)
 
         # Проверяем активность пользователя
         message_text = message.text or message.caption or ""
@@ -291,7 +253,7 @@ async def handle_feedback_content(message: types.Message, state: FSMContext, bot
                 return
 
             # --- Новый блок: ограничение для забаненных ---
-            if is_banned and ban_info:
+            if ban_status:
                 await submission_db.init()
                 last_time_str = await submission_db.get_last_submission_time(user_id)
                 import datetime
@@ -311,10 +273,10 @@ async def handle_feedback_content(message: types.Message, state: FSMContext, bot
                             hours = int((left % (24*3600)) // 3600)
                             minutes = int((left % 3600) // 60)
                             left_str = f"{days}д {hours}ч {minutes}м"
-                            if ban_info['is_permanent']:
+                            if ban_status.is_permanent:
                                 ban_text = f"🚫 Вы заблокированы навсегда. Следующее обращение будет доступно через: {left_str}"
                             else:
-                                ban_text = f"🚫 Вы заблокированы до {ban_info['expires_at'][:16]}. Следующее обращение будет доступно через: {left_str}"
+                                ban_text = f"🚫 Вы заблокированы до {ban_status.expires_at[:16]}. Следующее обращение будет доступно через: {left_str}"
                             await message.answer(ban_text, reply_markup=get_main_keyboard(user_id))
                             return
             # --- Конец блока ---
@@ -356,27 +318,29 @@ async def handle_feedback_content(message: types.Message, state: FSMContext, bot
         accumulated_files = user_data.get('accumulated_files', [])
         accumulated_text = user_data.get('accumulated_text', '') or ''
 
-        # Обработка медиа
-        if message.photo:
-            file_id = message.photo[-1].file_id
-            accumulated_files.append(file_id)
-        elif message.document:
-            file_id = message.document.file_id
-            accumulated_files.append(file_id)
-
-        # Обработка текста (включая caption к медиа)
-        text_to_add = None
-        if message.text:
-            text_to_add = message.text
-        elif message.caption:
-            text_to_add = message.caption
-
-        if text_to_add:
-            if accumulated_text:
-                new_text = accumulated_text + "\n\n" + text_to_add
-            else:
-                new_text = text_to_add
-            accumulated_text = new_text
+        # Альбом приходит одним обновлением (MediaGroupMiddleware)
+        for item in album or [message]:
+            # Обработка медиа
+            if item.photo:
+                file_id = item.photo[-1].file_id
+                accumulated_files.append(file_id)
+            elif item.document:
+                file_id = item.document.file_id
+                accumulated_files.append(file_id)
+
+            # Обработка текста (включая caption к медиа)
+            text_to_add = None
+            if item.text:
+                text_to_add = item.text
+            elif item.caption:
+                text_to_add = item.caption
+
+            if text_to_add:
+                if accumulated_text:
+                    new_text = accumulated_text + "\n\n" + text_to_add
+                else:
+                    new_text = text_to_add
+                accumulated_text = new_text
 
         # Обновляем состояние
         await state.update_data(accumulated_files=accumulated_files, accumulated_text=accumulated_text)
@@ -441,7 +405,8 @@ async def broadcast_handler(message: Message, state: FSMContext):
 
 # Обработчик для накопления текста, фото и документов, а также кнопок 'Отправить'/'Отменить' в рассылке
 @router.message(BroadcastState.waiting_message, F.photo | F.document | F.text)
-async def handle_broadcast_content(message: types.Message, state: FSMContext, bot: Bot):
+async def handle_broadcast_content(message: types.Message, state: FSMContext, bot: Bot,
+                                   album: Optional[List[types.Message]] = None):
     if not message.from_user or message.from_user.id not in ADMIN_IDS:
         return
     user_id = message.from_user.id
@@ -474,52 +439,49 @@ async def handle_broadcast_content(message: types.Message, state: FSMContext, bo
                 )
             )
             return
-        # Получаем всех пользователей
         if db is not None:
-            users = await db.get_all_users()
-            success = 0
-            failed = 0
-            for user in users:
-                try:
-                    # Сначала отправляем файлы, если есть
-                    for file_id in accumulated_files[:5]:
-                        await bot.send_photo(user[0], file_id)
-                    # Затем текст, если есть
-                    if accumulated_text:
-                        await bot.send_message(user[0], accumulated_text)
-                    success += 1
-                except Exception:
-                    failed += 1
             await message.answer(
-                f"✅ Рассылка завершена.\nДоставлено: {success}\nНе доставлено: {failed}",
+                "⏳ Начинаю рассылку...",
                 reply_markup=get_main_keyboard(user_id)
             )
+            status_message = await message.answer("📤 Подготовка получателей...")
+            # Рассылка идет в фоне, прогресс обновляется в status_message
+            await start_broadcast(
+                bot,
+                db,
+                payload={'text': accumulated_text,
+                         'files': accumulated_files[:5]},
+                created_by=user_id,
+                status_message=status_message
+            )
             await state.clear()
             return
         else:
             await message.answer("❌ Ошибка: не удалось получить пользователей из базы данных.", reply_markup=get_main_keyboard(user_id))
             return
 
-    # Накопление фото
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        accumulated_files.append(file_id)
-    # Накопление документов
-    elif message.document:
-        file_id = message.document.file_id
-        accumulated_files.append(file_id)
-    # Накопление текста
-    text_to_add = None
-    if message.text and message.text not in ["📤 Отправить", "❌ Отменить"]:
-        text_to_add = message.text
-    elif message.caption:
-        text_to_add = message.caption
-    if text_to_add:
-        if accumulated_text:
-            new_text = accumulated_text + "\n" + text_to_add
-        else:
-            new_text = text_to_add
-        accumulated_text = new_text
+    # Альбом приходит одним обновлением (MediaGroupMiddleware)
+    for item in album or [message]:
+        # Накопление фото (тип нужен, чтобы разослать файл правильным методом)
+        if item.photo:
+            accumulated_files.append(
+                {'file_id': item.photo[-1].file_id, 'type': 'photo'})
+        # Накопление документов
+        elif item.document:
+            accumulated_files.append(
+                {'file_id': item.document.file_id, 'type': 'document'})
+        # Накопление текста
+        text_to_add = None
+        if item.text and item.text not in ["📤 Отправить", "❌ Отменить"]:
+            text_to_add = item.text
+        elif item.caption:
+            text_to_add = item.caption
+        if text_to_add:
+            if accumulated_text:
+                new_text = accumulated_text + "\n" + text_to_add
+            else:
+                new_text = text_to_add
+            accumulated_text = new_text
     await state.update_data(accumulated_text=accumulated_text, accumulated_files=accumulated_files)
     # Показываем статус
     status_message = f"✅ Контент добавлен!\n"
@@ -669,7 +631,7 @@ async def show_user_history_anytime(message: types.Message, bot: Bot):
     Позволяет любому пользователю (в том числе заблокированному) просматривать свою историю обращений из главного меню.
     """
     await submission_db.init()
-    if not submission_db.connection:
+    if not submission_db.is_connected:
         if message:
             await message.answer("Ошибка: соединение с базой не установлено.", reply_markup=get_main_keyboard(message.from_user.id if message.from_user else 0))
         return
@@ -677,9 +639,7 @@ async def show_user_history_anytime(message: types.Message, bot: Bot):
     if not user_id:
         await message.answer("Ошибка: не удалось определить пользователя.", reply_markup=get_main_keyboard(message.from_user.id if message.from_user else 0))
         return
-    async with submission_db.connection.cursor() as cursor:
-        await cursor.execute('SELECT id, text_content, file_ids, status, created_at FROM submissions WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-        rows = await cursor.fetchall()
+    rows = await submission_db.get_user_submissions(user_id, limit=10)
     rows = list(rows) if rows else []
     if not rows:
         await message.answer("У вас пока нет обращений.", reply_markup=get_main_keyboard(message.from_user.id if message.from_user else 0))
@@ -703,7 +663,7 @@ async def show_user_history_anytime(message: types.Message, bot: Bot):
 @router.callback_query(F.data.startswith("mymsg_"))
 async def show_user_submission_detail(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
     await submission_db.init()
-    if not submission_db.connection:
+    if not submission_db.is_connected:
         if callback.message:
             await callback.message.answer("Ошибка: соединение с базой не установлено.", reply_markup=get_main_keyboard(callback.from_user.id if callback.from_user else 0))
         await callback.answer()
@@ -809,8 +769,9 @@ async def handle_user_reply(callback: types.CallbackQuery, state: FSMContext):
 
 # Обработчик для ответа пользователя на свое обращение
 @router.message(FeedbackStates.waiting_for_reply, F.photo | F.document | F.text)
-async def handle_user_reply_content(message: types.Message, state: FSMContext, bot: Bot):
-    """Обработка ответа пользователя на свое обращение"""
+async def handle_user_reply_content(message: types.Message, state: FSMContext, bot: Bot,
+                                    album: Optional[List[types.Message]] = None):
+    """Обработка ответа пользователя на свое обращение (альбом - одним вызовом)"""
     try:
         if not message.from_user:
             logger.error("❌ Не удалось определить пользователя")
@@ -896,27 +857,29 @@ async def handle_user_reply_content(message: types.Message, state: FSMContext, b
         accumulated_files = user_data.get('accumulated_files', [])
         accumulated_text = user_data.get('accumulated_text', '') or ''
 
-        # Обработка медиа
-        if message.photo:
-            file_id = message.photo[-1].file_id
-            accumulated_files.append(file_id)
-        elif message.document:
-            file_id = message.document.file_id
-            accumulated_files.append(file_id)
-
-        # Обработка текста (включая caption к медиа)
-        text_to_add = None
-        if message.text:
-            text_to_add = message.text
-        elif message.caption:
-            text_to_add = message.caption
-
-        if text_to_add:
-            if accumulated_text:
-                new_text = accumulated_text + "\n\n" + text_to_add
-            else:
-                new_text = text_to_add
-            accumulated_text = new_text
+        # Альбом приходит одним обновлением (MediaGroupMiddleware)
+        for item in album or [message]:
+            # Обработка медиа
+            if item.photo:
+                file_id = item.photo[-1].file_id
+                accumulated_files.append(file_id)
+            elif item.document:
+                file_id = item.document.file_id
+                accumulated_files.append(file_id)
+
+            # Обработка текста (включая caption к медиа)
+            text_to_add = None
+            if item.text:
+                text_to_add = item.text
+            elif item.caption:
+                text_to_add = item.caption
+
+            if text_to_add:
+                if accumulated_text:
+                    new_text = accumulated_text + "\n\n" + text_to_add
+                else:
+                    new_text = text_to_add
+                accumulated_text = new_text
 
         # Обновляем состояние
         await state.update_data(accumulated_files=accumulated_files, accumulated_text=accumulated_text)
@@ -960,7 +923,7 @@ async def handle_user_reply_content(message: types.Message, state: FSMContext, b
 @router.callback_query(F.data == "myhistory_back")
 async def back_to_user_history(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
     await submission_db.init()
-    if not submission_db.connection:
+    if not submission_db.is_connected:
         if callback.message:
             await callback.message.answer("Ошибка: соединение с базой не установлено.", reply_markup=get_main_keyboard(callback.from_user.id if callback.from_user else 0))
         await callback.answer()
@@ -969,9 +932,7 @@ async def back_to_user_history(callback: types.CallbackQuery, state: FSMContext,
     if not user_id:
         await callback.answer("Ошибка: не удалось определить пользователя.", reply_markup=get_main_keyboard(callback.from_user.id if callback.from_user else 0))
         return
-    async with submission_db.connection.cursor() as cursor:
-        await cursor.execute('SELECT id, text_content, file_ids, status, created_at FROM submissions WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-        rows = await cursor.fetchall()
+    rows = await submission_db.get_user_submissions(user_id, limit=10)
     rows = list(rows) if rows else []
     if not rows:
         if callback.message:
@@ -6,7 +6,8 @@ Telegram Bot v3.0 - Main Entry Point
 from aiogram import Bot, Dispatcher, F
 from aiogram.fsm.state import State, StatesGroup
 from config import config, BOT_VERSION
-from database import Database
+from database import get_user_storage, get_submission_storage, get_ban_storage
+from database.storage import init_all as init_storages
 from keyboards import get_subscribe_keyboard, get_main_keyboard, get_admin_keyboard
 import asyncio
 import logging
@@ -19,8 +20,18 @@ import threading
 from handlers.common import router as common_router
 from handlers.user import router as user_router, set_bot_instance
 from handlers.admin import router as admin_router
-from database.submissions import SubmissionDB
-from database.banned import BannedDB
+from database.broadcasts import BroadcastDB
+from database.fsm import SQLiteStorage, get_fsm_storage
+from database.shared_state import close_redis
+from utils.broadcast import resume_broadcasts, stop_broadcasts
+from utils.antispam import get_activity_tracker
+from utils.webhook import run_webhook
+from middlewares import RequestMetricsMiddleware, get_concurrency_middleware, setup_middlewares
+from metrics import (
+    ANTISPAM_USERS, BAN_CACHE_ENTRIES, CPU_PERCENT, DB_POOL, DB_POOL_TIMEOUTS, FSM_CACHE,
+    HANDLER_ERRORS, HANDLER_LATENCY, MEMORY_RSS, REGISTRY, UPDATES, UPDATES_SHED, UPTIME,
+    MetricsServer
+)
 from contextlib import asynccontextmanager
 
 # Настройка логирования
@@ -31,6 +42,7 @@ os.makedirs(config.files_dir, exist_ok=True)
 
 # Отключаем лишние логи
 logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
 logging.getLogger("handlers.user").setLevel(logging.WARNING)
 logging.getLogger("handlers.admin").setLevel(logging.WARNING)
 logging.getLogger("database.db").setLevel(logging.WARNING)
@@ -39,6 +51,9 @@ logging.getLogger("database.submissions").setLevel(logging.WARNING)
 # Глобальный флаг для завершения
 shutdown_event = asyncio.Event()
 
+# Типы обновлений, которые получает бот (polling и webhook)
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
 
 def signal_handler(signum, frame):
     """Обработчик сигналов для корректного завершения"""
@@ -61,36 +76,92 @@ class PerformanceMonitor:
 
     def __init__(self):
         self.start_time = time.time()
-        self.request_count = 0
         self.error_count = 0
         self.last_report_time = time.time()
-
-    def increment_request(self):
-        self.request_count += 1
+        self.process = psutil.Process()
+        # Первый замер CPU: дальше cpu_percent без interval не блокирует цикл событий
+        psutil.cpu_percent(interval=None)
+        REGISTRY.on_collect(self.update_gauges)
 
     def increment_error(self):
         self.error_count += 1
 
     def get_stats(self):
         uptime = time.time() - self.start_time
-        requests_per_minute = (self.request_count /
+        # Запросы и ошибки обработчиков считает middleware метрик
+        request_count = HANDLER_LATENCY.count()
+        error_count = self.error_count + HANDLER_ERRORS.total()
+        requests_per_minute = (request_count /
                                uptime) * 60 if uptime > 0 else 0
-        error_rate = (self.error_count / self.request_count *
-                      100) if self.request_count > 0 else 0
+        error_rate = (error_count / request_count *
+                      100) if request_count > 0 else 0
 
-        # Системные ресурсы
-        cpu_percent = psutil.cpu_percent(interval=1)
+        # Системные ресурсы (загрузка CPU с прошлого замера)
+        cpu_percent = psutil.cpu_percent(interval=None)
         memory = psutil.virtual_memory()
 
+        # Кэш блокировок
+        ban_cache = get_ban_storage().get_cache_stats()
+
+        # Пул соединений с БД пользователей
+        pool = get_user_storage().pool_stats()
+
+        # Трекер антиспама в памяти процесса
+        antispam = get_activity_tracker().stats()
+
+        # Очередь обработки обновлений
+        updates = get_concurrency_middleware().stats()
+
+        # Кэш FSM в SQLite (для memory/redis - пусто)
+        fsm_storage = get_fsm_storage()
+        fsm_cache = fsm_storage.get_cache_stats() if isinstance(fsm_storage, SQLiteStorage) else {}
+
         return {
+            'uptime_seconds': uptime,
             'uptime_hours': uptime / 3600,
             'requests_per_minute': requests_per_minute,
             'error_rate': error_rate,
             'cpu_percent': cpu_percent,
             'memory_percent': memory.percent,
-            'memory_available_gb': memory.available / (1024**3)
+            'memory_available_gb': memory.available / (1024**3),
+            'memory_rss_bytes': self.process.memory_info().rss,
+            'ban_cache_size': ban_cache['size'],
+            'ban_cache_hits': ban_cache['hits'],
+            'ban_cache_misses': ban_cache['misses'],
+            'db_pool_in_use': pool.get('in_use', 0),
+            'db_pool_size': pool.get('size', 0),
+            'db_pool_wait_avg_ms': pool.get('wait_avg_ms', 0.0),
+            'db_pool_wait_max_ms': pool.get('wait_max_ms', 0.0),
+            'db_pool_timeouts': pool.get('timeouts', 0),
+            'antispam_users': antispam['users'],
+            'antispam_evicted': antispam['evicted'],
+            'antispam_memory_kb': antispam['memory_bytes'] / 1024,
+            'updates_in_flight': updates['in_flight'],
+            'updates_pending': updates['pending'],
+            'updates_shed': updates['shed'],
+            'updates_wait_avg_ms': updates['wait_avg_ms'],
+            'updates_wait_max_ms': updates['wait_max_ms'],
+            'fsm_cache_size': fsm_cache.get('size', 0),
+            'fsm_cache_dirty': fsm_cache.get('dirty', 0)
         }
 
+    def update_gauges(self):
+        """Выставляет gauge для /metrics"""
+        stats = self.get_stats()
+        UPTIME.set(stats['uptime_seconds'])
+        CPU_PERCENT.set(stats['cpu_percent'])
+        MEMORY_RSS.set(stats['memory_rss_bytes'])
+        DB_POOL.set(stats['db_pool_in_use'], state='in_use')
+        DB_POOL.set(stats['db_pool_size'], state='size')
+        DB_POOL_TIMEOUTS.set(stats['db_pool_timeouts'])
+        BAN_CACHE_ENTRIES.set(stats['ban_cache_size'])
+        ANTISPAM_USERS.set(stats['antispam_users'])
+        UPDATES.set(stats['updates_in_flight'], state='in_flight')
+        UPDATES.set(stats['updates_pending'], state='pending')
+        UPDATES_SHED.set(stats['updates_shed'])
+        FSM_CACHE.set(stats['fsm_cache_size'], state='cached')
+        FSM_CACHE.set(stats['fsm_cache_dirty'], state='dirty')
+
     def log_performance(self):
         """Логирует статистику производительности"""
         stats = self.get_stats()
@@ -101,7 +172,17 @@ class PerformanceMonitor:
             f"Errors: {stats['error_rate']:.1f}%, "
             f"CPU: {stats['cpu_percent']:.1f}%, "
             f"RAM: {stats['memory_percent']:.1f}% "
-            f"({stats['memory_available_gb']:.1f}GB free)"
+            f"({stats['memory_available_gb']:.1f}GB free), "
+            f"BanCache: {stats['ban_cache_size']} "
+            f"(hit {stats['ban_cache_hits']}/miss {stats['ban_cache_misses']}), "
+            f"DBPool: {stats['db_pool_in_use']}/{stats['db_pool_size']} "
+            f"(wait avg {stats['db_pool_wait_avg_ms']:.1f}ms/max {stats['db_pool_wait_max_ms']:.1f}ms, "
+            f"timeouts {stats['db_pool_timeouts']}), "
+            f"AntiSpam: {stats['antispam_users']} users "
+            f"({stats['antispam_memory_kb']:.0f}KB, evicted {stats['antispam_evicted']}), "
+            f"Updates: {stats['updates_in_flight']} in flight/{stats['updates_pending']} pending "
+            f"(wait avg {stats['updates_wait_avg_ms']:.1f}ms/max {stats['updates_wait_max_ms']:.1f}ms, "
+            f"shed {stats['updates_shed']})"
         )
 
 
@@ -110,28 +191,60 @@ performance_monitor = PerformanceMonitor()
 
 
 @asynccontextmanager
-async def lifespan():
+async def lifespan(bot: Bot):
     """Управление жизненным циклом приложения"""
     logger.info(f"🚀 Запуск бота v{BOT_VERSION}")
 
     # Инициализация всех БД и таблиц ДО запуска бота
-    await Database.init_all()
+    await init_storages()
 
     # Создаём экземпляры БД для последующего закрытия
-    submission_db = SubmissionDB()
-    banned_db = BannedDB()
+    submission_db = get_submission_storage()
+    banned_db = get_ban_storage()
+    broadcast_db = BroadcastDB()
+    await broadcast_db.init()
+
+    # Черновики и состояния FSM (если хранятся в SQLite)
+    fsm_storage = get_fsm_storage()
+    if isinstance(fsm_storage, SQLiteStorage):
+        await fsm_storage.init()
+
+    # Активность пользователей пишется в БД пачками в фоне
+    get_user_storage().start_write_behind()
+
+    # Метрики Prometheus (METRICS_PORT=0 - выключены)
+    metrics_server = MetricsServer()
+    try:
+        await metrics_server.start()
+    except OSError as e:
+        logger.error(f"❌ Не удалось запустить сервер метрик: {e}")
+
+    # Продолжаем рассылки, прерванные прошлой остановкой
+    resumed = await resume_broadcasts(bot, get_user_storage())
+    if resumed:
+        logger.info(f"▶️ Возобновлено рассылок: {resumed}")
 
     try:
         yield submission_db
     finally:
         logger.info("🔄 Завершение работы бота...")
+        await metrics_server.stop()
+        await stop_broadcasts()
+        if isinstance(fsm_storage, SQLiteStorage):
+            await fsm_storage.close()
+        await broadcast_db.close()
         await submission_db.close()
         await banned_db.close()
 
-        # Закрываем соединения с основной БД
-        db = Database()
+        # Сохраняем отложенные записи и закрываем соединения с основной БД
+        db = get_user_storage()
+        await db.stop_write_behind()
         await db.close_all_connections()
 
+        # Клиент Redis общий для FSM, антиспама и кэша блокировок
+        if config.shared_state:
+            await close_redis()
+
         logger.info("✅ Бот остановлен")
 
 
@@ -151,10 +264,16 @@ async def setup_bot() -> tuple[Bot, Dispatcher]:
         pool_timeout=30
     )
 
+    # Время и ошибки запросов к Bot API для /metrics
+    bot.session.middleware(RequestMetricsMiddleware())
+
     # Устанавливаем глобальный экземпляр бота для автоматической блокировки
     set_bot_instance(bot)
 
-    dp = Dispatcher()
+    dp = Dispatcher(storage=get_fsm_storage())
+
+    # Сборка альбомов, лимит одновременных обработчиков, порядок обновлений каждого пользователя и метрики
+    setup_middlewares(dp)
 
     # Подключаем роутеры
     dp.include_router(common_router)
@@ -165,97 +284,56 @@ async def setup_bot() -> tuple[Bot, Dispatcher]:
 
 
 async def performance_monitoring_task():
-    """Задача мониторинга производительности"""
+    """Сводка производительности в лог (метрики для графиков - в /metrics)"""
+    if config.performance_log_interval <= 0:
+        return
     while True:
         try:
-            await asyncio.sleep(14400)  # Каждые 4 часа
+            await asyncio.sleep(config.performance_log_interval)
             performance_monitor.log_performance()
         except Exception as e:
             logger.error(f"❌ Ошибка мониторинга: {e}")
 
 
-async def main():
-    """Главная функция запуска бота"""
-    try:
-        async with lifespan() as submission_db:
-            bot, dp = await setup_bot()
-
-            logger.info(f"🚀 Бот v{BOT_VERSION} запущен")
-            logger.info("💡 Для остановки нажмите Ctrl+C")
-
-            # Запускаем мониторинг производительности
-            monitoring_task = asyncio.create_task(
-                performance_monitoring_task())
-
-            max_retries = 5
-            retry_count = 0
+async def run_polling(bot: Bot, dp: Dispatcher):
+    """Long polling с повторными попытками при ошибках подключения"""
+    max_retries = 5
+    retry_count = 0
 
-            while retry_count < max_retries and not shutdown_event.is_set():
+    while retry_count < max_retries and not shutdown_event.is_set():
+        try:
+            polling_task = asyncio.create_task(
+                dp.start_polling(
+                    bot,
+                    polling_timeout=60,
+                    skip_updates=True,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+            )
+
+            shutdown_task = asyncio.create_task(shutdown_event.wait())
+            done, pending = await asyncio.wait(
+                [polling_task, shutdown_task],
+                return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in pending:
+                task.cancel()
+
+            # Если получили сигнал остановки
+            if shutdown_event.is_set():
+                logger.info("🛑 Получен сигнал остановки")
+                break
+
+            # Если polling завершился (даже без ошибки) — проверяем shutdown_event
+            if polling_task in done:
                 try:
-                    polling_task = asyncio.create_task(
-                        dp.start_polling(
-                            bot,
-                            polling_timeout=60,
-                            skip_updates=True,
-                            allowed_updates=[
-                                "message", "callback_query", "chat_member"
-                            ]
-                        )
-                    )
-
-                    shutdown_task = asyncio.create_task(shutdown_event.wait())
-                    done, pending = await asyncio.wait(
-                        [polling_task, shutdown_task],
-                        return_when=asyncio.FIRST_COMPLETED
-                    )
-
-                    for task in pending:
-                        task.cancel()
-
-                    # Если получили сигнал остановки
-                    if shutdown_event.is_set():
-                        logger.info("🛑 Получен сигнал остановки")
-                        break
-
-                    # Если polling завершился (даже без ошибки) — проверяем shutdown_event
-                    if polling_task in done:
-                        try:
-                            await polling_task
-                        except Exception as e:
-                            retry_count += 1
-                            performance_monitor.increment_error()
-                            logger.error(
-                                f"❌ Ошибка подключения (попытка {retry_count}/{max_retries}): {e}")
-
-                            if retry_count < max_retries and not shutdown_event.is_set():
-                                wait_time = retry_count * 10
-                                logger.info(
-                                    f"🔄 Повторная попытка через {wait_time} секунд...")
-                                await asyncio.sleep(wait_time)
-                            else:
-                                logger.error(
-                                    "❌ Превышено максимальное количество попыток подключения")
-                                break
-                        else:
-                            # Если polling завершился без ошибки, но shutdown_event не установлен — это не Ctrl+C, а что-то другое (например, polling завершился сам)
-                            # Если shutdown_event установлен — выходим из цикла
-                            if shutdown_event.is_set():
-                                logger.info(
-                                    "🛑 Polling завершён, получен сигнал остановки")
-                                break
-                            else:
-                                # Если polling завершился сам по себе (например, из-за ошибки сети), делаем retry
-                                retry_count += 1
-                                wait_time = retry_count * 10
-                                logger.info(
-                                    f"🔄 Polling завершился, повторная попытка через {wait_time} секунд...")
-                                await asyncio.sleep(wait_time)
-
+                    await polling_task
                 except Exception as e:
                     retry_count += 1
                     performance_monitor.increment_error()
                     logger.error(
-                        f"❌ Критическая ошибка (попытка {retry_count}/{max_retries}): {e}")
+                        f"❌ Ошибка подключения (попытка {retry_count}/{max_retries}): {e}")
 
                     if retry_count < max_retries and not shutdown_event.is_set():
                         wait_time = retry_count * 10
@@ -263,7 +341,55 @@ async def main():
                             f"🔄 Повторная попытка через {wait_time} секунд...")
                         await asyncio.sleep(wait_time)
                     else:
+                        logger.error(
+                            "❌ Превышено максимальное количество попыток подключения")
+                        break
+                else:
+                    # Если polling завершился без ошибки, но shutdown_event не установлен — это не Ctrl+C, а что-то другое (например, polling завершился сам)
+                    # Если shutdown_event установлен — выходим из цикла
+                    if shutdown_event.is_set():
+                        logger.info(
+                            "🛑 Polling завершён, получен сигнал остановки")
                         break
+                    else:
+                        # Если polling завершился сам по себе (например, из-за ошибки сети), делаем retry
+                        retry_count += 1
+                        wait_time = retry_count * 10
+                        logger.info(
+                            f"🔄 Polling завершился, повторная попытка через {wait_time} секунд...")
+                        await asyncio.sleep(wait_time)
+
+        except Exception as e:
+            retry_count += 1
+            performance_monitor.increment_error()
+            logger.error(
+                f"❌ Критическая ошибка (попытка {retry_count}/{max_retries}): {e}")
+
+            if retry_count < max_retries and not shutdown_event.is_set():
+                wait_time = retry_count * 10
+                logger.info(
+                    f"🔄 Повторная попытка через {wait_time} секунд...")
+                await asyncio.sleep(wait_time)
+            else:
+                break
+
+
+async def main():
+    """Главная функция запуска бота"""
+    try:
+        bot, dp = await setup_bot()
+        async with lifespan(bot) as submission_db:
+            logger.info(f"🚀 Бот v{BOT_VERSION} запущен")
+            logger.info("💡 Для остановки нажмите Ctrl+C")
+
+            # Запускаем мониторинг производительности
+            monitoring_task = asyncio.create_task(
+                performance_monitoring_task())
+
+            if config.webhook_mode:
+                await run_webhook(bot, dp, shutdown_event, ALLOWED_UPDATES)
+            else:
+                await run_polling(bot, dp)
 
             # Корректное завершение
             logger.info("🔄 Начинаем корректное завершение...")
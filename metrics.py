@@ -0,0 +1,332 @@
+"""
+Метрики бота в формате Prometheus (text exposition 0.0.4)
+Счетчики, гистограммы и gauge без внешних зависимостей; отдаются на локальном /metrics
+"""
+import inspect
+import logging
+import math
+import re
+import time
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм задержек, сек
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Границы размеров данных FSM, байт
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}', *self._samples()]
+
+
+class Counter(_Metric):
+    """Монотонный счетчик"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Gauge(_Metric):
+    """Текущее значение; обновляется при сборе метрик (REGISTRY.on_collect)"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        self._values[self._key(labels)] = float(value)
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными границами (кумулятивные bucket при выводе)"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # [счетчики по bucket (+Inf последним), сумма, количество]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts = entry[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def count(self) -> int:
+        return sum(entry[2] for entry in self._values.values())
+
+    def _samples(self) -> Iterable[str]:
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}'
+            labels = _format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+class Registry:
+    """Все метрики процесса"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def on_collect(self, callback: Callable[[], None]):
+        """Функция, обновляющая gauge перед выдачей метрик"""
+        self._collectors.append(callback)
+
+    def render(self) -> str:
+        for callback in self._collectors:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"❌ Ошибка сбора метрик: {e}")
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = Histogram(
+    'bot_handler_duration_seconds', 'Время работы обработчиков',
+    ('router', 'event', 'callback'))
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках', ('router', 'event'))
+DB_LATENCY = Histogram(
+    'bot_db_query_duration_seconds', 'Время вызовов хранилищ', ('storage', 'method'))
+DB_ERRORS = Counter(
+    'bot_db_errors_total', 'Ошибки вызовов хранилищ', ('storage', 'method'))
+TELEGRAM_LATENCY = Histogram(
+    'bot_telegram_request_duration_seconds', 'Время запросов к Bot API', ('method',))
+TELEGRAM_ERRORS = Counter(
+    'bot_telegram_errors_total', 'Ошибки запросов к Bot API', ('method', 'code'))
+FSM_DATA_BYTES = Histogram(
+    'bot_fsm_data_bytes', 'Размер записываемых данных FSM', buckets=SIZE_BUCKETS)
+
+# Состояние процесса; значения выставляет PerformanceMonitor.update_gauges
+UPTIME = Gauge('bot_uptime_seconds', 'Время работы бота')
+CPU_PERCENT = Gauge('bot_cpu_percent', 'Загрузка CPU системы')
+MEMORY_RSS = Gauge('bot_memory_rss_bytes', 'Память процесса бота')
+DB_POOL = Gauge('bot_db_pool_connections', 'Соединения пула БД пользователей', ('state',))
+DB_POOL_TIMEOUTS = Gauge('bot_db_pool_timeouts', 'Таймауты ожидания соединения из пула')
+BAN_CACHE_ENTRIES = Gauge('bot_ban_cache_entries', 'Записей в кэше блокировок')
+ANTISPAM_USERS = Gauge('bot_antispam_users', 'Пользователей в трекере антиспама')
+UPDATES = Gauge('bot_updates', 'Обновления в обработке и в очереди', ('state',))
+UPDATES_SHED = Gauge('bot_updates_shed', 'Сброшенные сверх лимитов обновления')
+FSM_CACHE = Gauge('bot_fsm_cache_entries', 'Кэш состояний FSM', ('state',))
+
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек в стиле HDR: диапазоны по степеням двойки, в каждом
+    SUB_BUCKETS линейных ячеек (погрешность перцентилей ~3%), хранятся только
+    непустые ячейки. Значения в микросекундах, до ~19 часов
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    MAX_MICROS = (1 << 36) - 1
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, micros: int) -> int:
+        if micros < cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return cls.SUB_BUCKETS * (shift + 1) + (micros >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def _upper_bound(cls, index: int) -> int:
+        """Наибольшее значение ячейки, мкс"""
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        mantissa = index % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def observe(self, seconds: float):
+        micros = min(max(int(seconds * 1_000_000), 0), self.MAX_MICROS)
+        index = self._index(micros)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent: float) -> float:
+        """Значение перцентиля, сек (0.0 без замеров)"""
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._upper_bound(index) / 1_000_000, self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+# Время обработчиков по имени функции (для экрана статистики админа)
+HANDLER_TIMINGS: Dict[str, LatencyHistogram] = {}
+ALL_HANDLERS = LatencyHistogram()
+
+
+def observe_handler(name: str, seconds: float):
+    histogram = HANDLER_TIMINGS.get(name)
+    if histogram is None:
+        histogram = HANDLER_TIMINGS[name] = LatencyHistogram()
+    histogram.observe(seconds)
+    ALL_HANDLERS.observe(seconds)
+
+
+def slow_handlers(limit: int = 5, percent: float = 95) -> List[Tuple[str, LatencyHistogram]]:
+    """Самые медленные обработчики по перцентилю percent"""
+    ranked = sorted(HANDLER_TIMINGS.items(), key=lambda item: item[1].percentile(percent), reverse=True)
+    return ranked[:limit]
+
+
+def callback_prefix(data: Optional[str]) -> str:
+    """Префикс callback_data без ID: mymsg_15 -> mymsg, page_next -> page_next"""
+    if not data:
+        return ''
+    return re.split(r'[_:]?\d', data, maxsplit=1)[0]
+
+
+def instrument_storage(cls: type, storage: str):
+    """Оборачивает публичные async-методы класса хранилища замером DB_LATENCY"""
+    for name, method in list(vars(cls).items()):
+        # Только обычные async-методы: staticmethod/classmethod, абстрактные и уже обернутые пропускаем
+        if name.startswith('_') or not inspect.iscoroutinefunction(method) \
+                or getattr(method, '__isabstractmethod__', False) \
+                or getattr(method, '__instrumented__', False):
+            continue
+        setattr(cls, name, _timed(method, storage, name))
+
+
+def _timed(method, storage: str, name: str):
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(storage=storage, method=name)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, storage=storage, method=name)
+    wrapper.__instrumented__ = True
+    return wrapper
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер с /metrics (METRICS_PORT, 0 - выключен)"""
+
+    def __init__(self):
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        if config.metrics_port <= 0 or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', metrics_handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=config.metrics_host, port=config.metrics_port).start()
+        logger.info(f"📈 Метрики: http://{config.metrics_host}:{config.metrics_port}/metrics")
+
+    async def stop(self):
+        runner, self._runner = self._runner, None
+        if runner is not None:
+            await runner.cleanup()
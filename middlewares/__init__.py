@@ -0,0 +1,34 @@
+"""
+Middleware диспетчера
+"""
+from aiogram import Dispatcher
+
+from config import config
+from .concurrency import ConcurrencyMiddleware, get_concurrency_middleware
+from .media_group import MediaGroupMiddleware
+from .metrics import HandlerMetricsMiddleware, RequestMetricsMiddleware
+
+__all__ = [
+    'ConcurrencyMiddleware',
+    'HandlerMetricsMiddleware',
+    'MediaGroupMiddleware',
+    'RequestMetricsMiddleware',
+    'get_concurrency_middleware',
+    'setup_middlewares'
+]
+
+
+def setup_middlewares(dp: Dispatcher):
+    """
+    Подключает middleware обновлений перед FSM middleware, чтобы состояние читалось,
+    когда предыдущее обновление пользователя уже обработано.
+    Альбом собирается до очереди пользователя: его элементы не ждут друг друга.
+    Inner middleware метрик диспетчера действуют и на обработчики вложенных роутеров
+    """
+    dp.update.outer_middleware.unregister(dp.fsm)
+    if config.media_group_wait > 0:
+        dp.update.outer_middleware(MediaGroupMiddleware())
+    dp.update.outer_middleware(get_concurrency_middleware())
+    dp.update.outer_middleware(dp.fsm)
+    dp.message.middleware(HandlerMetricsMiddleware('message'))
+    dp.callback_query.middleware(HandlerMetricsMiddleware('callback_query'))
@@ -0,0 +1,137 @@
+"""
+Ограничение одновременной обработки обновлений
+Общий лимит обработчиков, очередь по пользователю (строгий порядок) и сброс лишней нагрузки
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Не чаще раза в столько секунд пишем в лог о сброшенных обновлениях
+SHED_LOG_INTERVAL = 10.0
+
+
+class _UserQueue:
+    """Очередь обновлений одного пользователя: asyncio.Lock пропускает ожидающих по порядку"""
+    __slots__ = ('lock', 'size')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.size = 0  # обрабатывается + ждут
+
+
+class ConcurrencyMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update. Обновления одного пользователя обрабатываются
+    строго по очереди, всего одновременно - не больше max_in_flight обработчиков.
+    Сверх max_pending ожидающих (или max_user_queue у одного пользователя) обновление сбрасывается
+    """
+
+    def __init__(self, max_in_flight: Optional[int] = None, max_pending: Optional[int] = None,
+                 max_user_queue: Optional[int] = None):
+        self.max_in_flight = max_in_flight or config.update_max_in_flight
+        self.max_pending = config.update_max_pending if max_pending is None else max_pending
+        self.max_user_queue = config.update_max_user_queue if max_user_queue is None else max_user_queue
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._queues: Dict[Hashable, _UserQueue] = {}
+        self.in_flight = 0
+        self.pending = 0
+        self.processed = 0
+        self.shed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._shed_logged_at = 0.0
+        self._shed_logged = 0
+
+    def _shed(self, reason: str):
+        self.shed += 1
+        now = time.monotonic()
+        if now - self._shed_logged_at >= SHED_LOG_INTERVAL:
+            logger.warning(
+                f"⚠️ Перегрузка: {reason}, сброшено обновлений: {self.shed - self._shed_logged}")
+            self._shed_logged_at = now
+            self._shed_logged = self.shed
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if self.max_pending and self.pending >= self.max_pending:
+            self._shed("очередь обновлений заполнена")
+            return None
+
+        user = data.get('event_from_user')
+        queue = None
+        if user is not None:
+            queue = self._queues.get(user.id)
+            if queue is None:
+                queue = self._queues[user.id] = _UserQueue()
+            elif self.max_user_queue and queue.size >= self.max_user_queue:
+                self._shed(f"очередь пользователя {user.id} заполнена")
+                return None
+            queue.size += 1
+
+        self.pending += 1
+        started = time.monotonic()
+        waiting = True
+        try:
+            # Сначала очередь пользователя, потом общий лимит:
+            # ожидающие своей очереди не занимают общие слоты
+            if queue is not None:
+                await queue.lock.acquire()
+            try:
+                async with self._semaphore:
+                    waiting = False
+                    self.pending -= 1
+                    wait = time.monotonic() - started
+                    self._wait_total += wait
+                    self._wait_max = max(self._wait_max, wait)
+                    self.in_flight += 1
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self.in_flight -= 1
+                        self.processed += 1
+            finally:
+                if queue is not None:
+                    queue.lock.release()
+        finally:
+            if waiting:
+                self.pending -= 1
+            if queue is not None:
+                queue.size -= 1
+                if queue.size == 0:
+                    del self._queues[user.id]
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики для PerformanceMonitor"""
+        return {
+            'in_flight': self.in_flight,
+            'pending': self.pending,
+            'users': len(self._queues),
+            'processed': self.processed,
+            'shed': self.shed,
+            'wait_avg_ms': self._wait_total / self.processed * 1000 if self.processed else 0.0,
+            'wait_max_ms': self._wait_max * 1000
+        }
+
+
+_middleware: Optional[ConcurrencyMiddleware] = None
+
+
+def get_concurrency_middleware() -> ConcurrencyMiddleware:
+    """Общий экземпляр middleware (статистика для PerformanceMonitor)"""
+    global _middleware
+    if _middleware is None:
+        _middleware = ConcurrencyMiddleware()
+    return _middleware
+
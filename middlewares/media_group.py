@@ -0,0 +1,84 @@
+"""
+Сборка альбомов (media group) в одно обновление
+Обработчик вызывается один раз на альбом и получает все сообщения в аргументе album
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject, Update
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Больше 10 элементов в альбоме Telegram не присылает
+MAX_ALBUM_SIZE = 10
+
+
+class MediaGroupMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update. Первое сообщение альбома ждет, пока новые
+    элементы перестанут приходить дольше wait секунд (или наберется 10), остальные
+    обновления поглощаются. Обработчик получает первое по message_id сообщение (на нем
+    подпись альбома) и album - весь альбом в порядке message_id; обработчики без
+    параметра album видят только это сообщение.
+    Должен стоять до очереди пользователя, иначе элементы альбома ждут друг друга
+    """
+
+    def __init__(self, wait: Optional[float] = None):
+        self.wait = config.media_group_wait if wait is None else wait
+        self._groups: Dict[Tuple[int, str], List[Message]] = {}
+        # Чат -> событие "альбом передан дальше": следующие обновления чата ждут его,
+        # чтобы, например, "Отправить" сразу после альбома не обогнало сам альбом
+        self._released: Dict[int, asyncio.Event] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        message = event.message if isinstance(event, Update) else None
+        if message is None:
+            return await handler(event, data)
+
+        chat_id = message.chat.id
+        if not message.media_group_id:
+            previous = self._released.get(chat_id)
+            if previous is not None:
+                await previous.wait()
+            return await handler(event, data)
+
+        key = (chat_id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is not None:
+            group.append(message)
+            return None
+
+        previous = self._released.get(chat_id)
+        released = self._released[chat_id] = asyncio.Event()
+        group = self._groups[key] = [message]
+        try:
+            while len(group) < MAX_ALBUM_SIZE:
+                size = len(group)
+                await asyncio.sleep(self.wait)
+                if len(group) == size:
+                    break
+            del self._groups[key]
+            # Предыдущий альбом этого чата уходит первым
+            if previous is not None:
+                await previous.wait()
+        finally:
+            self._groups.pop(key, None)
+            # Ожидающие проснутся, когда альбом уже встанет в очередь пользователя
+            released.set()
+            if self._released.get(chat_id) is released:
+                del self._released[chat_id]
+
+        album = data['album'] = sorted(group, key=lambda item: item.message_id)
+        # Элементы могут прийти не по порядку: событием становится первое сообщение альбома
+        if album[0] is not message:
+            event = event.model_copy(update={'message': album[0]})
+        return await handler(event, data)
@@ -0,0 +1,94 @@
+"""
+Метрики обработчиков и запросов к Bot API
+"""
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramConflictError, TelegramEntityTooLarge, TelegramForbiddenError,
+    TelegramNetworkError, TelegramNotFound, TelegramRetryAfter, TelegramServerError,
+    TelegramUnauthorizedError
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import CallbackQuery, TelegramObject
+
+from metrics import (
+    HANDLER_ERRORS, HANDLER_LATENCY, TELEGRAM_ERRORS, TELEGRAM_LATENCY, callback_prefix,
+    observe_handler
+)
+
+# Код ошибки Bot API по типу исключения aiogram
+ERROR_CODES = (
+    (TelegramRetryAfter, '429'),
+    (TelegramBadRequest, '400'),
+    (TelegramUnauthorizedError, '401'),
+    (TelegramForbiddenError, '403'),
+    (TelegramNotFound, '404'),
+    (TelegramConflictError, '409'),
+    (TelegramEntityTooLarge, '413'),
+    (TelegramServerError, '5xx'),
+    (TelegramNetworkError, 'network'),
+)
+
+
+def error_code(error: Exception) -> str:
+    for error_type, code in ERROR_CODES:
+        if isinstance(error, error_type):
+            return code
+    return 'other'
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware для message и callback_query каждого роутера:
+    время обработчика по модулю роутера и префиксу callback_data (Prometheus)
+    и по имени функции обработчика (экран статистики). Inner, а не outer:
+    только здесь известен выбранный обработчик, а фильтры и FSM не попадают в замер
+    """
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        function = getattr(data.get('handler'), 'callback', None)
+        router = getattr(function, '__module__', '') or ''
+        name = getattr(function, '__name__', '') or type(function).__name__
+        callback = callback_prefix(event.data) if isinstance(event, CallbackQuery) else ''
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(router=router, event=self.event)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, router=router, event=self.event, callback=callback)
+            observe_handler(name, elapsed)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки запросов к Bot API по методу"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, code=error_code(e))
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=name)
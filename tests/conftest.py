@@ -0,0 +1,75 @@
+"""
+Общие фикстуры тестов хранилищ
+Бэкенд SQLite проверяется всегда, PostgreSQL - если задан DATABASE_URL
+"""
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pytest
+
+# config читает окружение при импорте: временные файлы БД вместо рабочих
+_TMP_DIR = tempfile.mkdtemp(prefix='tgbot-tests-')
+os.environ.update({
+    'BOT_TOKEN': os.getenv('BOT_TOKEN', '123456:TEST'),
+    'ADMIN_IDS': os.getenv('ADMIN_IDS', '1'),
+    'DB_BACKEND': 'sqlite',
+    'DB_USERS_PATH': os.path.join(_TMP_DIR, 'users.db'),
+    'DB_SUBMISSIONS_PATH': os.path.join(_TMP_DIR, 'submissions.db'),
+    'DB_BANNED_PATH': os.path.join(_TMP_DIR, 'banned.db'),
+    'FSM_DB_PATH': os.path.join(_TMP_DIR, 'fsm.db'),
+    'FILES_DIR': os.path.join(_TMP_DIR, 'files'),
+})
+os.environ.pop('DB_UNIFIED_PATH', None)
+os.environ.pop('REDIS_URL', None)
+
+BACKENDS = ['sqlite'] + (['postgres'] if os.getenv('DATABASE_URL') else [])
+
+# Уникальные ID: в PostgreSQL могут остаться данные прошлых запусков
+_ids = itertools.count(int(time.time() * 1000) * 10)
+
+
+@pytest.fixture(scope='session')
+def loop():
+    """Один цикл событий: хранилища - singleton с соединениями, привязанными к циклу"""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope='module', params=BACKENDS)
+def storages(request, loop):
+    """Хранилища пользователей, обращений и блокировок выбранного бэкенда"""
+    from config import config
+    from database.storage import (
+        get_ban_storage, get_submission_storage, get_user_storage, init_all
+    )
+
+    previous, config.db_backend = config.db_backend, request.param
+    loop.run_until_complete(init_all())
+    users, submissions, bans = get_user_storage(), get_submission_storage(), get_ban_storage()
+    yield SimpleNamespace(
+        backend=request.param,
+        users=users,
+        submissions=submissions,
+        bans=bans,
+        run=loop.run_until_complete
+    )
+
+    async def close():
+        await submissions.close()
+        await bans.close()
+        # Пул PostgreSQL общий - закрывается последним
+        await users.close_all_connections()
+
+    loop.run_until_complete(close())
+    config.db_backend = previous
+
+
+@pytest.fixture
+def new_id():
+    """Новый ID пользователя на каждый вызов"""
+    return lambda: next(_ids)
@@ -0,0 +1,82 @@
+"""
+Тесты LocalActivityTracker: окно сообщений, повторы текста и вытеснение пользователей
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from utils import antispam
+from utils.antispam import (ACTIVITY_TTL, DUPLICATE_LIMIT, REASON_DUPLICATE, REASON_FLOOD,
+                            SPAM_MAX_MESSAGES, SPAM_WINDOW, LocalActivityTracker)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое время трекера: clock.now двигается тестом"""
+    fake = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(antispam, 'time', SimpleNamespace(time=lambda: fake.now))
+    return fake
+
+
+def send(tracker: LocalActivityTracker, user_id: int, text=None):
+    return asyncio.run(tracker.register(user_id, text))
+
+
+def test_flood_within_window(clock):
+    tracker = LocalActivityTracker(max_users=10)
+
+    for i in range(SPAM_MAX_MESSAGES):
+        assert send(tracker, 1, f'сообщение {i}') is None
+        clock.now += 1
+    assert send(tracker, 1, 'лишнее') == REASON_FLOOD
+
+
+def test_no_flood_after_window(clock):
+    tracker = LocalActivityTracker(max_users=10)
+
+    for i in range(SPAM_MAX_MESSAGES):
+        assert send(tracker, 1, f'сообщение {i}') is None
+    clock.now += SPAM_WINDOW + 1
+    assert send(tracker, 1, 'после окна') is None
+
+
+def test_repeated_text(clock):
+    tracker = LocalActivityTracker(max_users=10)
+
+    # Первое сообщение и DUPLICATE_LIMIT - 1 повторов проходят, следующий повтор - блокировка
+    for _ in range(DUPLICATE_LIMIT):
+        assert send(tracker, 1, 'одно и то же') is None
+        clock.now += SPAM_WINDOW
+    assert send(tracker, 1, 'одно и то же') == REASON_DUPLICATE
+
+    # Другой текст сбрасывает счетчик
+    assert send(tracker, 2, 'одно и то же') is None
+    assert send(tracker, 2, 'другое') is None
+    assert send(tracker, 2, 'одно и то же') is None
+
+
+def test_users_bounded_by_max_users(clock):
+    tracker = LocalActivityTracker(max_users=3)
+
+    for user_id in range(10):
+        send(tracker, user_id)
+        assert len(tracker.users) <= 3
+
+    # Вытесняются самые давно активные
+    assert list(tracker.users) == [7, 8, 9]
+    assert tracker.stats()['evicted'] == 7
+
+
+def test_idle_users_evicted_after_ttl(clock):
+    tracker = LocalActivityTracker(max_users=10)
+    send(tracker, 1)
+    send(tracker, 2)
+
+    clock.now += ACTIVITY_TTL / 2
+    send(tracker, 2)
+    clock.now += ACTIVITY_TTL / 2
+    send(tracker, 3)
+
+    assert list(tracker.users) == [2, 3]
+    assert tracker.stats()['users'] == 2
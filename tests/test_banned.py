@@ -0,0 +1,129 @@
+"""
+Тесты индекса активных блокировок (BanCache) и проверки блокировки через него
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from database.banned import BanCache
+
+NOW = datetime(2026, 1, 1, 12, 0)
+
+
+def ban_info(user_id: int, hours: float = 24, permanent: bool = False) -> dict:
+    return {
+        'user_id': user_id,
+        'username': 'tester',
+        'banned_at': NOW.isoformat(),
+        'banned_by': 1,
+        'reason': 'спам',
+        'expires_at': None if permanent else (NOW + timedelta(hours=hours)).isoformat(),
+        'is_permanent': permanent,
+        'ban_count': 3 if permanent else 1,
+        'last_ban_reason': 'спам'
+    }
+
+
+@pytest.fixture
+def db_reads(storages, monkeypatch):
+    """Обращения проверки блокировки к БД (после индекса их быть не должно)"""
+    calls = []
+    if storages.backend == 'postgres':
+        from database.postgres import PostgresPool
+        acquire = PostgresPool.acquire
+        monkeypatch.setattr(PostgresPool, 'acquire', lambda: calls.append('acquire') or acquire())
+    else:
+        get_connection = storages.bans._get_connection
+        monkeypatch.setattr(storages.bans, '_get_connection',
+                            lambda: calls.append('connection') or get_connection())
+    return calls
+
+
+# -------------------------------
+# BanCache
+# -------------------------------
+
+
+def test_cache_expires_temporary_ban():
+    cache = BanCache()
+    asyncio.run(cache.put(1, ban_info(1, hours=1)))
+
+    assert asyncio.run(cache.pop_expired(NOW + timedelta(minutes=30))) == []
+    expired = asyncio.run(cache.pop_expired(NOW + timedelta(hours=2)))
+    assert expired == [(1, (NOW + timedelta(hours=1)).isoformat())]
+    assert asyncio.run(cache.get(1)) is None
+
+
+def test_cache_reban_with_later_expiry_ignores_old_heap_entry():
+    cache = BanCache()
+    asyncio.run(cache.put(1, ban_info(1, hours=1)))
+    asyncio.run(cache.put(1, ban_info(1, hours=24 * 7)))
+
+    assert asyncio.run(cache.pop_expired(NOW + timedelta(hours=2))) == []
+    assert asyncio.run(cache.get(1))['expires_at'] == (NOW + timedelta(hours=24 * 7)).isoformat()
+    assert [user_id for user_id, _ in asyncio.run(cache.pop_expired(NOW + timedelta(days=8)))] == [1]
+
+
+def test_cache_permanent_ban_never_expires():
+    cache = BanCache()
+    asyncio.run(cache.put(1, ban_info(1, hours=1)))
+    asyncio.run(cache.put(1, ban_info(1, permanent=True)))
+
+    assert asyncio.run(cache.pop_expired(NOW + timedelta(days=365))) == []
+    assert asyncio.run(cache.get(1))['is_permanent'] is True
+
+
+def test_cache_unban_leaves_no_expiry():
+    cache = BanCache()
+    asyncio.run(cache.put(1, ban_info(1, hours=1)))
+
+    assert asyncio.run(cache.remove(1)) is True
+    assert asyncio.run(cache.get(1)) is None
+    assert asyncio.run(cache.pop_expired(NOW + timedelta(hours=2))) == []
+    assert cache.stats() == {'size': 0, 'hits': 0, 'misses': 1}
+
+
+# -------------------------------
+# Проверка блокировки через индекс
+# -------------------------------
+
+
+def test_expired_ban_not_read_from_db_again(storages, new_id, db_reads):
+    bans = storages.bans
+    user_id = new_id()
+    storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1, duration_hours=0))
+
+    # Первая проверка снимает истекшую блокировку, следующие отвечает индекс
+    assert storages.run(bans.lookup(user_id)) is None
+    db_reads.clear()
+    assert storages.run(bans.lookup(user_id)) is None
+    assert db_reads == []
+
+
+def test_reban_keeps_user_banned_past_first_expiry(storages, new_id):
+    bans = storages.bans
+    user_id = new_id()
+    first = storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1))
+    second = storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1))
+
+    after_first = datetime.fromisoformat(first['expires_at']) + timedelta(seconds=1)
+    assert storages.run(bans.cache.pop_expired(after_first)) == []
+
+    status = storages.run(bans.lookup(user_id))
+    assert status is not None and status.expires_at == second['expires_at']
+    storages.run(bans.unban_user(user_id))
+
+
+def test_unban_clears_index_immediately(storages, new_id, db_reads):
+    bans = storages.bans
+    user_id = new_id()
+    storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1))
+    size = len(bans.cache)
+
+    assert storages.run(bans.unban_user(user_id)) is True
+    db_reads.clear()
+
+    assert len(bans.cache) == size - 1
+    assert storages.run(bans.lookup(user_id)) is None
+    assert db_reads == []
@@ -0,0 +1,102 @@
+"""
+Тесты ConcurrencyMiddleware: порядок по пользователю, общий лимит и сброс нагрузки
+"""
+import asyncio
+from types import SimpleNamespace
+
+from middlewares.concurrency import ConcurrencyMiddleware
+
+
+class Recorder:
+    """Обработчик, который держит обновления до gate и запоминает порядок"""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.started = []
+        self.finished = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, event, data):
+        self.started.append(event)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await self.gate.wait()
+        # Переключение внутри обработчика: порядок не должен зависеть от планировщика
+        await asyncio.sleep(0)
+        self.running -= 1
+        self.finished.append(event)
+        return event
+
+
+def dispatch(middleware, handler, user_id, event):
+    data = {'event_from_user': SimpleNamespace(id=user_id)}
+    return asyncio.ensure_future(middleware(handler, event, data))
+
+
+def test_user_order_in_flight_limit_and_user_queue_shedding():
+    async def scenario():
+        middleware = ConcurrencyMiddleware(max_in_flight=2, max_pending=0, max_user_queue=2)
+        handler = Recorder()
+        tasks = [
+            dispatch(middleware, handler, 1, 'a1'),
+            dispatch(middleware, handler, 1, 'a2'),
+            dispatch(middleware, handler, 1, 'a3'),  # третье в очереди пользователя - сброс
+            dispatch(middleware, handler, 2, 'b1'),
+            dispatch(middleware, handler, 2, 'b2'),
+            dispatch(middleware, handler, 3, 'c1'),
+        ]
+        await asyncio.sleep(0)
+        in_progress = middleware.stats()
+        handler.gate.set()
+        results = await asyncio.gather(*tasks)
+        return middleware, handler, in_progress, results
+
+    middleware, handler, in_progress, results = asyncio.run(scenario())
+
+    assert in_progress['in_flight'] == 2
+    assert results == ['a1', 'a2', None, 'b1', 'b2', 'c1']
+    assert handler.max_running == 2
+    for user, expected in (('a', ['a1', 'a2']), ('b', ['b1', 'b2']), ('c', ['c1'])):
+        assert [e for e in handler.started if e[0] == user] == expected
+        assert [e for e in handler.finished if e[0] == user] == expected
+    stats = middleware.stats()
+    assert (stats['processed'], stats['shed']) == (5, 1)
+    assert (stats['in_flight'], stats['pending'], stats['users']) == (0, 0, 0)
+    assert middleware._queues == {}
+
+
+def test_global_pending_limit_sheds_updates():
+    async def scenario():
+        middleware = ConcurrencyMiddleware(max_in_flight=1, max_pending=2, max_user_queue=0)
+        handler = Recorder()
+        tasks = [dispatch(middleware, handler, user_id, f'u{user_id}') for user_id in range(1, 5)]
+        await asyncio.sleep(0)
+        # u1 обрабатывается, u2 и u3 ждут, u4 сверх max_pending
+        in_progress = middleware.stats()
+        handler.gate.set()
+        results = await asyncio.gather(*tasks)
+        return middleware, in_progress, results
+
+    middleware, in_progress, results = asyncio.run(scenario())
+
+    assert (in_progress['in_flight'], in_progress['pending']) == (1, 2)
+    assert results == ['u1', 'u2', 'u3', None]
+    assert (middleware.shed, middleware.processed) == (1, 3)
+    assert middleware._queues == {}
+
+
+def test_queue_released_when_handler_fails():
+    async def failing(event, data):
+        raise ValueError(event)
+
+    async def scenario():
+        middleware = ConcurrencyMiddleware(max_in_flight=1, max_pending=0, max_user_queue=2)
+        result = await asyncio.gather(dispatch(middleware, failing, 1, 'x'), return_exceptions=True)
+        return middleware, result
+
+    middleware, result = asyncio.run(scenario())
+
+    assert isinstance(result[0], ValueError)
+    assert middleware._queues == {}
+    assert middleware.stats()['in_flight'] == 0
@@ -0,0 +1,52 @@
+"""
+Тесты MediaGroupMiddleware: альбом приходит в обработчик одним вызовом
+"""
+import asyncio
+from datetime import datetime
+
+from aiogram.types import Update
+
+from middlewares.media_group import MediaGroupMiddleware
+
+CHAT = {'id': 7, 'type': 'private'}
+USER = {'id': 7, 'is_bot': False, 'first_name': 'Test'}
+
+
+def make_update(message_id: int, media_group_id=None, caption=None, text=None) -> Update:
+    message = {'message_id': message_id, 'date': datetime.now(), 'chat': CHAT, 'from': USER}
+    if media_group_id:
+        message.update(media_group_id=media_group_id, caption=caption,
+                       photo=[{'file_id': f'photo{message_id}', 'file_unique_id': f'u{message_id}',
+                               'width': 10, 'height': 10}])
+    else:
+        message['text'] = text
+    return Update.model_validate({'update_id': message_id, 'message': message})
+
+
+def test_album_reaches_handler_once_in_order():
+    calls = []
+
+    async def handler(event, data):
+        album = data.get('album')
+        calls.append((event.message.message_id, event.message.caption or event.message.text,
+                      [item.message_id for item in album] if album else None))
+        return event.message.message_id
+
+    async def scenario():
+        middleware = MediaGroupMiddleware(wait=0.05)
+        updates = [make_update(3, 'g1'), make_update(2, 'g1', caption='подпись'), make_update(4, 'g1')]
+        tasks = [asyncio.ensure_future(middleware(handler, update, {})) for update in updates]
+        await asyncio.sleep(0.01)
+        # Обычное сообщение до окончания сборки альбома ждет, пока альбом уйдет дальше
+        plain = asyncio.ensure_future(middleware(handler, make_update(5, text='📤 Отправить'), {}))
+        await asyncio.sleep(0.01)
+        waited = not plain.done() and calls == []
+        results = await asyncio.gather(*tasks, plain)
+        return middleware, waited, results
+
+    middleware, waited, results = asyncio.run(scenario())
+
+    assert waited
+    assert calls == [(2, 'подпись', [2, 3, 4]), (5, '📤 Отправить', None)]
+    assert results == [2, None, None, 5]
+    assert middleware._groups == {} and middleware._released == {}
@@ -0,0 +1,156 @@
+"""
+Тесты интерфейсов UserStorage, SubmissionStorage и BanStorage
+Одни и те же проверки для SQLite и PostgreSQL (фикстура storages)
+"""
+from aiogram.types import User
+
+# Колонки строки submissions
+STATUS = 5
+CREATED_AT = 9
+
+
+def make_user(user_id: int, username: str = 'tester') -> User:
+    return User(id=user_id, is_bot=False, first_name='Test', username=username)
+
+
+# -------------------------------
+# Пользователи
+# -------------------------------
+
+
+def test_save_user_reports_new_user(storages, new_id):
+    user_id = new_id()
+
+    assert storages.run(storages.users.save_user(make_user(user_id))) is True
+    assert storages.run(storages.users.save_user(make_user(user_id, 'renamed'))) is False
+
+    row = storages.run(storages.users.get_user(user_id))
+    assert row[0] == user_id
+    assert row[1] == 'renamed'
+
+
+def test_unreachable_users_skipped_in_broadcast_ids(storages, new_id):
+    user_ids = [new_id() for _ in range(3)]
+    for user_id in user_ids:
+        storages.run(storages.users.save_user(make_user(user_id)))
+
+    storages.run(storages.users.note_delivery_failure(user_ids[1], 'blocked'))
+    assert storages.run(storages.users.flush_delivery_failures()) == 1
+
+    after = user_ids[0] - 1
+    active = storages.run(storages.users.get_user_ids_after(after, limit=1000))
+    every = storages.run(storages.users.get_user_ids_after(after, limit=1000, include_unreachable=True))
+    assert [i for i in active if i in user_ids] == [user_ids[0], user_ids[2]]
+    assert [i for i in every if i in user_ids] == user_ids
+
+
+# -------------------------------
+# Обращения
+# -------------------------------
+
+
+def test_submission_lifecycle(storages, new_id):
+    db = storages.submissions
+    user_id = new_id()
+    new_before = storages.run(db.count_submissions('new'))
+    solved_before = storages.run(db.count_submissions('solved'))
+
+    submission_id = storages.run(db.add_submission(user_id, 'tester', 'текст', ['file1']))
+    assert storages.run(db.get_submission_by_id(submission_id))[STATUS] == 'new'
+    assert storages.run(db.count_submissions('new')) == new_before + 1
+
+    storages.run(db.mark_as_viewed(submission_id))
+    assert storages.run(db.get_submission_by_id(submission_id))[STATUS] == 'viewed'
+
+    storages.run(db.mark_as_solved(submission_id))
+    assert storages.run(db.get_submission_by_id(submission_id))[STATUS] == 'solved'
+    assert storages.run(db.count_submissions('new')) == new_before
+    assert storages.run(db.count_submissions('solved')) == solved_before + 1
+
+    own = storages.run(db.get_user_submissions(user_id))
+    assert [row[0] for row in own] == [submission_id]
+
+    storages.run(db.delete_submission(submission_id))
+    assert storages.run(db.get_submission_by_id(submission_id)) is None
+    assert storages.run(db.count_submissions('solved')) == solved_before
+
+
+def test_admin_response_added_to_history(storages, new_id):
+    db = storages.submissions
+    submission_id = storages.run(db.add_submission(new_id(), 'tester', 'вопрос'))
+
+    storages.run(db.save_admin_response(submission_id, 'ответ', admin_id=1))
+
+    history = storages.run(db.get_conversation_history(submission_id))
+    assert [(row[0], row[1]) for row in history] == [('user', 'вопрос'), ('admin', 'ответ')]
+    storages.run(db.delete_submission(submission_id))
+
+
+def test_counters_match_recompute(storages, new_id):
+    db = storages.submissions
+    ids = [storages.run(db.add_submission(new_id(), 'tester', f'текст {i}')) for i in range(3)]
+    storages.run(db.batch_update_status(ids[:2], 'viewed'))
+
+    counted = {status: storages.run(db.count_submissions(status)) for status in ('new', 'viewed', 'solved')}
+    total = storages.run(db.count_submissions())
+    recomputed = storages.run(db.recompute_counters())
+
+    for status, count in counted.items():
+        assert recomputed.get(status, 0) == count
+    assert recomputed['total'] == total
+
+    for submission_id in ids:
+        storages.run(db.delete_submission(submission_id))
+
+
+def test_submissions_page_keyset(storages, new_id):
+    db = storages.submissions
+    ids = [storages.run(db.add_submission(new_id(), 'tester', f'страница {i}')) for i in range(5)]
+
+    first = storages.run(db.get_submissions_page(limit=2))
+    cursor = (first[-1][CREATED_AT], first[-1][0])
+    second = storages.run(db.get_submissions_page(cursor=cursor, limit=2))
+    keys = [(row[CREATED_AT], row[0]) for row in first + second]
+    assert keys == sorted(keys, reverse=True)
+    assert len(set(keys)) == 4
+
+    back = storages.run(db.get_submissions_page(
+        cursor=(second[0][CREATED_AT], second[0][0]), direction='prev', limit=2))
+    assert [row[0] for row in back] == [row[0] for row in first]
+
+    for submission_id in ids:
+        storages.run(db.delete_submission(submission_id))
+
+
+# -------------------------------
+# Блокировки
+# -------------------------------
+
+
+def test_progressive_bans(storages, new_id):
+    bans = storages.bans
+    user_id = new_id()
+
+    first = storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1))
+    second = storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1))
+    third = storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1))
+    assert (first['ban_count'], first['is_permanent']) == (1, False)
+    assert (second['ban_count'], second['duration_hours']) == (2, 24 * 7)
+    assert (third['ban_count'], third['is_permanent']) == (3, True)
+
+    status = storages.run(bans.lookup(user_id))
+    assert status.is_permanent and status.reason == 'спам'
+    assert user_id in [info['user_id'] for info in storages.run(bans.get_banned_list())]
+
+    assert storages.run(bans.unban_user(user_id)) is True
+    assert storages.run(bans.is_banned(user_id)) is False
+
+
+def test_expired_ban_lifted_on_lookup(storages, new_id):
+    bans = storages.bans
+    user_id = new_id()
+
+    storages.run(bans.ban_user(user_id, 'tester', 'спам', banned_by=1, duration_hours=0))
+
+    assert storages.run(bans.lookup(user_id)) is None
+    assert user_id not in [info['user_id'] for info in storages.run(bans.get_banned_list())]
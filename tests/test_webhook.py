@@ -0,0 +1,74 @@
+"""
+Тесты webhook-сервера: локальный HTTP-клиент отправляет поддельные обновления
+"""
+import time
+
+import pytest
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+from aiohttp.test_utils import TestClient, TestServer
+
+from config import config
+from utils.webhook import create_webhook_app, wait_pending_updates
+
+SECRET = 'test_secret'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def make_update(update_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 5, 'type': 'private'},
+            'from': {'id': 5, 'is_bot': False, 'first_name': 'Test'},
+            'text': text
+        }
+    }
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    """Приложение webhook с диспетчером, запоминающим тексты сообщений"""
+    monkeypatch.setattr(config, 'webhook_secret', SECRET)
+    seen = []
+    router = Router()
+
+    @router.message()
+    async def remember(message: Message):
+        seen.append(message.text)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return create_webhook_app(Bot('123456:TEST'), dp), seen
+
+
+def test_rejects_wrong_secret_and_accepts_valid_update(storages, webhook):
+    app, seen = webhook
+
+    async def scenario():
+        async with TestClient(TestServer(app)) as client:
+            missing = await client.post(config.webhook_path, json=make_update(1, 'no secret'))
+            wrong = await client.post(config.webhook_path, json=make_update(2, 'wrong'),
+                                      headers={SECRET_HEADER: 'wrong'})
+            valid = await client.post(config.webhook_path, json=make_update(3, 'hello'),
+                                      headers={SECRET_HEADER: SECRET})
+            await wait_pending_updates(app)
+            return missing.status, wrong.status, valid.status
+
+    assert storages.run(scenario()) == (401, 401, 200)
+    assert seen == ['hello']
+
+
+def test_health_reports_database_state(storages, webhook):
+    app, _ = webhook
+
+    async def scenario():
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get('/health')
+            return response.status, await response.json()
+
+    status, body = storages.run(scenario())
+    assert status == 200
+    assert body['status'] == 'ok'
@@ -0,0 +1,172 @@
+"""
+Антиспам: скользящее окно сообщений и повторы одного текста
+Состояние в памяти процесса или в Redis (общее для нескольких процессов бота)
+"""
+import hashlib
+import itertools
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from config import config
+
+SPAM_WINDOW = 60  # сек
+SPAM_MAX_MESSAGES = 5  # сообщений в окне
+DUPLICATE_LIMIT = 3  # повторов одного текста подряд
+# Сколько Redis помнит последний текст пользователя, сек
+DUPLICATE_TTL = 3600
+# Через сколько секунд без сообщений пользователь забывается трекером в памяти
+ACTIVITY_TTL = DUPLICATE_TTL
+
+REASON_FLOOD = "Спам: более 5 сообщений за минуту"
+REASON_DUPLICATE = "Спам: отправка одинаковых сообщений"
+
+
+class ActivityTracker(ABC):
+    """Учет активности пользователей для автоматической блокировки"""
+
+    @abstractmethod
+    async def register(self, user_id: int, message_text: Optional[str] = None) -> Optional[str]:
+        """Учитывает сообщение, возвращает причину блокировки или None"""
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики для PerformanceMonitor (состояние в Redis здесь не учитывается)"""
+        return {'users': 0, 'evicted': 0, 'memory_bytes': 0}
+
+
+class _UserActivity:
+    """Активность одного пользователя: кольцевой буфер времени последних сообщений"""
+    __slots__ = ('times', 'head', 'last_seen', 'last_text', 'duplicate_count')
+
+    def __init__(self):
+        self.times = array('d', bytes(8 * SPAM_MAX_MESSAGES))
+        self.head = 0  # самая старая запись буфера
+        self.last_seen = 0.0
+        self.last_text: Optional[int] = None  # hash текста, сам текст не храним
+        self.duplicate_count = 0
+
+
+class LocalActivityTracker(ActivityTracker):
+    """
+    Состояние в памяти процесса. Пользователи в порядке последней активности:
+    неактивные дольше ACTIVITY_TTL и сверх max_users вытесняются с начала
+    """
+
+    def __init__(self, max_users: Optional[int] = None):
+        self.users: "OrderedDict[int, _UserActivity]" = OrderedDict()
+        self.max_users = max_users or config.antispam_max_users
+        self.evicted = 0
+
+    def _evict(self, now: float):
+        users = self.users
+        while users:
+            user_id, activity = next(iter(users.items()))
+            if len(users) <= self.max_users and now - activity.last_seen < ACTIVITY_TTL:
+                break
+            del users[user_id]
+            self.evicted += 1
+
+    async def register(self, user_id: int, message_text: Optional[str] = None) -> Optional[str]:
+        now = time.time()
+
+        activity = self.users.get(user_id)
+        if activity is None:
+            activity = self.users[user_id] = _UserActivity()
+        else:
+            self.users.move_to_end(user_id)
+        activity.last_seen = now
+        self._evict(now)
+
+        # В буфере SPAM_MAX_MESSAGES предыдущих сообщений: если самое старое
+        # из них моложе окна, вместе с текущим их больше лимита
+        oldest = activity.times[activity.head]
+        activity.times[activity.head] = now
+        activity.head = (activity.head + 1) % SPAM_MAX_MESSAGES
+        if now - oldest < SPAM_WINDOW:
+            return REASON_FLOOD
+
+        # Проверяем дублирование сообщений
+        if message_text:
+            text_hash = hash(message_text)
+            if activity.last_text == text_hash:
+                activity.duplicate_count += 1
+                if activity.duplicate_count >= DUPLICATE_LIMIT:
+                    return REASON_DUPLICATE
+            else:
+                activity.duplicate_count = 0
+                activity.last_text = text_hash
+
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        users = len(self.users)
+        entry = _UserActivity()
+        # Оценка: словарь + на каждого пользователя объект, буфер и ключ
+        per_user = sys.getsizeof(entry) + sys.getsizeof(entry.times) + sys.getsizeof(2 ** 40)
+        return {
+            'users': users,
+            'evicted': self.evicted,
+            'memory_bytes': sys.getsizeof(self.users) + users * per_user
+        }
+
+
+class RedisActivityTracker(ActivityTracker):
+    """
+    Состояние в Redis: окно - sorted set с временем сообщений,
+    повторы - хэш последнего текста и счетчик. Один round trip на сообщение
+    """
+
+    def __init__(self):
+        from database.shared_state import get_redis
+        self.redis = get_redis()
+        # Уникальная часть элемента окна: сообщения в одну микросекунду не схлопываются
+        self._sequence = itertools.count()
+        self._pid = os.getpid()
+
+    async def register(self, user_id: int, message_text: Optional[str] = None) -> Optional[str]:
+        from database.shared_state import redis_key
+
+        now = time.time()
+        window_key = redis_key('spam', user_id, 'window')
+        last_key = redis_key('spam', user_id, 'last')
+        repeats_key = redis_key('spam', user_id, 'repeats')
+        digest = hashlib.sha1(message_text.encode()).hexdigest() if message_text else None
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(window_key, 0, now - SPAM_WINDOW)
+            pipe.zadd(window_key, {f"{now:.6f}:{self._pid}:{next(self._sequence)}": now})
+            pipe.zcard(window_key)
+            pipe.expire(window_key, SPAM_WINDOW)
+            if digest:
+                pipe.set(last_key, digest, ex=DUPLICATE_TTL, get=True)
+                pipe.incr(repeats_key)
+                pipe.expire(repeats_key, DUPLICATE_TTL)
+            results = await pipe.execute()
+
+        if results[2] > SPAM_MAX_MESSAGES:
+            return REASON_FLOOD
+
+        if digest:
+            previous, repeats = results[4], results[5]
+            if previous != digest:
+                # Новый текст: счетчик повторов начинается заново
+                await self.redis.set(repeats_key, 0, ex=DUPLICATE_TTL)
+            elif repeats >= DUPLICATE_LIMIT:
+                return REASON_DUPLICATE
+
+        return None
+
+
+_tracker: Optional[ActivityTracker] = None
+
+
+def get_activity_tracker() -> ActivityTracker:
+    """Трекер активности: в Redis при REDIS_URL, иначе в памяти"""
+    global _tracker
+    if _tracker is None:
+        _tracker = RedisActivityTracker() if config.shared_state else LocalActivityTracker()
+    return _tracker
@@ -0,0 +1,418 @@
+"""
+Движок массовой рассылки
+
+Получатели читаются из users порциями (keyset-пагинация по user_id),
+отправка идет несколькими воркерами через общий token bucket с учетом
+лимитов Telegram: ~30 сообщений/с глобально и ~1 сообщение/с в один чат.
+Задания и доставки хранятся в БД (database.broadcasts), поэтому рассылка
+продолжается после перезапуска и не отправляется пользователю повторно.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InputMediaDocument, InputMediaPhoto, MediaUnion, Message
+
+from config import config
+from database.broadcasts import BroadcastDB
+from utils.checks import get_delivery_status
+
+logger = logging.getLogger(__name__)
+
+# Один шаг отправки получателю: (bot, chat_id) -> вызов API
+BroadcastStep = Callable[[Bot, int], Awaitable[Any]]
+
+# Максимум повторов одного вызова после RetryAfter
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+# Как часто обновлять сообщение с прогрессом (секунды)
+PROGRESS_UPDATE_INTERVAL = 5.0
+
+# Сколько результатов доставки копить до записи в БД
+RESULTS_FLUSH_SIZE = 100
+
+# Лимиты Telegram: подпись к медиа и файлов в рассылке
+MAX_CAPTION_LENGTH = 1024
+MAX_BROADCAST_FILES = 5
+
+# Сколько ждать завершения начатых отправок при остановке (секунды)
+GRACEFUL_STOP_TIMEOUT = 10.0
+
+
+class RateLimiter:
+    """Token bucket для глобального лимита + минимальный интервал на чат"""
+
+    def __init__(self, rate: float, capacity: Optional[int] = None, per_chat_interval: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.per_chat_interval = per_chat_interval
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._chat_last_sent: Dict[int, float] = {}
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, chat_id: int):
+        """Ждет, пока можно сделать очередной вызов API в чат"""
+        # Лимит на один чат
+        last_sent = self._chat_last_sent.get(chat_id)
+        if last_sent is not None:
+            wait = last_sent + self.per_chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        # Глобальный лимит
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+        self._chat_last_sent[chat_id] = time.monotonic()
+
+    def pause(self, seconds: float):
+        """Приостанавливает все отправки (flood control от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def release(self, chat_id: int):
+        """Забывает чат после завершения отправки ему"""
+        self._chat_last_sent.pop(chat_id, None)
+
+
+@dataclass
+class BroadcastStats:
+    """Счетчики рассылки"""
+    total: int = 0
+    success: int = 0
+    failed: int = 0
+    skipped: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished: bool = False
+
+    @property
+    def processed(self) -> int:
+        return self.success + self.failed
+
+    def format(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        title = "✅ Рассылка завершена" if self.finished else "⏳ Идет рассылка"
+        text = (
+            f"{title}:\n"
+            f"• Обработано: {self.processed}\n"
+            f"• Доставлено: {self.success}\n"
+            f"• Не доставлено: {self.failed}\n"
+        )
+        if self.skipped:
+            text += f"• Пропущено: {self.skipped}\n"
+        text += f"• Время: {int(elapsed)} сек."
+        return text
+
+
+def _normalize_files(files: Iterable[Any]) -> List[Dict[str, str]]:
+    """Приводит файлы payload к виду {'file_id', 'type'} (старые задания хранили только file_id фото)"""
+    normalized = []
+    for item in files:
+        if isinstance(item, dict):
+            normalized.append({'file_id': item['file_id'],
+                               'type': item.get('type', 'photo')})
+        else:
+            normalized.append({'file_id': item, 'type': 'photo'})
+    return normalized
+
+
+def _single_file_step(item: Dict[str, str], caption: Optional[str]) -> BroadcastStep:
+    if item['type'] == 'document':
+        return lambda bot, chat_id: bot.send_document(chat_id, item['file_id'], caption=caption)
+    return lambda bot, chat_id: bot.send_photo(chat_id, item['file_id'], caption=caption)
+
+
+def _media_group_step(items: List[Dict[str, str]], caption: Optional[str]) -> BroadcastStep:
+    media: List[MediaUnion] = []
+    for i, item in enumerate(items):
+        media_cls = InputMediaDocument if item['type'] == 'document' else InputMediaPhoto
+        # Подпись у первого файла показывается как подпись всей группы
+        media.append(media_cls(media=item['file_id'], caption=caption if i == 0 else None))
+    return lambda bot, chat_id: bot.send_media_group(chat_id, media)
+
+
+def build_steps(payload: Dict[str, Any]) -> List[BroadcastStep]:
+    """
+    Строит шаги отправки из сохраняемого в БД payload рассылки.
+    Текст и файлы упаковываются в одну медиа-группу: фото и документы
+    нельзя смешивать в одной группе, поэтому они идут отдельными группами.
+    """
+    text = payload.get('text') or ''
+    files = _normalize_files(payload.get('files', []))[:MAX_BROADCAST_FILES]
+    if not files:
+        return [lambda bot, chat_id: bot.send_message(chat_id, text)] if text else []
+
+    # Длинный текст не помещается в подпись — отправляем его отдельно
+    caption = text if text and len(text) <= MAX_CAPTION_LENGTH else None
+
+    groups = [
+        [item for item in files if item['type'] != 'document'],
+        [item for item in files if item['type'] == 'document']
+    ]
+    steps: List[BroadcastStep] = []
+    for group in groups:
+        if not group:
+            continue
+        group_caption, caption = caption, None
+        if len(group) == 1:
+            steps.append(_single_file_step(group[0], group_caption))
+        else:
+            steps.append(_media_group_step(group, group_caption))
+
+    if text and len(text) > MAX_CAPTION_LENGTH:
+        steps.append(lambda bot, chat_id: bot.send_message(chat_id, text))
+    return steps
+
+
+class BroadcastEngine:
+    """Рассылка одного задания всем пользователям в фоне"""
+
+    def __init__(self, bot: Bot, db, store: BroadcastDB, job: Dict[str, Any],
+                 limiter: Optional[RateLimiter] = None,
+                 concurrency: Optional[int] = None,
+                 chunk_size: Optional[int] = None):
+        self.bot = bot
+        self.db = db
+        self.store = store
+        self.job_id: int = job['id']
+        self.steps = build_steps(job['payload'])
+        self.exclude_ids: Set[int] = set(job.get('exclude_ids') or [])
+        self.start_after: int = job.get('last_user_id') or 0
+        self.status_chat_id: Optional[int] = job.get('status_chat_id')
+        self.status_message_id: Optional[int] = job.get('status_message_id')
+        self.limiter = limiter or RateLimiter(config.broadcast_rate_limit)
+        self.concurrency = concurrency or config.broadcast_concurrency
+        self.chunk_size = chunk_size or config.broadcast_chunk_size
+        self.stats = BroadcastStats(
+            success=job.get('sent_count') or 0,
+            failed=job.get('failed_count') or 0
+        )
+        # Занятые в БД получатели, которых воркеры еще не взяли
+        self._claimed: Dict[int, None] = {}
+        self._results: List[Tuple[int, str, Optional[str]]] = []
+        self._in_flight: Set[asyncio.Task] = set()
+        self._flush_lock = asyncio.Lock()
+
+    async def _call(self, step: BroadcastStep, chat_id: int):
+        """Один вызов API с учетом лимитов и RetryAfter"""
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                return await step(self.bot, chat_id)
+            except TelegramRetryAfter as e:
+                if attempt >= MAX_RETRY_AFTER_ATTEMPTS:
+                    raise
+                logger.warning(
+                    f"⏸️ Flood control: пауза {e.retry_after} сек. (чат {chat_id})")
+                self.limiter.pause(e.retry_after)
+
+    async def _send_to(self, chat_id: int):
+        try:
+            for step in self.steps:
+                await self._call(step, chat_id)
+            self.stats.success += 1
+            self._results.append((chat_id, 'sent', None))
+        except Exception as e:
+            delivery_status = get_delivery_status(e)
+            if delivery_status:
+                # Заблокировал бота / удалил аккаунт - исключаем из следующих рассылок
+                logger.info(f"🚫 Пользователь {chat_id} недоступен: {delivery_status}")
+                await self.db.note_delivery_failure(chat_id, delivery_status)
+            else:
+                logger.error(f"Ошибка отправки пользователю {chat_id}: {e}")
+            self.stats.failed += 1
+            self._results.append((chat_id, 'failed', str(e)[:200]))
+        finally:
+            self.limiter.release(chat_id)
+        if len(self._results) >= RESULTS_FLUSH_SIZE:
+            await self._flush_results()
+
+    async def _flush_results(self):
+        """Сохраняет накопленные результаты одной транзакцией"""
+        async with self._flush_lock:
+            results, self._results = self._results, []
+            await self.store.record_results(self.job_id, results)
+            await self.db.flush_delivery_failures()
+
+    async def _produce(self, queue: asyncio.Queue):
+        """Читает получателей порциями по user_id и занимает их в БД"""
+        last_id = self.start_after
+        while True:
+            user_ids = await self.db.get_user_ids_after(last_id, self.chunk_size)
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+            recipients = []
+            for user_id in user_ids:
+                if user_id in self.exclude_ids:
+                    self.stats.skipped += 1
+                else:
+                    recipients.append(user_id)
+
+            # Занимаем небольшими порциями, чтобы при сбое терялось минимум
+            for i in range(0, len(recipients), self.concurrency):
+                batch = recipients[i:i + self.concurrency]
+                claimed = await self.store.claim_recipients(self.job_id, batch)
+                for user_id in claimed:
+                    self._claimed[user_id] = None
+                for user_id in claimed:
+                    self.stats.total += 1
+                    await queue.put(user_id)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                if chat_id is None:
+                    return
+                self._claimed.pop(chat_id, None)
+                # Отправка защищена от отмены воркера, чтобы при остановке
+                # бота начатая доставка успела завершиться и записаться
+                task = asyncio.create_task(self._send_to(chat_id))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+                await asyncio.shield(task)
+            finally:
+                queue.task_done()
+
+    async def _report_progress(self):
+        if self.status_chat_id is None or self.status_message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text=self.stats.format(),
+                chat_id=self.status_chat_id,
+                message_id=self.status_message_id
+            )
+        except Exception as e:
+            # Игнорируем ошибку "message is not modified"
+            if "message is not modified" not in str(e):
+                logger.error(f"Ошибка обновления прогресса рассылки: {e}")
+
+    async def _progress_loop(self):
+        while True:
+            await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+            await self._flush_results()
+            await self._report_progress()
+
+    async def run(self) -> BroadcastStats:
+        """Выполняет рассылку до конца или до отмены"""
+        # Отложенные записи (новые пользователи, недоставки) должны учесться до выборки
+        await self.db.flush_pending_writes()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue))
+                   for _ in range(self.concurrency)]
+        progress_task = asyncio.create_task(self._progress_loop())
+        try:
+            await self._produce(queue)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            # Остановка бота: сохраняем прогресс, задание продолжится при запуске
+            for task in workers + [progress_task]:
+                task.cancel()
+            await asyncio.gather(*workers, progress_task, return_exceptions=True)
+            if self._in_flight:
+                _, pending = await asyncio.wait(
+                    list(self._in_flight), timeout=GRACEFUL_STOP_TIMEOUT)
+                for task in pending:
+                    task.cancel()
+            await self._flush_results()
+            await self.store.release_claims(self.job_id, list(self._claimed))
+            logger.info(f"⏸️ Рассылка #{self.job_id} приостановлена")
+            raise
+        finally:
+            for task in workers:
+                task.cancel()
+            progress_task.cancel()
+
+        await self._flush_results()
+        await self.store.finish_job(self.job_id)
+        self.stats.finished = True
+        await self._report_progress()
+
+        logger.info(
+            f"📨 Рассылка #{self.job_id} завершена: доставлено {self.stats.success}, "
+            f"не доставлено {self.stats.failed}")
+        return self.stats
+
+
+# Ссылки на фоновые рассылки, чтобы задачи не собирал GC
+_running_broadcasts: Set[asyncio.Task] = set()
+
+
+def _start_engine(engine: BroadcastEngine) -> asyncio.Task:
+    task = asyncio.create_task(engine.run())
+    _running_broadcasts.add(task)
+    task.add_done_callback(_running_broadcasts.discard)
+    return task
+
+
+async def start_broadcast(bot: Bot, db, payload: Dict[str, Any], created_by: int,
+                          status_message: Message,
+                          exclude_ids: Optional[Iterable[int]] = None) -> asyncio.Task:
+    """Сохраняет задание рассылки и запускает его фоновой задачей"""
+    store = BroadcastDB()
+    await store.init()
+    exclude = list(exclude_ids or [])
+    job_id = await store.create_job(
+        payload,
+        created_by,
+        exclude_ids=exclude,
+        status_chat_id=status_message.chat.id,
+        status_message_id=status_message.message_id
+    )
+    job = {
+        'id': job_id,
+        'payload': payload,
+        'exclude_ids': exclude,
+        'status_chat_id': status_message.chat.id,
+        'status_message_id': status_message.message_id
+    }
+    return _start_engine(BroadcastEngine(bot, db, store, job))
+
+
+async def resume_broadcasts(bot: Bot, db) -> int:
+    """Продолжает рассылки, прерванные остановкой бота"""
+    store = BroadcastDB()
+    await store.init()
+    jobs = await store.get_unfinished_jobs()
+    for job in jobs:
+        stale = await store.mark_stale_pending(job['id'])
+        if stale:
+            logger.warning(
+                f"⚠️ Рассылка #{job['id']}: {stale} доставок прервано аварийно, повторно не отправляются")
+        logger.info(
+            f"▶️ Возобновление рассылки #{job['id']} с user_id > {job['last_user_id']}")
+        _start_engine(BroadcastEngine(bot, db, store, job))
+    return len(jobs)
+
+
+async def stop_broadcasts():
+    """Приостанавливает рассылки (при остановке бота), прогресс сохраняется"""
+    tasks = list(_running_broadcasts)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
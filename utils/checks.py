@@ -4,9 +4,11 @@
 import logging
 from typing import Optional, Union
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.types import Message, User
 from config import config
-from database.banned import BannedDB
+from database.banned import BanStatus
+from database.storage import BanStorage, DELIVERY_BLOCKED, DELIVERY_DEACTIVATED, get_ban_storage
 
 logger = logging.getLogger(__name__)
 
@@ -211,34 +213,60 @@ def get_error_message(error: Exception) -> str:
         return "❌ Произошла неизвестная ошибка"
 
 
-# Глобальный экземпляр БД блокировок
-_banned_db = None
+def get_delivery_status(error: Exception) -> Optional[str]:
+    """
+    Определяет, недоступен ли пользователь для доставки после ошибки отправки
 
+    Args:
+        error: Исключение при отправке сообщения
 
-def get_banned_db() -> BannedDB:
-    """Получает экземпляр БД блокировок"""
-    global _banned_db
-    if _banned_db is None:
-        _banned_db = BannedDB()
-    return _banned_db
+    Returns:
+        Optional[str]: 'blocked' / 'deactivated' или None, если ошибка временная
+    """
+    text = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        if "deactivated" in text:
+            return DELIVERY_DEACTIVATED
+        return DELIVERY_BLOCKED
+    if isinstance(error, TelegramBadRequest) and "chat not found" in text:
+        return DELIVERY_DEACTIVATED
+    return None
 
 
-async def is_user_banned(user_id: int) -> bool:
+def get_banned_db() -> BanStorage:
+    """Получает хранилище блокировок выбранного бэкенда (Singleton)"""
+    return get_ban_storage()
+
+
+async def get_ban_status(user_id: int) -> Optional[BanStatus]:
     """
-    Проверяет, заблокирован ли пользователь
+    Проверяет блокировку и возвращает её параметры одним запросом
 
     Args:
         user_id: ID пользователя
 
     Returns:
-        bool: True если пользователь заблокирован
+        Optional[BanStatus]: Параметры блокировки или None, если не заблокирован
     """
     try:
         banned_db = get_banned_db()
-        return await banned_db.is_banned(user_id)
+        return await banned_db.lookup(user_id)
     except Exception as e:
         logger.error(f"Ошибка проверки блокировки: {e}")
-        return False
+        return None
+
+
+async def is_user_banned(user_id: int) -> bool:
+    """
+    Проверяет, заблокирован ли пользователь
+
+    Args:
+        user_id: ID пользователя
+
+    Returns:
+        bool: True если пользователь заблокирован
+    """
+    return await get_ban_status(user_id) is not None
 
 
 async def get_ban_info(user_id: int) -> Optional[dict]:
@@ -251,12 +279,8 @@ async def get_ban_info(user_id: int) -> Optional[dict]:
     Returns:
         Optional[dict]: Информация о блокировке или None
     """
-    try:
-        banned_db = get_banned_db()
-        return await banned_db.get_ban_info(user_id)
-    except Exception as e:
-        logger.error(f"Ошибка получения информации о блокировке: {e}")
-        return None
+    status = await get_ban_status(user_id)
+    return status.to_dict() if status else None
 
 
 async def ban_user(user_id: int, username: str, reason: str, banned_by: int) -> dict:
@@ -0,0 +1,122 @@
+"""
+Режим webhook: aiohttp-сервер вместо long polling
+Telegram сам присылает обновления, несколько процессов могут стоять за балансировщиком
+"""
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from config import config, BOT_VERSION
+from database import get_submission_storage
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PATH = "/health"
+# Сколько ждать обработки уже принятых обновлений при остановке, сек
+SHUTDOWN_TIMEOUT = 30.0
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    """Проверка для балансировщика: 503, если нет соединения с БД обратной связи"""
+    connected = get_submission_storage().is_connected
+    return web.json_response(
+        {'status': 'ok' if connected else 'unavailable', 'version': BOT_VERSION},
+        status=200 if connected else 503
+    )
+
+
+class WebhookRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик webhook: Telegram сразу получает 200, обновление обрабатывается
+    в фоновой задаче. Задачи учитываются здесь, а не во внутреннем наборе aiogram,
+    чтобы при остановке их гарантированно дождаться
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: Optional[str] = None, **data: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token, **data)
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update: Dict[str, Any] = await request.json(loads=bot.session.json_loads)
+        task = asyncio.create_task(self._feed_update(bot, update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _feed_update(self, bot: Bot, update: Dict[str, Any]):
+        result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot=bot, result=result)
+
+
+WEBHOOK_HANDLER = web.AppKey('webhook_handler', WebhookRequestHandler)
+
+
+def create_webhook_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    """
+    aiohttp-приложение: POST WEBHOOK_PATH с проверкой X-Telegram-Bot-Api-Secret-Token
+    и GET /health. Обновления обрабатываются в фоне, Telegram сразу получает 200
+    """
+    app = web.Application()
+    handler = WebhookRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=config.webhook_secret
+    )
+    handler.register(app, path=config.webhook_path)
+    app[WEBHOOK_HANDLER] = handler
+    app.router.add_get(HEALTH_PATH, health_handler)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def wait_pending_updates(app: web.Application, timeout: float = SHUTDOWN_TIMEOUT):
+    """Дожидается обработки обновлений, принятых до остановки сервера"""
+    tasks = set(app[WEBHOOK_HANDLER].tasks)
+    if not tasks:
+        return
+    logger.info(f"⏳ Завершение обработки обновлений: {len(tasks)}")
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        logger.warning(f"⚠️ Не дождались обработки обновлений: {len(pending)}")
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, shutdown_event: asyncio.Event,
+                      allowed_updates: Optional[List[str]] = None):
+    """Регистрирует webhook и обслуживает запросы до shutdown_event"""
+    app = create_webhook_app(bot, dp)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=config.webhook_host, port=config.webhook_port)
+    await site.start()
+    logger.info(
+        f"🌐 Webhook-сервер слушает {config.webhook_host}:{config.webhook_port}{config.webhook_path}")
+
+    try:
+        # Обновления, пришедшие пока бот был остановлен, не сбрасываются
+        await bot.set_webhook(
+            url=config.webhook_url.rstrip('/') + config.webhook_path,
+            secret_token=config.webhook_secret,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=False
+        )
+    except Exception as e:
+        # Другой процесс мог уже зарегистрировать тот же адрес
+        logger.error(f"❌ Ошибка регистрации webhook: {e}")
+
+    try:
+        await shutdown_event.wait()
+    finally:
+        logger.info("🛑 Остановка webhook-сервера")
+        # Сначала перестаем принимать запросы, затем дорабатываем принятые
+        await site.stop()
+        await wait_pending_updates(app)
+        await runner.cleanup()